@@ -32,12 +32,32 @@ NEM12_STORAGE_PATH_IN = os.environ.get(
     'NEM12_STORAGE_PATH_IN', 'NEM12_STORAGE_PATH_IN not set.')
 NEM12_STORAGE_PATH_MERGED = os.environ.get(
     'NEM12_STORAGE_PATH_MERGED', 'NEM12_STORAGE_PATH_MERGED not set.')
+NEM12_HIGH_RES_DAILIES = os.environ.get(
+    'NEM12_HIGH_RES_DAILIES', 'false').lower() == 'true'
+# A burst of NEM12 uploads within the window is merged in one run, the lease expires if its holder dies
+NEM12_MERGE_WINDOW_SECONDS = float(
+    os.environ.get('NEM12_MERGE_WINDOW_SECONDS', '10'))
+NEM12_MERGE_LEASE_SECONDS = float(
+    os.environ.get('NEM12_MERGE_LEASE_SECONDS', '540'))
+
+MANIFEST_STORAGE_PATH_PREFIX = os.environ.get(
+    'MANIFEST_STORAGE_PATH_PREFIX', 'manifests')
 
 GCP_STORAGE_BUCKET_ID = os.environ.get(
     'GCP_STORAGE_BUCKET_ID', 'GCP_STORAGE_BUCKET_ID not set.')
 
 NMI = os.environ.get('NMI', 'NMI not set.')
 
+HTTP_CONNECT_TIMEOUT_SECONDS = float(
+    os.environ.get('HTTP_CONNECT_TIMEOUT_SECONDS', '10'))
+HTTP_READ_TIMEOUT_SECONDS = float(
+    os.environ.get('HTTP_READ_TIMEOUT_SECONDS', '60'))
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', '3'))
+
+# cloud: google-cloud-logging CloudLoggingHandler, stdout: JSON lines on stdout which Cloud Functions
+# forwards to Cloud Logging, without importing google-cloud-logging on cold start
+GCP_LOGGING_HANDLER = os.environ.get('GCP_LOGGING_HANDLER', 'cloud')
+
 VIEWBANK_WEATHER_URL = 'https://reg.bom.gov.au/fwo/IDV60901/IDV60901.95874.json'
 SCORESBY_WEATHER_URL = 'https://reg.bom.gov.au/fwo/IDV60901/IDV60901.95867.json'
 
@@ -74,18 +94,47 @@ def init_firestore_client():
 
 def init_gcp_logger():
     import logging
-    from google.cloud.logging.handlers import CloudLoggingHandler, setup_logging
-    import google.cloud.logging as gcp_logging
 
     global GCP_LOGGER
 
     if GCP_LOGGER:
         return GCP_LOGGER
 
-    GCP_LOG_CLIENT = gcp_logging.Client()
-    GCP_LOG_HANDLER = CloudLoggingHandler(GCP_LOG_CLIENT)
+    if GCP_LOGGING_HANDLER == 'stdout':
+        import sys
+
+        GCP_LOG_HANDLER = logging.StreamHandler(sys.stdout)
+        GCP_LOG_HANDLER.setFormatter(structured_log_formatter())
+    else:
+        from google.cloud.logging.handlers import CloudLoggingHandler
+        import google.cloud.logging as gcp_logging
+
+        GCP_LOG_CLIENT = gcp_logging.Client()
+        GCP_LOG_HANDLER = CloudLoggingHandler(GCP_LOG_CLIENT)
+
     GCP_LOGGER = logging.getLogger()
     GCP_LOGGER.setLevel(logging.INFO)
     GCP_LOGGER.addHandler(GCP_LOG_HANDLER)
 
     return GCP_LOGGER
+
+
+def structured_log_formatter():
+    """Formats records as the JSON lines Cloud Logging parses into a log entry with severity."""
+    import json
+    import logging
+
+    class StructuredLogFormatter(logging.Formatter):
+        def format(self, record):
+            message = record.getMessage()
+            if record.exc_info:
+                message = f"{message}\n{self.formatException(record.exc_info)}"
+
+            entry = {'severity': record.levelname, 'message': message, 'logger': record.name}
+            # Spans of app.metrics are passed as extra, kept as a field of the entry to query on
+            if hasattr(record, 'metrics'):
+                entry['metrics'] = record.metrics
+
+            return json.dumps(entry)
+
+    return StructuredLogFormatter()
@@ -0,0 +1,396 @@
+"""
+Storage and DB backends.  Handlers talk to a BlobStore (blob get/put/list) and a DailiesStore
+(site and daily document upsert/stream) instead of google.cloud.storage and Firestore directly,
+so the ingest pipelines can also run against local disk or memory, e.g. for backfills and profiling.
+
+HOME_ENERGY_BACKEND=gcp (default) uses Cloud Storage and Firestore,
+HOME_ENERGY_BACKEND=local uses LocalBlobStore and SqliteDailiesStore under LOCAL_BACKEND_DIR.
+"""
+
+import os
+import pickle
+import sqlite3
+import threading
+from collections import namedtuple
+from datetime import datetime, timezone
+from pathlib import Path
+
+from app import init_firestore_client, init_storage_client
+
+HOME_ENERGY_BACKEND = os.environ.get('HOME_ENERGY_BACKEND', 'gcp')
+LOCAL_BACKEND_DIR = os.environ.get('LOCAL_BACKEND_DIR', '.local')
+
+BLOB_STORE = None
+DAILIES_STORE = None
+
+BlobInfo = namedtuple('BlobInfo', ['name', 'size', 'generation'])
+
+
+class BlobStore():
+    """Interface of a flat blob namespace, blob names use / separated paths like Cloud Storage."""
+
+    def get(self, name):
+        """Returns the blob content as bytes, None if the blob does not exist."""
+        raise NotImplementedError()
+
+    def put(self, name, data, content_type=None):
+        """Creates or replaces the blob, data can be bytes or str."""
+        raise NotImplementedError()
+
+    def create(self, name, data, content_type=None):
+        """Creates the blob only if it does not exist yet, returns False if it already existed."""
+        raise NotImplementedError()
+
+    def replace(self, name, data, generation, content_type=None):
+        """Replaces the blob only if it is still at generation, returns False if it changed or was deleted."""
+        raise NotImplementedError()
+
+    def delete(self, name, generation=None):
+        """Deletes the blob if it exists, and if given generation only if it is still at generation."""
+        raise NotImplementedError()
+
+    def list(self, prefix):
+        """Returns BlobInfo of all blobs with names starting with prefix, ordered by name."""
+        raise NotImplementedError()
+
+    def stat(self, name):
+        """Returns BlobInfo of the blob, None if the blob does not exist."""
+        raise NotImplementedError()
+
+    def exists(self, name):
+        return self.stat(name) is not None
+
+
+class GcsBlobStore(BlobStore):
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def get(self, name):
+        blob = self.bucket.get_blob(name)
+        if blob is None:
+            return None
+
+        return blob.download_as_string()
+
+    def put(self, name, data, content_type=None):
+        blob = self.bucket.blob(name)
+        blob.upload_from_string(data, content_type=content_type)
+
+    def create(self, name, data, content_type=None):
+        from google.api_core.exceptions import PreconditionFailed
+
+        blob = self.bucket.blob(name)
+        # ifGenerationMatch=0 makes the upload fail if the blob exists, checking and creating in one request
+        try:
+            blob.upload_from_string(
+                data, content_type=content_type, if_generation_match=0)
+        except PreconditionFailed:
+            return False
+
+        return True
+
+    def replace(self, name, data, generation, content_type=None):
+        from google.api_core.exceptions import PreconditionFailed
+
+        try:
+            self.bucket.blob(name).upload_from_string(
+                data, content_type=content_type, if_generation_match=generation)
+        except PreconditionFailed:
+            return False
+
+        return True
+
+    def delete(self, name, generation=None):
+        from google.api_core.exceptions import NotFound, PreconditionFailed
+
+        try:
+            self.bucket.delete_blob(name, if_generation_match=generation)
+        except (NotFound, PreconditionFailed):
+            pass
+
+    def list(self, prefix):
+        return [BlobInfo(b.name, b.size, b.generation) for b in self.bucket.list_blobs(prefix=prefix)]
+
+    def stat(self, name):
+        blob = self.bucket.get_blob(name)
+        if blob is None:
+            return None
+
+        return BlobInfo(blob.name, blob.size, blob.generation)
+
+
+class LocalBlobStore(BlobStore):
+    """
+    Blobs are files under root_dir, the file modification time in nanoseconds stands in for the generation.
+    Conditional replace and delete are atomic within the process only.
+    """
+
+    _conditional_lock = threading.Lock()
+
+    def __init__(self, root_dir):
+        self.root_dir = Path(root_dir)
+
+    def get(self, name):
+        path = self.root_dir / name
+        if not path.is_file():
+            return None
+
+        return path.read_bytes()
+
+    def put(self, name, data, content_type=None):
+        path = self.root_dir / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data.encode('utf-8') if isinstance(data, str) else data)
+
+    def create(self, name, data, content_type=None):
+        path = self.root_dir / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            with open(path, 'xb') as blob_file:
+                blob_file.write(data.encode('utf-8') if isinstance(data, str) else data)
+        except FileExistsError:
+            return False
+
+        return True
+
+    def replace(self, name, data, generation, content_type=None):
+        path = self.root_dir / name
+        with self._conditional_lock:
+            info = self.stat(name)
+            if info is None or info.generation != generation:
+                return False
+            path.write_bytes(data.encode('utf-8') if isinstance(data, str) else data)
+            # The modification time can be too coarse to change on a quick rewrite, a generation must
+            if path.stat().st_mtime_ns <= generation:
+                os.utime(path, ns=(generation + 1, generation + 1))
+
+        return True
+
+    def delete(self, name, generation=None):
+        with self._conditional_lock:
+            info = self.stat(name)
+            if info is None or (generation is not None and info.generation != generation):
+                return
+            (self.root_dir / name).unlink()
+
+    def list(self, prefix):
+        if not self.root_dir.is_dir():
+            return []
+
+        infos = (self._info(path) for path in self.root_dir.rglob('*') if path.is_file())
+        return sorted((info for info in infos if info.name.startswith(prefix)), key=lambda info: info.name)
+
+    def stat(self, name):
+        path = self.root_dir / name
+        if not path.is_file():
+            return None
+
+        return self._info(path)
+
+    def _info(self, path):
+        stat = path.stat()
+        return BlobInfo(path.relative_to(self.root_dir).as_posix(), stat.st_size, stat.st_mtime_ns)
+
+
+class DailiesStore():
+    """
+    Interface of the site and daily documents store, laid out like Firestore
+    {root_collection_name}/{nmi} site documents with a dailies sub collection keyed by %Y%m%d day ids,
+    and optionally other sub collections of daily documents, e.g. dailies_5min at a finer interval length.
+    Writes merge into existing documents field by field and stamp each daily document with updated_at.
+    """
+
+    def upsert_site(self, root_collection_name, nmi, site_data):
+        raise NotImplementedError()
+
+    def upsert_dailies(self, root_collection_name, nmi, dailies, collection_name='dailies'):
+        """dailies is a dict of day id to document data."""
+        raise NotImplementedError()
+
+    def stream_dailies(self, root_collection_name, nmi, updated_since=None, collection_name='dailies'):
+        """
+        Yields (day id, document data) of all daily documents ordered by interval_date,
+        or if updated_since is given only documents with a later updated_at, ordered by updated_at.
+        """
+        raise NotImplementedError()
+
+
+class FirestoreDailiesStore(DailiesStore):
+    def __init__(self, fdb, logger):
+        self.fdb = fdb
+        self.logger = logger
+
+    def upsert_site(self, root_collection_name, nmi, site_data):
+        self.fdb.collection(root_collection_name).document(
+            nmi).set(site_data, merge=True)
+
+    def upsert_dailies(self, root_collection_name, nmi, dailies, collection_name='dailies'):
+        # Imported here so the local backends do not need the google-cloud packages
+        from google.cloud import firestore
+        from app.bulk_writer import BulkWriter
+
+        # There is a limit of 500 on the number of batch writes, BulkWriter splits writes into chunks within the limit
+        writer = BulkWriter(self.fdb, self.logger)
+        dailies_collection = self.fdb.collection(
+            root_collection_name).document(nmi).collection(collection_name)
+
+        for day_id, doc_data in dailies.items():
+            writer.set(dailies_collection.document(day_id),
+                       {**doc_data, 'updated_at': firestore.SERVER_TIMESTAMP}, merge=True)
+
+        return writer.flush()
+
+    def stream_dailies(self, root_collection_name, nmi, updated_since=None, collection_name='dailies'):
+        query = self.fdb.collection(
+            f"{root_collection_name}/{nmi}/{collection_name}")
+        if updated_since is None:
+            query = query.order_by('interval_date', direction='ASCENDING')
+        else:
+            query = query.where('updated_at', '>', updated_since).order_by(
+                'updated_at', direction='ASCENDING')
+
+        for doc in query.stream():
+            yield doc.id, doc.to_dict()
+
+
+class MemoryDailiesStore(DailiesStore):
+    def __init__(self):
+        self.sites = {}
+        self.dailies = {}
+        self._lock = threading.Lock()
+
+    def upsert_site(self, root_collection_name, nmi, site_data):
+        with self._lock:
+            key = (root_collection_name, nmi)
+            self.sites[key] = {**self.sites.get(key, {}), **site_data}
+
+    def upsert_dailies(self, root_collection_name, nmi, dailies, collection_name='dailies'):
+        with self._lock:
+            site_dailies = self.dailies.setdefault(
+                (root_collection_name, nmi, collection_name), {})
+            updated_at = datetime.now(timezone.utc)
+            for day_id, doc_data in dailies.items():
+                site_dailies[day_id] = {**site_dailies.get(day_id, {}), **doc_data, 'updated_at': updated_at}
+
+    def stream_dailies(self, root_collection_name, nmi, updated_since=None, collection_name='dailies'):
+        with self._lock:
+            site_dailies = dict(self.dailies.get(
+                (root_collection_name, nmi, collection_name), {}))
+
+        for day_id, doc_data in _select_dailies(site_dailies.items(), updated_since):
+            yield day_id, dict(doc_data)
+
+
+class SqliteDailiesStore(DailiesStore):
+    """
+    Documents are pickled into a SQLite database file, suited to local backfills of many years.
+    Every sub collection of daily documents is a table of the same name.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._tables = set()
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS sites (root TEXT, nmi TEXT, doc BLOB, PRIMARY KEY (root, nmi))')
+        self._dailies_table('dailies')
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path)
+
+    def _dailies_table(self, collection_name):
+        # Table names cannot be bound as parameters
+        if not collection_name.isidentifier() or collection_name == 'sites':
+            raise ValueError(f"Invalid dailies collection name {collection_name}")
+
+        if collection_name not in self._tables:
+            with self._connect() as conn:
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {collection_name} (root TEXT, nmi TEXT, day_id TEXT, "
+                             'doc BLOB, PRIMARY KEY (root, nmi, day_id))')
+            self._tables.add(collection_name)
+
+        return collection_name
+
+    def upsert_site(self, root_collection_name, nmi, site_data):
+        with self._lock, self._connect() as conn:
+            row = conn.execute('SELECT doc FROM sites WHERE root = ? AND nmi = ?',
+                               (root_collection_name, nmi)).fetchone()
+            existing = pickle.loads(row[0]) if row else {}
+            conn.execute('INSERT OR REPLACE INTO sites VALUES (?, ?, ?)',
+                         (root_collection_name, nmi, pickle.dumps({**existing, **site_data})))
+
+    def upsert_dailies(self, root_collection_name, nmi, dailies, collection_name='dailies'):
+        with self._lock, self._connect() as conn:
+            table = self._dailies_table(collection_name)
+            merged = []
+            updated_at = datetime.now(timezone.utc)
+            for day_id, doc_data in dailies.items():
+                row = conn.execute(f"SELECT doc FROM {table} WHERE root = ? AND nmi = ? AND day_id = ?",
+                                   (root_collection_name, nmi, day_id)).fetchone()
+                existing = pickle.loads(row[0]) if row else {}
+                merged.append((root_collection_name, nmi, day_id,
+                               pickle.dumps({**existing, **doc_data, 'updated_at': updated_at})))
+            conn.executemany(f"INSERT OR REPLACE INTO {table} VALUES (?, ?, ?, ?)", merged)
+
+    def stream_dailies(self, root_collection_name, nmi, updated_since=None, collection_name='dailies'):
+        with self._lock, self._connect() as conn:
+            table = self._dailies_table(collection_name)
+            rows = conn.execute(f"SELECT day_id, doc FROM {table} WHERE root = ? AND nmi = ?",
+                                (root_collection_name, nmi)).fetchall()
+
+        docs = ((day_id, pickle.loads(doc)) for day_id, doc in rows)
+        for day_id, doc_data in _select_dailies(docs, updated_since):
+            yield day_id, doc_data
+
+
+def _select_dailies(day_items, updated_since):
+    if updated_since is None:
+        return sorted(day_items, key=_interval_date_key)
+
+    updated = (day_item for day_item in day_items
+               if day_item[1].get('updated_at') is not None and day_item[1]['updated_at'] > updated_since)
+    return sorted(updated, key=lambda day_item: day_item[1]['updated_at'])
+
+
+def _interval_date_key(day_item):
+    # Same as ordering by interval_date, documents without one (e.g. temperatures only) go by day id
+    day_id, doc_data = day_item
+    interval_date = doc_data.get('interval_date')
+    return interval_date.strftime('%Y%m%d') if interval_date is not None else day_id
+
+
+def as_blob_store(bucket):
+    """Handlers accept either a BlobStore or a google.cloud.storage.Bucket."""
+    if isinstance(bucket, BlobStore):
+        return bucket
+
+    return GcsBlobStore(bucket)
+
+
+def configure_backends(blob_store=None, dailies_store=None):
+    """Overrides the stores returned by init_blob_store() and init_dailies_store(), e.g. for local runs and tests."""
+    global BLOB_STORE, DAILIES_STORE
+
+    BLOB_STORE = blob_store
+    DAILIES_STORE = dailies_store
+
+
+def init_blob_store(bucket_name):
+    if BLOB_STORE:
+        return BLOB_STORE
+
+    if HOME_ENERGY_BACKEND == 'local':
+        return LocalBlobStore(Path(LOCAL_BACKEND_DIR) / 'blobs' / bucket_name)
+
+    return GcsBlobStore(init_storage_client().bucket(bucket_name))
+
+
+def init_dailies_store(logger):
+    if DAILIES_STORE:
+        return DAILIES_STORE
+
+    if HOME_ENERGY_BACKEND == 'local':
+        Path(LOCAL_BACKEND_DIR).mkdir(parents=True, exist_ok=True)
+        return SqliteDailiesStore(str(Path(LOCAL_BACKEND_DIR) / 'dailies.sqlite3'))
+
+    return FirestoreDailiesStore(init_firestore_client(), logger)
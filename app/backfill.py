@@ -0,0 +1,202 @@
+"""
+Backfills Enlighten stats blobs over a range of days as one long running command,
+instead of a MAX_FETCHED_BATCH_SIZE batch per fetch_enlighten_data invocation.
+
+API calls are paced by a token bucket to the Enlighten plan limit and up to `concurrency` requests are kept in flight,
+so slow responses do not waste the call budget.  Progress is saved in a cursor manifest holding the date range
+and the first day of it not fetched yet, an interrupted or failed backfill of the same range resumes from there.  The already fetched index fetch_enlighten_data
+reuses is saved with the cursor, so the days backfilled are not fetched again there.
+
+Usage:
+    python -m app.backfill [--start-date 2019-01-01] [--end-date 2020-01-31] [--concurrency 4]
+"""
+
+import argparse
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from functools import partial
+
+import requests
+
+from app import (ENLIGHTEN_API_KEY, ENLIGHTEN_DATA_MIN_DATE,
+                 ENLIGHTEN_STORAGE_PATH_PREFIX, ENLIGHTEN_SYSTEM_ID,
+                 ENLIGHTEN_USER_ID, GCP_STORAGE_BUCKET_ID,
+                 MANIFEST_STORAGE_PATH_PREFIX)
+from app.backends import init_blob_store
+from app.common import (get_already_fetched, idate_range, read_json_blob,
+                        save_already_fetched, write_json_blob)
+from app.enlighten import (ALREADY_FETCHED_SIZE_THRESHOLD_BYTES,
+                           enlighten_blob_name, get_enlighten_stats_resp)
+
+# Enlighten API free plan only allows maximum of 10 API calls per minute
+ENLIGHTEN_CALLS_PER_MINUTE = 10
+
+ENLIGHTEN_BACKFILL_CURSOR_BLOB_NAME = f"{MANIFEST_STORAGE_PATH_PREFIX}/enlighten_backfill_cursor.json"
+
+
+class TokenBucket():
+    """
+    Allows rate acquisitions per period seconds, in bursts of up to capacity.
+    With the default capacity of 1 calls are evenly spaced, so no window of period seconds sees more than rate calls.
+    """
+
+    def __init__(self, rate, period=60.0, capacity=1, clock=time.monotonic, sleep=asyncio.sleep):
+        self.fill_rate = rate / period
+        self.capacity = capacity
+        self.tokens = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated_at = clock()
+        self._lock = None
+
+    async def acquire(self):
+        # Created on first use, an asyncio.Lock is bound to the event loop running at creation in Python 3.7
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            while True:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated_at) * self.fill_rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await self.sleep((1 - self.tokens) / self.fill_rate)
+
+
+async def backfill_enlighten(blob_store, fetch_day, start_date, end_date, logger,
+                             token_bucket=None, concurrency=4, cursor_blob_name=ENLIGHTEN_BACKFILL_CURSOR_BLOB_NAME):
+    """
+    Fetches the Enlighten stats of every day from start_date to end_date not already in storage.
+    fetch_day(as_of_date) is a blocking call returning a requests.Response, it is run on a thread pool.
+    Days that fail are logged and left for the next run, the cursor never moves past them.
+    The cursor is only resumed from by a backfill of the same start_date and end_date.
+    Fetched blobs are added to the saved already fetched index whenever the cursor moves and when the run ends,
+    also when it ends with an exception.
+    Returns the number of days fetched.
+    """
+    if token_bucket is None:
+        token_bucket = TokenBucket(ENLIGHTEN_CALLS_PER_MINUTE)
+
+    cursor_range = {'start_date': start_date.isoformat(), 'end_date': end_date.isoformat()}
+    cursor = read_json_blob(blob_store, cursor_blob_name, {})
+    resume_date = start_date
+    if cursor.get('next_date') is not None:
+        if {key: cursor.get(key) for key in cursor_range} == cursor_range:
+            resume_date = datetime.fromisoformat(cursor['next_date'])
+        else:
+            logger.info('Ignoring cursor %s of another date range', cursor)
+
+    already_fetched = get_already_fetched(
+        None, blob_store, ENLIGHTEN_STORAGE_PATH_PREFIX, ALREADY_FETCHED_SIZE_THRESHOLD_BYTES, use_manifest=True)
+    as_of_dates = list(idate_range(resume_date, end_date))
+    pending = deque(as_of_date for as_of_date in as_of_dates
+                    if not already_fetched.has_date(as_of_date))
+    done = set(as_of_dates).difference(pending)
+    cursor_index = 0
+    cursor_lock = threading.Lock()
+    fetched_counter = 0
+
+    logger.info('backfill_enlighten(), from %s to %s, %s days to fetch',
+                resume_date.date(), end_date.date(), len(pending))
+
+    def advance_cursor():
+        nonlocal cursor_index
+
+        start_index = cursor_index
+        while cursor_index < len(as_of_dates) and as_of_dates[cursor_index] in done:
+            cursor_index += 1
+        if cursor_index > start_index:
+            next_date = as_of_dates[cursor_index] if cursor_index < len(
+                as_of_dates) else end_date + timedelta(days=1)
+            save_already_fetched(
+                blob_store, ENLIGHTEN_STORAGE_PATH_PREFIX, already_fetched)
+            write_json_blob(blob_store, cursor_blob_name,
+                            {**cursor_range, 'next_date': next_date.isoformat()})
+
+    def record_fetched(as_of_date, blob_name, size):
+        # Runs on the thread pool, the lock keeps the index, done days and cursor writes in order
+        with cursor_lock:
+            already_fetched.add(blob_name, size)
+            done.add(as_of_date)
+            advance_cursor()
+
+    loop = asyncio.get_running_loop()
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            async def fetch_worker():
+                nonlocal fetched_counter
+
+                while pending:
+                    as_of_date = pending.popleft()
+                    await token_bucket.acquire()
+                    try:
+                        resp = await loop.run_in_executor(executor, fetch_day, as_of_date)
+                    except requests.RequestException:
+                        logger.exception('Failed to fetch %s', as_of_date.date())
+                        continue
+
+                    if resp.status_code != 200:
+                        logger.warning('Failed to fetch %s, status_code=%s, %s',
+                                       as_of_date.date(), resp.status_code, resp.text[:200])
+                        continue
+
+                    blob_name = enlighten_blob_name(as_of_date)
+                    await loop.run_in_executor(executor, blob_store.put, blob_name, resp.text)
+                    logger.info('blob %s fetched.', blob_name)
+                    fetched_counter += 1
+                    await loop.run_in_executor(executor, record_fetched, as_of_date, blob_name, len(resp.content))
+
+            await asyncio.gather(*(fetch_worker() for _ in range(concurrency)))
+    finally:
+        # Leaving the executor waited for the writes in flight, what was fetched before a failure is kept
+        with cursor_lock:
+            advance_cursor()
+            if fetched_counter > 0:
+                save_already_fetched(
+                    blob_store, ENLIGHTEN_STORAGE_PATH_PREFIX, already_fetched)
+
+    return fetched_counter
+
+
+def main():
+    yesterday = datetime.combine(
+        date.today(), datetime.min.time()) - timedelta(days=1)
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--start-date', default=ENLIGHTEN_DATA_MIN_DATE)
+    parser.add_argument('--end-date', default=yesterday.date().isoformat())
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--calls-per-minute', type=int,
+                        default=ENLIGHTEN_CALLS_PER_MINUTE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger()
+
+    start_date = datetime.combine(
+        date.fromisoformat(args.start_date), datetime.min.time())
+    end_date = datetime.combine(
+        date.fromisoformat(args.end_date), datetime.min.time())
+    fetch_day = partial(get_enlighten_stats_resp, ENLIGHTEN_API_KEY,
+                        ENLIGHTEN_USER_ID, ENLIGHTEN_SYSTEM_ID)
+
+    fetched_counter = asyncio.run(backfill_enlighten(
+        init_blob_store(GCP_STORAGE_BUCKET_ID), fetch_day, start_date, end_date, logger,
+        token_bucket=TokenBucket(args.calls_per_minute), concurrency=args.concurrency))
+
+    logger.info('Fetched %s days', fetched_counter)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Import time of each Cloud Functions entry point on a cold start, i.e. a fresh interpreter looking up the entry point
+on main, measured with python -X importtime.  Reports the total import time, the number of modules imported,
+whether pandas was imported and the slowest top level packages.
+
+With --history the results are appended as one JSON line per run (with the date and git revision),
+to follow the cold start cost over time.
+
+Usage:
+    python -m app.benchmarks.cold_start [--history cold_start.jsonl] [entry_point ...]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+import main
+
+REPO_DIR = os.path.dirname(os.path.abspath(main.__file__))
+SLOWEST_PACKAGES = 5
+
+ENTRY_POINT_SCRIPT = """
+import sys
+import main
+main.{entry_point}
+print('pandas' in sys.modules, len(sys.modules))
+"""
+
+
+def parse_importtime(stderr):
+    """{module: (self_us, cumulative_us)} of the 'import time:' lines python -X importtime writes to stderr."""
+    module_times = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        module_times[module.strip()] = (int(self_us), int(cumulative_us))
+
+    return module_times
+
+
+def measure_entry_point(entry_point):
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', ENTRY_POINT_SCRIPT.format(entry_point=entry_point)],
+                               cwd=REPO_DIR, capture_output=True, text=True, check=True)
+    module_times = parse_importtime(completed.stderr)
+    pandas_imported, module_count = completed.stdout.split()
+    top_level = {module: cumulative_us for module, (_, cumulative_us) in module_times.items()
+                 if '.' not in module}
+    slowest = sorted(top_level.items(), key=lambda item: item[1], reverse=True)[:SLOWEST_PACKAGES]
+
+    return {
+        'import_ms': round(sum(self_us for self_us, _ in module_times.values()) / 1000, 1),
+        'modules': int(module_count),
+        'pandas_imported': pandas_imported == 'True',
+        'slowest_packages_ms': {module: round(cumulative_us / 1000, 1) for module, cumulative_us in slowest},
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(entry_points=None):
+    return {entry_point: measure_entry_point(entry_point) for entry_point in entry_points or main.ENTRY_POINTS}
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('entry_points', nargs='*')
+    parser.add_argument('--history', help='append the results as a JSON line to this file')
+    args = parser.parse_args()
+
+    results = run(args.entry_points)
+    print(json.dumps(results, indent=2))
+
+    if args.history:
+        with open(args.history, 'a') as history_file:
+            history_file.write(json.dumps({'measured_at': datetime.now(timezone.utc).isoformat(),
+                                           'revision': _git_revision(), 'entry_points': results}) + '\n')
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,48 @@
+"""
+Times reloading a year of synthetic Enlighten blobs, with serial downloads as the reload used to,
+and with concurrent downloads.
+
+Usage:
+    python -m app.benchmarks.enlighten_reload [year]
+"""
+
+import json
+import logging
+import sys
+import tempfile
+from datetime import datetime
+from time import perf_counter
+
+from app.backends import LocalBlobStore
+from app.benchmarks.synthetic import synthetic_enlighten_stats
+from app.common import idate_range
+from app.enlighten import create_enlighten_year_df, enlighten_blob_name
+
+
+def run(year=2019):
+    logger = logging.getLogger()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        blob_store = LocalBlobStore(tmp_dir)
+        for seed, as_of_date in enumerate(idate_range(datetime(year, 1, 1), datetime(year, 12, 31))):
+            blob_store.put(enlighten_blob_name(as_of_date), json.dumps(
+                synthetic_enlighten_stats(as_of_date, seed)))
+
+        start = perf_counter()
+        df_serial = create_enlighten_year_df(
+            blob_store, year, logger, max_workers=1)
+        serial_elapsed = perf_counter() - start
+
+        start = perf_counter()
+        df_parallel = create_enlighten_year_df(blob_store, year, logger)
+        parallel_elapsed = perf_counter() - start
+
+    assert df_parallel.equals(df_serial)
+
+    return {'days': len(df_serial), 'serial_seconds': round(serial_elapsed, 3),
+            'parallel_seconds': round(parallel_elapsed, 3)}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    print(run(*[int(arg) for arg in sys.argv[1:]]))
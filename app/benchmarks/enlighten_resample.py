@@ -0,0 +1,106 @@
+"""
+Times the NumPy Enlighten resampler against the join and groupby per day implementation it replaced,
+over a year of synthetic days.
+
+Usage:
+    python -m app.benchmarks.enlighten_resample [year]
+"""
+
+import sys
+from datetime import datetime
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+from app.benchmarks.synthetic import synthetic_enlighten_stats
+from app.common import AEST_OFFSET, LOCAL_TZ, idate_range
+from app.enlighten import create_normalised_enlighten_days_df
+
+
+def rounded_mean(num):
+    return round(np.mean(num / 1000), 3)
+
+
+def sum_to_kwh(num):
+    return np.sum(num / 1000)
+
+
+def join_groupby_day_df(interval_date, enlighten_intervals):
+    """The previous create_normalised_enlighten_stats_df(), the reference output of the resampler."""
+    df_stats = pd.DataFrame(enlighten_intervals)
+
+    df_stats.rename(columns={'end_at': 'period_end'}, inplace=True)
+    df_stats['period_end'] = pd.to_datetime(
+        df_stats['period_end']).dt.tz_convert(LOCAL_TZ)
+    df_stats['period_start'] = df_stats['period_end'] - \
+        pd.Timedelta('5 minutes')
+    df_stats['interval_date'] = pd.to_datetime(
+        df_stats['period_start'].dt.date)
+    df_stats.set_index(['interval_date', 'period_start',
+                        'period_end'], inplace=True)
+
+    df_periods = _create_5_min_periods_df(interval_date)
+
+    df_solar = df_periods.join(df_stats, how='left', on=[
+        'interval_date', 'period_start', 'period_end'])
+    df_interval = df_solar.groupby(['interval_date', 'interval']).agg(
+        devices_reporting=pd.NamedAgg(
+            column='devices_reporting', aggfunc='first'),
+        mean_powr_kw=pd.NamedAgg(column='powr', aggfunc=rounded_mean),
+        generation_kwh=pd.NamedAgg(column='enwh', aggfunc=sum_to_kwh),
+    ).fillna(0)
+    df_day = df_interval.groupby(['interval_date']).agg(
+        solar_devices_reportings=pd.NamedAgg(
+            column='devices_reporting', aggfunc=list),
+        solar_mean_powrs_kw=pd.NamedAgg(column='mean_powr_kw', aggfunc=list),
+        solar_generations_kwh=pd.NamedAgg(
+            column='generation_kwh', aggfunc=list),
+    )
+
+    return df_day
+
+
+def _create_5_min_periods_df(interval_date):
+    iso_date_str = interval_date.strftime('%Y-%m-%d')
+    interval_date = pd.Timestamp(iso_date_str)
+
+    interval_count = int(60 * 24 / 5)
+    interval5s = pd.Index(np.arange(1, interval_count + 1))
+    period_starts = pd.date_range(
+        start=interval_date, periods=interval_count, freq='5min', tz=AEST_OFFSET)
+    period_ends = period_starts + pd.Timedelta('5 minutes')
+    df_periods = pd.DataFrame({
+        'interval_date': interval_date,
+        'interval_5': interval5s,
+        'period_start': period_starts,
+        'period_end': period_ends,
+    })
+    df_periods['interval'] = np.ceil(
+        df_periods['interval_5'] / (30 / 5)).astype(int)
+    df_periods.set_index(['interval_date', 'period_start',
+                          'period_end', 'interval_5', 'interval'])
+
+    return df_periods
+
+
+def run(year=2019):
+    days = [(as_of_date, synthetic_enlighten_stats(as_of_date, seed).get('intervals'))
+            for seed, as_of_date in enumerate(idate_range(datetime(year, 1, 1), datetime(year, 12, 31)))]
+
+    start = perf_counter()
+    df_reference = pd.concat([join_groupby_day_df(*day) for day in days])
+    reference_elapsed = perf_counter() - start
+
+    start = perf_counter()
+    df_days = create_normalised_enlighten_days_df(days)
+    elapsed = perf_counter() - start
+
+    assert df_days.equals(df_reference)
+
+    return {'days': len(days), 'join_groupby_seconds': round(reference_elapsed, 3),
+            'numpy_seconds': round(elapsed, 3)}
+
+
+if __name__ == '__main__':
+    print(run(*[int(arg) for arg in sys.argv[1:]]))
@@ -0,0 +1,111 @@
+"""
+Compares a new connection per request (plain requests.get) with the pooled sessions of app.http_client,
+against a local keep-alive stub server that counts the connections it accepts.
+Against the real APIs every new connection is also a TLS handshake.
+
+Usage:
+    python -m app.benchmarks.http_reuse [requests]
+"""
+
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+import requests
+
+from app.http_client import close_http_sessions, http_get
+
+
+class StubHttpServer(ThreadingHTTPServer):
+    """
+    Serves body to any GET with ETag etag, answers 304 to a matching If-None-Match
+    and 503 to the first failures requests.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, body=b'{}', etag=None, failures=0):
+        super().__init__(('127.0.0.1', 0), StubHttpHandler)
+        self.body = body
+        self.etag = etag
+        self.failures = failures
+        self.connections = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def get_request(self):
+        request = super().get_request()
+        with self.lock:
+            self.connections += 1
+
+        return request
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StubHttpHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, with Nagle on a kept alive connection waits for the delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        with self.server.lock:
+            self.server.requests += 1
+            failing = self.server.failures > 0
+            self.server.failures -= 1 if failing else 0
+
+        if failing:
+            self._respond(503, b'')
+        elif self.server.etag and self.headers.get('If-None-Match') == self.server.etag:
+            self._respond(304, b'')
+        else:
+            self._respond(200, self.server.body)
+
+    def _respond(self, status_code, body):
+        self.send_response(status_code)
+        if self.server.etag:
+            self.send_header('ETag', self.server.etag)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+def _measure(server, get, request_count):
+    connections_before = server.connections
+    start = perf_counter()
+    for _ in range(request_count):
+        get(f"{server.url}/api/stats").raise_for_status()
+
+    return {'elapsed_seconds': perf_counter() - start,
+            'connections': server.connections - connections_before}
+
+
+def run(request_count=200):
+    server = StubHttpServer(body=b'{"intervals": []}').start()
+    try:
+        per_request = _measure(server, requests.get, request_count)
+        pooled = _measure(server, http_get, request_count)
+    finally:
+        close_http_sessions()
+        server.stop()
+
+    return {'requests': request_count, 'per_request_connection': per_request, 'pooled_session': pooled}
+
+
+if __name__ == '__main__':
+    print(run(*[int(arg) for arg in sys.argv[1:]]))
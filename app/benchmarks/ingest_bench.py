@@ -0,0 +1,237 @@
+"""
+pytest-benchmark suite of the ingest and analysis hot paths, offline with local backends.
+The fixtures, and synthetic data of BENCHMARK_YEARS years (default 10) of BENCHMARK_NMIS NMIs (default 4),
+go through the NEM12 merge and flatten, LEMS and Enlighten normalisation and the dailies export.
+Next to the timings every benchmark keeps the rows it went through, rows per second and the peak memory traced
+while running it once more after the timed rounds in extra_info, which --benchmark-autosave saves with the commit
+to follow them over time.  Fixture benchmarks are skipped when the fixtures are missing.
+
+Usage:
+    pytest app/benchmarks/ingest_bench.py --benchmark-autosave
+    BENCHMARK_YEARS=20 BENCHMARK_NMIS=50 pytest app/benchmarks/ingest_bench.py -k synthetic
+    pytest-benchmark compare
+"""
+
+import gc
+import json
+import logging
+import os
+import tracemalloc
+from datetime import datetime
+from io import StringIO
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from app.backends import (LocalBlobStore, SqliteDailiesStore,
+                          configure_backends)
+from app.benchmarks.synthetic import (DEFAULT_START_DATE,
+                                      synthetic_enlighten_stats,
+                                      synthetic_lems_csv, synthetic_nmis,
+                                      write_synthetic_nem12)
+from app.common import idate_range, merge_df_to_db
+from app.dailies import export_dailies_snapshot
+from app.enlighten import (create_normalised_enlighten_days_df,
+                           create_normalised_enlighten_stats_df)
+from app.lems import create_normalised_lems_df
+from app.nem12 import Nem12Merger, read_nmis
+
+pytest.importorskip('pytest_benchmark')
+
+BENCHMARK_YEARS = int(os.environ.get('BENCHMARK_YEARS', '10'))
+BENCHMARK_NMIS = int(os.environ.get('BENCHMARK_NMIS', '4'))
+SYNTHETIC_REGISTERS = ['E1', 'B1']
+# The LEMS and Enlighten fixtures are of the site of this NMI, as in local_ingest.py
+FIXTURE_NMI = '6408091979'
+
+FIXTURES_DIR = Path(__file__).resolve().parents[2] / 'fixtures'
+NEM12_FIXTURE_FILES = sorted(str(path) for path in (FIXTURES_DIR / 'nem12').glob('*/*.csv'))
+LEMS_FIXTURE_FILES = sorted((FIXTURES_DIR / 'lems').glob('*/*.csv'))
+ENLIGHTEN_FIXTURE_FILES = sorted((FIXTURES_DIR / 'enlighten').glob('*/*.json'))
+
+requires_nem12_fixtures = pytest.mark.skipif(
+    not NEM12_FIXTURE_FILES, reason=f"No NEM12 fixtures in {FIXTURES_DIR}")
+requires_lems_fixtures = pytest.mark.skipif(
+    not LEMS_FIXTURE_FILES, reason=f"No LEMS fixtures in {FIXTURES_DIR}")
+requires_enlighten_fixtures = pytest.mark.skipif(
+    not ENLIGHTEN_FIXTURE_FILES, reason=f"No Enlighten fixtures in {FIXTURES_DIR}")
+
+LOGGER = logging.getLogger(__name__)
+
+
+def peak_bytes(func, *args):
+    """Peak memory traced while func runs once."""
+    gc.collect()
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return peak
+
+
+def run_benchmark(benchmark, rows, func, *args):
+    """
+    Benchmarks func(*args), rows counts the rows of its result for the throughput.
+    Memory is traced after the timed rounds, so the tracing overhead and its allocations are not timed.
+    """
+    result = benchmark(func, *args)
+
+    row_count = rows(result)
+    benchmark.extra_info['rows'] = row_count
+    benchmark.extra_info['peak_bytes'] = peak_bytes(func, *args)
+    # Stats are missing with --benchmark-disable
+    if benchmark.stats is not None:
+        benchmark.extra_info['rows_per_second'] = round(row_count / benchmark.stats.stats.mean, 1)
+
+    return result
+
+
+def _interval_days(merger):
+    return sum(len(nmr.interval_days) for nmr in merger.nmi_meter_registers)
+
+
+def _rows(df):
+    return len(df.index)
+
+
+def _total_rows(dfs):
+    return sum(len(df.index) for df in dfs)
+
+
+def _documents(documents):
+    return documents
+
+
+def _nem12_files_by_nmi(nem12_files):
+    files_by_nmi = {}
+    for nem12_file in nem12_files:
+        for nmi in read_nmis(nem12_file):
+            files_by_nmi.setdefault(nmi, []).append(nem12_file)
+
+    return files_by_nmi
+
+
+def _flatten_all(parsers):
+    """As handle_nem12_blob_merged() does, one NMI per merged file."""
+    return [parser.flatten_to_frame() for parser in parsers]
+
+
+def _normalise_enlighten_blobs(days):
+    """As handle_enlighten_blob() does, one day per blob."""
+    return [create_normalised_enlighten_stats_df(interval_date, intervals) for interval_date, intervals in days]
+
+
+def _export_dailies(dailies_store, blob_store, nmis):
+    return sum(export_dailies_snapshot(dailies_store, blob_store, 'sites', nmi, LOGGER, full=True)
+               for nmi in nmis)
+
+
+def _load_dailies(tmp_dir, dfs_by_nmi):
+    blob_store = LocalBlobStore(tmp_dir / 'blobs')
+    dailies_store = SqliteDailiesStore(str(tmp_dir / 'dailies.sqlite3'))
+    configure_backends(blob_store, dailies_store)
+    try:
+        for nmi, dfs in dfs_by_nmi.items():
+            for dfm in dfs:
+                merge_df_to_db(nmi, dfm, 'sites', LOGGER)
+    finally:
+        configure_backends()
+
+    return blob_store, dailies_store
+
+
+@pytest.fixture(scope='module')
+def fixture_lems_df():
+    return pd.concat([pd.read_csv(path) for path in LEMS_FIXTURE_FILES], ignore_index=True)
+
+
+@pytest.fixture(scope='module')
+def fixture_enlighten_days():
+    return [(datetime.strptime(path.stem[-8:], '%Y%m%d'), json.loads(path.read_bytes()).get('intervals'))
+            for path in ENLIGHTEN_FIXTURE_FILES]
+
+
+@pytest.fixture(scope='module')
+def synthetic_nem12_files(tmp_path_factory):
+    """One file per NMI, as each retailer export only has the NMI of its account."""
+    tmp_dir = tmp_path_factory.mktemp('nem12')
+
+    return [write_synthetic_nem12(str(tmp_dir / f"nem12_{nmi}.csv"), [nmi], SYNTHETIC_REGISTERS,
+                                  DEFAULT_START_DATE, BENCHMARK_YEARS * 365, seed=seed)
+            for seed, nmi in enumerate(synthetic_nmis(BENCHMARK_NMIS))]
+
+
+@pytest.fixture(scope='module')
+def synthetic_lems_df():
+    return pd.read_csv(StringIO(synthetic_lems_csv(DEFAULT_START_DATE, BENCHMARK_YEARS * 365)))
+
+
+@pytest.fixture(scope='module')
+def synthetic_enlighten_days():
+    end_date = DEFAULT_START_DATE.replace(year=DEFAULT_START_DATE.year + BENCHMARK_YEARS)
+    return [(as_of_date, synthetic_enlighten_stats(as_of_date, seed)['intervals'])
+            for seed, as_of_date in enumerate(idate_range(DEFAULT_START_DATE, end_date))]
+
+
+@requires_nem12_fixtures
+def test_nem12_merge_fixtures(benchmark):
+    run_benchmark(benchmark, _interval_days, Nem12Merger, NEM12_FIXTURE_FILES)
+
+
+@requires_nem12_fixtures
+def test_nem12_flatten_fixtures(benchmark):
+    parsers = [Nem12Merger(nem12_files, keep_lines=False)
+               for nem12_files in _nem12_files_by_nmi(NEM12_FIXTURE_FILES).values()]
+
+    run_benchmark(benchmark, _total_rows, _flatten_all, parsers)
+
+
+@requires_lems_fixtures
+def test_lems_normalise_fixtures(benchmark, fixture_lems_df):
+    run_benchmark(benchmark, _rows, create_normalised_lems_df, fixture_lems_df)
+
+
+@requires_enlighten_fixtures
+def test_enlighten_normalise_fixtures(benchmark, fixture_enlighten_days):
+    run_benchmark(benchmark, len, _normalise_enlighten_blobs, fixture_enlighten_days)
+
+
+@requires_nem12_fixtures
+@requires_lems_fixtures
+@requires_enlighten_fixtures
+def test_dailies_export_fixtures(benchmark, tmp_path, fixture_lems_df, fixture_enlighten_days):
+    dfs_by_nmi = {nmi: [Nem12Merger(nem12_files, keep_lines=False).flatten_to_frame()]
+                  for nmi, nem12_files in _nem12_files_by_nmi(NEM12_FIXTURE_FILES).items()}
+    dfs_by_nmi[FIXTURE_NMI] += [create_normalised_lems_df(fixture_lems_df),
+                                create_normalised_enlighten_days_df(fixture_enlighten_days)]
+    blob_store, dailies_store = _load_dailies(tmp_path, dfs_by_nmi)
+
+    run_benchmark(benchmark, _documents, _export_dailies, dailies_store, blob_store, sorted(dfs_by_nmi))
+
+
+def test_nem12_merge_synthetic(benchmark, synthetic_nem12_files):
+    run_benchmark(benchmark, _interval_days, Nem12Merger, synthetic_nem12_files)
+
+
+def test_nem12_flatten_synthetic(benchmark, synthetic_nem12_files):
+    parsers = [Nem12Merger([nem12_file], keep_lines=False) for nem12_file in synthetic_nem12_files]
+
+    run_benchmark(benchmark, _total_rows, _flatten_all, parsers)
+
+
+def test_lems_normalise_synthetic(benchmark, synthetic_lems_df):
+    run_benchmark(benchmark, _rows, create_normalised_lems_df, synthetic_lems_df)
+
+
+def test_enlighten_normalise_synthetic(benchmark, synthetic_enlighten_days):
+    run_benchmark(benchmark, _rows, create_normalised_enlighten_days_df, synthetic_enlighten_days)
+
+
+def test_dailies_export_synthetic(benchmark, tmp_path, synthetic_nem12_files):
+    dfs_by_nmi = {nmi: [Nem12Merger(nem12_files, keep_lines=False).flatten_to_frame()]
+                  for nmi, nem12_files in _nem12_files_by_nmi(synthetic_nem12_files).items()}
+    blob_store, dailies_store = _load_dailies(tmp_path, dfs_by_nmi)
+
+    run_benchmark(benchmark, _documents, _export_dailies, dailies_store, blob_store, sorted(dfs_by_nmi))
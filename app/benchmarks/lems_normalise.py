@@ -0,0 +1,126 @@
+"""
+Times the LEMS normalisation kernel against the groupby with list aggregations it replaced,
+over a year of days built from the fixture files.
+
+Usage:
+    python -m app.benchmarks.lems_normalise [days]
+"""
+
+import sys
+from time import perf_counter
+
+import pandas as pd
+
+from app.common import AEST_OFFSET, day_content_hashes, day_records
+from app.lems import create_normalised_lems_df
+
+FIXTURE_FILE = 'fixtures/lems/2019/lems_data_20190405.csv'
+
+
+def groupby_lems_df(dfm):
+    """
+    The previous create_normalised_lems_df(), the reference output of the kernel.
+    Rows of files with 47 rows must have gone through fix_dst_issue() first.
+    """
+    df_normalised = dfm.drop(['Unnamed: 0', 'BatteryId', 'UserGroupId', 'UserGroupName', 'RegistrationId',
+                              'IFUnitSerial', 'CustomerNumber', 'CustomerName', 'CurrentMode', 'TimeZoneId'], axis='columns')
+    df_normalised['period_start'] = pd.to_datetime(
+        dfm['DateMeasuredUtc']).dt.tz_convert(AEST_OFFSET)
+    df_normalised['interval_date'] = pd.to_datetime(
+        df_normalised['period_start'].dt.date)
+    df_normalised.index = dfm.index + 1
+    df_normalised['DeteriorationState_pct'] = df_normalised['DeteriorationState'] / 100
+    df_normalised['Capacity_kwh'] = df_normalised['Capacity'] / 1000
+    df_normalised['ResidualCapacity_pct'] = df_normalised['ResidualCapacity'] / 100
+    df_normalised['PowerAtCharge_kw'] = df_normalised['PowerAtCharge'] / 1000
+    df_normalised['ChargeQty_kwh'] = df_normalised['ChargeQty'] / 1000
+    df_normalised['DischargeQty_kwh'] = df_normalised['DischargeQty'] / 1000
+    df_normalised['TotalChargeQty_kwh'] = df_normalised['TotalChargeQty'] / 1000
+    df_normalised['TotalDischargeQty_kwh'] = df_normalised['TotalDischargeQty'] / 1000
+
+    df_grouped_by_day = df_normalised.groupby(['interval_date']).agg(
+        deterioration_states_pct=pd.NamedAgg(
+            column='DeteriorationState_pct', aggfunc=list),
+        capacities_kw=pd.NamedAgg(
+            column='Capacity_kwh', aggfunc=list),
+        residual_capcacities_pct=pd.NamedAgg(
+            column='ResidualCapacity_pct', aggfunc=list),
+        power_at_charges_kw=pd.NamedAgg(
+            column='PowerAtCharge_kw', aggfunc=list),
+        charge_quantities_kwh=pd.NamedAgg(
+            column='ChargeQty_kwh', aggfunc=list),
+        discharge_quantities_kwh=pd.NamedAgg(
+            column='DischargeQty_kwh', aggfunc=list),
+        total_charge_quantities_kwh=pd.NamedAgg(
+            column='TotalChargeQty_kwh', aggfunc=list),
+        total_discharge_quantities_kwh=pd.NamedAgg(
+            column='TotalDischargeQty_kwh', aggfunc=list),
+        count=pd.NamedAgg(column='interval_date', aggfunc='count'),
+    )
+    df_result = df_grouped_by_day.loc[df_grouped_by_day['count'] == 48]
+    df_result = df_result.drop(['count'], axis='columns')
+
+    return df_result
+
+
+def fix_dst_issue(dfm):
+    """
+    This is needed because LEMS do not handle data correctly during DST transition, i.e. from AEDT to AEST
+    The other way seems fine from AEST to AEDT.
+    Two issues exists when going from AEDT to AEST:
+    1. the hour that rolls back one hour has all values empty.
+    2. Only 47 rows are returned instead of 48.
+    There's nothing much we can do here, simply duplicate the row of data with empty values.
+    Another hack is to add two additional half hourly data when transitioning from AEST to AEDT
+    so that local time data can be converted to standard time data when these files are processed
+    everyday.
+    """
+    row_count = len(dfm.index)
+    if row_count == 47:
+        df_nan = dfm.loc[dfm['UserGroupName'].isnull()]
+
+        df_result = dfm.append([df_nan, df_nan, df_nan]).sort_values(
+            by=['DateMeasuredBattery']).reset_index(drop=True)
+        return df_result
+
+    return dfm
+
+
+def synthetic_lems_rows(days, fixture_file=FIXTURE_FILE):
+    """The rows of one fixture day repeated for consecutive days."""
+    df_day = pd.read_csv(fixture_file)
+    measured_utc = pd.to_datetime(df_day['DateMeasuredUtc'])
+    dfs = []
+    for day in range(days):
+        df_shifted = df_day.copy()
+        df_shifted['DateMeasuredUtc'] = (
+            measured_utc + pd.Timedelta(days=day)).dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+        dfs.append(df_shifted)
+
+    return pd.concat(dfs, ignore_index=True)
+
+
+def run(days=365):
+    dfm = synthetic_lems_rows(days)
+
+    # Normalising and turning the days into the dicts written to the DB
+    start = perf_counter()
+    df_reference = groupby_lems_df(dfm)
+    reference_records = list(day_records(df_reference))
+    reference_elapsed = perf_counter() - start
+
+    start = perf_counter()
+    df_days = create_normalised_lems_df(dfm)
+    records = list(day_records(df_days))
+    elapsed = perf_counter() - start
+
+    # The kernel also keeps daylight saving transition days with a few slots missing
+    assert len(records) >= len(reference_records)
+    assert day_content_hashes(df_days.loc[df_reference.index]) == day_content_hashes(df_reference)
+
+    return {'days': len(df_days), 'groupby_seconds': round(reference_elapsed, 3),
+            'numpy_seconds': round(elapsed, 3)}
+
+
+if __name__ == '__main__':
+    print(run(*[int(arg) for arg in sys.argv[1:]]))
@@ -0,0 +1,132 @@
+"""
+Compares peak memory and time of Nem12Merger.flatten_to_frame() against the per interval dict + groupby pipeline
+it replaced, on the multi-year NEM12 fixture.  The reference reads the raw rows itself, so it checks
+flatten_to_frame() independently of Nem12Merger.
+
+Usage:
+    python -m app.benchmarks.nem12_flatten [nem12_file]
+"""
+
+import csv
+import sys
+import tracemalloc
+from contextlib import nullcontext
+from datetime import datetime
+from time import perf_counter
+
+import pandas as pd
+
+from app.nem12 import Nem12Merger
+
+DEFAULT_NEM12_FILE = 'fixtures/nem12/in/6408091979_20180221_20200221_20200222210500_UNITEDENERGY_DETAILED.csv'
+
+# Frozen copy of the quality flags from least to most severe, independent of app.nem12
+REFERENCE_QUALITY_RANKS = {flag: rank for rank, flag in enumerate('VANESF', start=1)}
+
+
+def _raw_interval_rows(nem12_files):
+    """
+    One dict per interval read straight from the 200, 300 and 400 rows, without Nem12Merger.
+    A day seen in an earlier file is kept with the qualities read with it, as merging does.
+    """
+    rows = []
+    register_order = {}
+    seen_days = set()
+
+    for nem12_file in nem12_files:
+        with nullcontext(nem12_file) if hasattr(nem12_file, 'read') else open(nem12_file) as csv_file:
+            day_rows = None
+            for row in csv.reader(csv_file, delimiter=','):
+                if not row:
+                    continue
+                if row[0] == '200':
+                    register_key = (row[1], row[6], row[3], row[2])
+                    register_order.setdefault(register_key, len(register_order))
+                    register = row[3]
+                    interval_length = int(row[8])
+                    day_rows = None
+                elif row[0] == '300':
+                    interval_count = 1440 // interval_length
+                    interval_date = datetime.strptime(row[1], '%Y%m%d')
+                    if (register_key, interval_date) in seen_days:
+                        day_rows = None
+                        continue
+                    seen_days.add((register_key, interval_date))
+
+                    quality = row[interval_count + 2]
+                    day_rows = []
+                    for i, value in enumerate(row[2:interval_count + 2]):
+                        day_rows.append({
+                            'register_order': register_order[register_key],
+                            'interval_date': interval_date,
+                            'interval': i * interval_length // 30 + 1,
+                            'native_interval': i + 1,
+                            'consumption': float(value) if register.startswith('E') else 0.0,
+                            'generation': float(value) if register.startswith('B') else 0.0,
+                            'quality': quality[:1],
+                        })
+                    rows.extend(day_rows)
+                elif row[0] == '400' and day_rows is not None:
+                    for day_row in day_rows[int(row[1]) - 1:int(row[2])]:
+                        day_row['quality'] = row[3][:1]
+
+    return rows
+
+
+def groupby_day_frame(nem12_files):
+    """
+    The original per interval dict + two level groupby pipeline over the raw rows of nem12_files, kept as the
+    reference implementation.  Finer intervals of a register are summed into 30 minutes with their most severe
+    quality, the quality of the first register wins across registers.
+    """
+    df_nem12 = pd.DataFrame(_raw_interval_rows(nem12_files))
+    df_nem12['quality_rank'] = df_nem12['quality'].map(
+        lambda quality: REFERENCE_QUALITY_RANKS.get(quality, 0))
+
+    # Most severe quality of each register interval, the first of equally severe ones
+    df_nem12 = df_nem12.sort_values(['register_order', 'interval_date', 'interval', 'quality_rank', 'native_interval'],
+                                    ascending=[True, True, True, False, True], kind='stable')
+    df_register = df_nem12.groupby(['register_order', 'interval_date', 'interval']).agg(
+        consumption=pd.NamedAgg(column='consumption', aggfunc='sum'),
+        generation=pd.NamedAgg(column='generation', aggfunc='sum'),
+        quality=pd.NamedAgg(column='quality', aggfunc='first'),
+    ).reset_index()
+
+    df_interval = df_register.groupby(['interval_date', 'interval']).agg(
+        consumption_kwh=pd.NamedAgg(column='consumption', aggfunc='sum'),
+        generation_kwh=pd.NamedAgg(column='generation', aggfunc='sum'),
+        quality=pd.NamedAgg(column='quality', aggfunc='first'),
+    )
+    df_interval['generation_kwh'] = df_interval['generation_kwh'].abs()
+
+    return df_interval.groupby(['interval_date']).agg(
+        meter_consumptions_kwh=pd.NamedAgg(
+            column='consumption_kwh', aggfunc=list),
+        meter_generations_kwh=pd.NamedAgg(
+            column='generation_kwh', aggfunc=list),
+        meter_data_qualities=pd.NamedAgg(column='quality', aggfunc=list),
+    )
+
+
+def measure(func, *args):
+    tracemalloc.start()
+    start = perf_counter()
+    result = func(*args)
+    elapsed = perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, {'elapsed_seconds': round(elapsed, 3), 'peak_bytes': peak}
+
+
+def run(nem12_file=DEFAULT_NEM12_FILE):
+    merger = Nem12Merger([nem12_file])
+
+    _, groupby_stats = measure(groupby_day_frame, [nem12_file])
+    _, frame_stats = measure(merger.flatten_to_frame)
+
+    return {'groupby': groupby_stats, 'flatten_to_frame': frame_stats}
+
+
+if __name__ == '__main__':
+    print(run(*sys.argv[1:]))
@@ -0,0 +1,129 @@
+"""
+Compares the memory held by a parsed NEM12 file in the compact Nem12Merger model (__slots__ classes,
+array('d') interval values, interned qualities) with and without raw lines, against the plain object model
+it replaced, on the NEM12 fixtures.
+
+Usage:
+    python -m app.benchmarks.nem12_memory [nem12_file ...]
+"""
+
+import csv
+import gc
+import sys
+import tracemalloc
+from datetime import datetime
+from os import listdir
+from os.path import isfile, join
+
+from app.nem12 import Nem12Merger
+
+NEM12_FIXTURE_PATHS = ['fixtures/nem12/in', 'fixtures/nem12/merged']
+
+
+class PlainNmiMeterRegister():
+    def __init__(self, nmi, meter, register, register_config, uom, interval_length, line_items):
+        self.nmi = nmi
+        self.meter = meter
+        self.register = register
+        self.register_config = register_config
+        self.uom = uom
+        self.interval_length = interval_length
+        self.interval_days = []
+        self.interval_day_index = {}
+        self.line_items = line_items
+
+
+class PlainIntervalDay():
+    def __init__(self, nmi_meter_register, interval_date, quality, line_items):
+        self.nmi_meter_register = nmi_meter_register
+        self.interval_date = interval_date
+        self.quality = quality
+        self.interval_values = []
+        self.variable_qualities = []
+        self._variable_quality_index = set()
+        self.line_items = line_items
+
+
+class PlainVariableDayQuality():
+    def __init__(self, interval_day, line_str, line_items):
+        self.interval_day = interval_day
+        self.line_str = line_str
+        self.line_items = line_items
+
+
+def plain_object_model(nem12_files):
+    """The original per instance __dict__ model with float lists and raw lines, kept as the reference."""
+    nmr_index = {}
+    interval_dates = {}
+    current_nmr = None
+    current_iday = None
+
+    for nem12_file in nem12_files:
+        with open(nem12_file) as csv_file:
+            for row in csv.reader(csv_file, delimiter=','):
+                if row[0] == '200':
+                    nmr_key = (row[1], row[6], row[3], row[2])
+                    current_nmr = nmr_index.get(nmr_key)
+                    if current_nmr is None:
+                        current_nmr = PlainNmiMeterRegister(
+                            row[1], row[6], row[3], row[2], row[7], int(row[8]), row)
+                        nmr_index[nmr_key] = current_nmr
+                elif row[0] == '300':
+                    interval_count = 1440 // current_nmr.interval_length
+                    interval_date = interval_dates.setdefault(
+                        row[1], datetime.strptime(row[1], '%Y%m%d'))
+                    current_iday = current_nmr.interval_day_index.get(interval_date)
+                    if current_iday is None:
+                        current_iday = PlainIntervalDay(
+                            current_nmr, interval_date, row[interval_count + 2], row)
+                        current_iday.interval_values = [
+                            float(iv) for iv in row[2:interval_count + 2]]
+                        current_nmr.interval_days.append(current_iday)
+                        current_nmr.interval_day_index[interval_date] = current_iday
+                elif row[0] == '400':
+                    line_str = "".join(row)
+                    if line_str not in current_iday._variable_quality_index:
+                        current_iday._variable_quality_index.add(line_str)
+                        current_iday.variable_qualities.append(
+                            PlainVariableDayQuality(current_iday, line_str, row))
+
+    return list(nmr_index.values())
+
+
+def retained_bytes(func, *args):
+    """Bytes still allocated by the result of func once it returns."""
+    gc.collect()
+    tracemalloc.start()
+    result = func(*args)
+    gc.collect()
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, retained
+
+
+def fixture_files():
+    return [join(path, f) for path in NEM12_FIXTURE_PATHS for f in sorted(listdir(path))
+            if isfile(join(path, f)) and f.endswith('.csv')]
+
+
+def run(*nem12_files):
+    results = {}
+    for nem12_file in nem12_files or fixture_files():
+        _, plain_bytes = retained_bytes(plain_object_model, [nem12_file])
+        _, lines_bytes = retained_bytes(Nem12Merger, [nem12_file])
+        merger, compact_bytes = retained_bytes(
+            lambda files: Nem12Merger(files, keep_lines=False), [nem12_file])
+
+        results[nem12_file] = {
+            'interval_days': sum(len(nmr.interval_days) for nmr in merger.nmi_meter_registers),
+            'plain_bytes': plain_bytes,
+            'slots_with_lines_bytes': lines_bytes,
+            'slots_without_lines_bytes': compact_bytes,
+        }
+
+    return results
+
+
+if __name__ == '__main__':
+    print(run(*sys.argv[1:]))
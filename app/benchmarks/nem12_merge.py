@@ -0,0 +1,48 @@
+"""
+Times Nem12Merger over two overlapping synthetic exports of 10 years x 20 registers.
+
+Usage:
+    python -m app.benchmarks.nem12_merge [years] [registers]
+"""
+
+import os
+import sys
+import tempfile
+from datetime import timedelta
+from time import perf_counter
+
+from app.benchmarks.synthetic import (DEFAULT_START_DATE, synthetic_nmis,
+                                      synthetic_registers,
+                                      write_synthetic_nem12)
+from app.nem12 import Nem12Merger
+
+
+def run(years=10, register_count=20):
+    days = years * 365
+    registers = synthetic_registers(register_count)
+    nmis = synthetic_nmis(1)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Two retailer exports overlapping by half, like re-downloading a rolling 2 year window
+        first = write_synthetic_nem12(os.path.join(tmp_dir, 'first.csv'), nmis, registers,
+                                      DEFAULT_START_DATE, days, seed=1)
+        second = write_synthetic_nem12(os.path.join(tmp_dir, 'second.csv'), nmis, registers,
+                                       DEFAULT_START_DATE + timedelta(days=days // 2), days, seed=2)
+
+        start = perf_counter()
+        merger = Nem12Merger([first, second])
+        elapsed = perf_counter() - start
+
+    interval_day_count = sum(len(nmr.interval_days)
+                             for nmr in merger.nmi_meter_registers)
+
+    return {
+        'years': years,
+        'registers': register_count,
+        'interval_days': interval_day_count,
+        'elapsed_seconds': round(elapsed, 3),
+    }
+
+
+if __name__ == '__main__':
+    print(run(*[int(arg) for arg in sys.argv[1:]]))
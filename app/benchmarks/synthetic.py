@@ -0,0 +1,101 @@
+"""
+Synthetic data generators, used to benchmark the ingest pipelines at scales well beyond the fixtures.
+"""
+
+import csv
+import random
+from datetime import datetime, timedelta, timezone
+from io import StringIO
+
+from app.common import LOCAL_TZ
+
+
+def write_synthetic_nem12(file_name, nmis, registers, start_date, days, interval_length=30, seed=0):
+    """
+    Writes a NEM12 file with one 200 record per (nmi, register) followed by one 300 record per day.
+    Registers starting with E are consumption, B are generation, same as United Energy exports.
+    """
+
+    rand = random.Random(seed)
+    interval_count = 1440 // interval_length
+    update_time = start_date.strftime('%Y%m%d%H%M%S')
+
+    with open(file_name, mode='w', newline='') as csv_file:
+        csv_writer = csv.writer(csv_file, delimiter=',')
+        csv_writer.writerow(
+            ['100', 'NEM12', update_time, 'UNITEDENERGY', 'SYNTHETIC'])
+        for nmi in nmis:
+            for register in registers:
+                csv_writer.writerow(['200', nmi, 'E1B1', register, register, '',
+                                     '1236594', 'KWH', str(interval_length), ''])
+                for day in range(days):
+                    interval_date = start_date + timedelta(days=day)
+                    values = [f"{rand.random():.3f}" for _ in range(interval_count)]
+                    csv_writer.writerow(['300', interval_date.strftime('%Y%m%d'), *values,
+                                         'A', '', '', update_time, ''])
+        csv_writer.writerow(['900'])
+
+    return file_name
+
+
+def synthetic_enlighten_stats(as_of_date, seed=0):
+    """Enlighten stats API response of one day, 5 minute intervals from 7:00 to 19:00 local time, like the fixtures."""
+    rand = random.Random(seed)
+    day_start = LOCAL_TZ.localize(datetime.combine(as_of_date.date(), datetime.min.time()))
+    intervals = []
+    for interval_5 in range(7 * 12, 19 * 12):
+        powr = rand.randint(0, 5000)
+        end_at = LOCAL_TZ.normalize(day_start + timedelta(minutes=5 * (interval_5 + 1)))
+        intervals.append({'end_at': end_at.isoformat(), 'devices_reporting': 24,
+                          'powr': powr, 'enwh': powr // 12})
+
+    return {'system_id': 597188, 'total_devices': 24, 'intervals': intervals}
+
+
+LEMS_CSV_HEADER = ['', 'BatteryId', 'UserGroupId', 'UserGroupName', 'RegistrationId', 'IFUnitSerial', 'CustomerNumber',
+                   'CustomerName', 'CurrentMode', 'DeteriorationState', 'Capacity', 'ResidualCapacity', 'PowerAtCharge',
+                   'ChargeQty', 'DischargeQty', 'TotalChargeQty', 'TotalDischargeQty', 'TimeZoneId', 'DateMeasuredUtc',
+                   'DateMeasuredBattery']
+
+
+def synthetic_lems_csv(start_date, days, seed=0):
+    """
+    LEMS battery data CSV of days local days from start_date, a row every half hour of local time like the fixtures,
+    46 or 50 rows on daylight saving transition days.  One day is the content of one LEMS blob.
+    """
+    rand = random.Random(seed)
+    csv_buffer = StringIO()
+    csv_writer = csv.writer(csv_buffer, delimiter=',')
+    csv_writer.writerow(LEMS_CSV_HEADER)
+
+    total_charge = total_discharge = 0.0
+    row_index = 0
+    for day in range(days):
+        local_date = start_date + timedelta(days=day)
+        measured_at = LOCAL_TZ.localize(local_date).astimezone(timezone.utc)
+        next_midnight = LOCAL_TZ.localize(local_date + timedelta(days=1)).astimezone(timezone.utc)
+        while measured_at < next_midnight:
+            charge, discharge = rand.choice([(float(rand.randint(0, 2000)), 0.0), (0.0, float(rand.randint(0, 2000)))])
+            total_charge += charge
+            total_discharge += discharge
+            csv_writer.writerow([row_index, '17fcea94-3612-4105-8e2c-f1d4b0cf3f0a', 9, 'SYNTHETIC', 33554442,
+                                 'E0200922', 10063, 'SYNTHETIC', 70, 80.0, 6720.0, round(rand.uniform(10, 100), 1),
+                                 float(rand.randint(-2000, 2000)), charge, discharge, total_charge, total_discharge,
+                                 'AUS Eastern Standard Time', measured_at.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                                 measured_at.astimezone(LOCAL_TZ).strftime('%Y-%m-%dT%H:%M:%S')])
+            measured_at += timedelta(minutes=30)
+            row_index += 1
+
+    return csv_buffer.getvalue()
+
+
+def synthetic_registers(count):
+    """Half consumption (E1, E2, ...) and half generation (B1, B2, ...) registers."""
+    return [f"{'E' if i % 2 == 0 else 'B'}{i // 2 + 1}" for i in range(count)]
+
+
+def synthetic_nmis(count):
+    return [str(6400000000 + i) for i in range(count)]
+
+
+DEFAULT_START_DATE = datetime(2010, 1, 1)
@@ -0,0 +1,93 @@
+"""
+Chunked, concurrent bulk writer for Firestore documents.
+Firestore limits a batch to 500 writes, writes are split into chunks of at most that size
+and committed concurrently by a bounded thread pool, retrying failed chunks with exponential backoff.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core import exceptions as gcp_exceptions
+
+MAX_BATCH_SIZE = 500
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BACKOFF_SECONDS = 0.5
+
+RETRYABLE_EXCEPTIONS = (
+    gcp_exceptions.Aborted,
+    gcp_exceptions.DeadlineExceeded,
+    gcp_exceptions.InternalServerError,
+    gcp_exceptions.ResourceExhausted,
+    gcp_exceptions.ServiceUnavailable,
+)
+
+
+class BulkWriter():
+    """
+    Collects document writes with set() and commits them with flush().
+    fdb only needs to provide batch(), returning an object with set(doc_ref, data, merge) and commit(),
+    so an in-memory fake or the Firestore emulator can be used in tests.
+    """
+
+    def __init__(self, fdb, logger, chunk_size=MAX_BATCH_SIZE, max_workers=DEFAULT_MAX_WORKERS,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS, backoff_seconds=DEFAULT_BACKOFF_SECONDS, sleep=time.sleep):
+        assert 0 < chunk_size <= MAX_BATCH_SIZE, f"chunk_size must be between 1 and {MAX_BATCH_SIZE} but got chunk_size={chunk_size}"
+
+        self.fdb = fdb
+        self.logger = logger
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.sleep = sleep
+        self._writes = []
+
+    def set(self, doc_ref, doc_data, merge=True):
+        self._writes.append((doc_ref, doc_data, merge))
+
+    def flush(self):
+        """
+        Commits all pending writes, raises the last error of any chunk that still fails after max_attempts.
+        Returns write statistics, documents written, chunks committed, elapsed seconds and documents per second.
+        """
+        writes, self._writes = self._writes, []
+        chunks = [writes[i:i + self.chunk_size]
+                  for i in range(0, len(writes), self.chunk_size)]
+
+        start = time.perf_counter()
+        if len(chunks) > 0:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(chunks))) as executor:
+                documents = sum(executor.map(self._commit_chunk, chunks))
+        else:
+            documents = 0
+        elapsed = time.perf_counter() - start
+
+        stats = {
+            'documents': documents,
+            'chunks': len(chunks),
+            'elapsed_seconds': elapsed,
+            'documents_per_second': documents / elapsed if elapsed > 0 else 0.0,
+        }
+        self.logger.info('BulkWriter.flush(), documents=%s, chunks=%s, elapsed=%.3fs, documents_per_second=%.1f',
+                         stats['documents'], stats['chunks'], stats['elapsed_seconds'], stats['documents_per_second'])
+
+        return stats
+
+    def _commit_chunk(self, chunk):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                batch = self.fdb.batch()
+                for doc_ref, doc_data, merge in chunk:
+                    batch.set(doc_ref, doc_data, merge=merge)
+                batch.commit()
+
+                return len(chunk)
+            except RETRYABLE_EXCEPTIONS as ex:
+                if attempt == self.max_attempts:
+                    raise
+
+                delay = self.backoff_seconds * (2 ** (attempt - 1))
+                self.logger.warning('Commit of %s writes failed on attempt %s, retrying in %.2fs, error=%s',
+                                    len(chunk), attempt, delay, ex)
+                self.sleep(delay)
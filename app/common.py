@@ -1,12 +1,18 @@
+import base64
+import hashlib
 import itertools
+import json
+import re
 import sys
-from datetime import timedelta, timezone
-from operator import itemgetter
+import zlib
+from datetime import datetime, timedelta, timezone
 
 import pandas as pd
 from pytz import timezone as pytz_timezone
 
-from app import init_firestore_client
+from app import MANIFEST_STORAGE_PATH_PREFIX
+from app.backends import as_blob_store, init_dailies_store
+from app.metrics import span
 
 LOCAL_TZ = pytz_timezone('Australia/Melbourne')
 AEST_OFFSET = timezone(pd.Timedelta('10 hours'))
@@ -21,24 +27,154 @@ def idate_range(start_date, end_date):
         yield date
 
 
-def get_already_fetched(storage_client, bucket, prefix, already_fetched_size_threshold_bytes):
-    all_blobs = ({'name': b.name, 'size': b.size}
-                 for b in storage_client.list_blobs(bucket_or_name=bucket, prefix=prefix))
-    sorted_by_size = sorted(all_blobs, key=itemgetter('size'))
+class AlreadyFetched():
+    """
+    Index of the blobs under a prefix that are bigger than the size threshold, smaller blobs are probably only an API
+    error message and are fetched again.  names is the set of blob names and dates a bitmap of the %Y%m%d dates in the
+    names, one bit per day since DATES_BITMAP_EPOCH, so checking a candidate day is O(1) and a date range O(days).
+    """
+
+    DATES_BITMAP_EPOCH = datetime(2000, 1, 1)
+
+    def __init__(self, size_threshold_bytes, names=(), dates_bitmap=b''):
+        self.size_threshold_bytes = size_threshold_bytes
+        self.names = set()
+        self.dates_bitmap = bytearray(dates_bitmap)
+        for name in names:
+            self._add_name(name)
+
+    def __contains__(self, blob_name):
+        return blob_name in self.names
+
+    def __iter__(self):
+        return iter(sorted(self.names))
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, blob_name, size):
+        """Records a blob just written, ignored if it is not over the size threshold."""
+        if size > self.size_threshold_bytes:
+            self._add_name(blob_name)
+
+    def has_date(self, as_of_date):
+        day = self._day_index(as_of_date)
+        return 0 <= day < len(self.dates_bitmap) * 8 and bool(self.dates_bitmap[day // 8] & (1 << (day % 8)))
+
+    def to_json(self):
+        names = zlib.compress('\n'.join(self).encode('utf-8'))
+        return {'size_threshold_bytes': self.size_threshold_bytes,
+                'names': base64.b64encode(names).decode('ascii'),
+                'dates_bitmap': base64.b64encode(self.dates_bitmap).decode('ascii')}
+
+    @classmethod
+    def from_json(cls, data):
+        names = zlib.decompress(base64.b64decode(data['names'])).decode('utf-8')
+        return cls(data['size_threshold_bytes'], names.split('\n') if names else (),
+                   base64.b64decode(data['dates_bitmap']))
+
+    def _add_name(self, blob_name):
+        self.names.add(blob_name)
 
-    grouped_by_size_more_than_threshold = itertools.groupby(
-        sorted_by_size, lambda b: b.get('size') > already_fetched_size_threshold_bytes)
-    already_fetched_group = next(
-        (i for i in grouped_by_size_more_than_threshold if i[0]), (True, iter([])))
-    already_fetched = already_fetched_group[1]
+        match = re.search(r'_(\d{8})\.', blob_name)
+        if match is None:
+            return
+        day = self._day_index(datetime.strptime(match[1], '%Y%m%d'))
+        if day < 0:
+            return
+        if day // 8 >= len(self.dates_bitmap):
+            self.dates_bitmap.extend(bytes(day // 8 + 1 - len(self.dates_bitmap)))
+        self.dates_bitmap[day // 8] |= 1 << (day % 8)
 
-    return list(already_fetched)
+    def _day_index(self, as_of_date):
+        return (datetime.combine(as_of_date.date(), datetime.min.time()) - self.DATES_BITMAP_EPOCH).days
 
 
-def merge_df_to_db(nmi, dfm, root_collection_name, logger):
+def already_fetched_manifest_name(prefix):
+    return f"{MANIFEST_STORAGE_PATH_PREFIX}/already_fetched_{prefix.replace('/', '_')}.json"
+
+
+def get_already_fetched(storage_client, bucket, prefix, already_fetched_size_threshold_bytes, use_manifest=False):
+    """
+    Returns an AlreadyFetched index of the blobs under prefix.
+    With use_manifest the index saved by save_already_fetched() is reused if there is one, otherwise the prefix is
+    listed once.  Everything writing blobs under prefix must add them to the index and save it.
+    """
+    if use_manifest:
+        cached = read_json_blob(
+            bucket, already_fetched_manifest_name(prefix))
+        if cached is not None and cached.get('size_threshold_bytes') == already_fetched_size_threshold_bytes:
+            return AlreadyFetched.from_json(cached)
+
+    return AlreadyFetched(already_fetched_size_threshold_bytes, (
+        b.name for b in as_blob_store(bucket).list(prefix) if b.size > already_fetched_size_threshold_bytes))
+
+
+def save_already_fetched(bucket, prefix, already_fetched):
+    write_json_blob(bucket, already_fetched_manifest_name(
+        prefix), already_fetched.to_json())
+
+
+def read_json_blob(bucket, blob_name, default=None):
+    """
+    Reads a small JSON document (e.g. a manifest) from storage, returns default if the blob does not exist.
+    """
+    content = as_blob_store(bucket).get(blob_name)
+    if content is None:
+        return default
+
+    return json.loads(content)
+
+
+def write_json_blob(bucket, blob_name, data):
+    as_blob_store(bucket).put(blob_name, json.dumps(data, sort_keys=True),
+                              content_type='application/json')
+
+
+def day_records(dfm):
+    """
+    Yields (interval_date, day data) for every row of dfm.
+    Columns are either one list of 48 values per cell, or wide (column, interval) MultiIndex columns
+    with one float column per half hour, which are converted to lists one whole column block at a time.
+    """
+    if not isinstance(dfm.columns, pd.MultiIndex):
+        yield from dfm.to_dict('index').items()
+        return
+
+    names = list(dict.fromkeys(dfm.columns.get_level_values(0)))
+    column_lists = {name: dfm[name].to_numpy().tolist() for name in names}
+    for i, interval_date in enumerate(dfm.index):
+        yield interval_date, {name: column_lists[name][i] for name in names}
+
+
+def day_content_hashes(dfm):
+    """
+    dfm must have DatetimeIndex['interval_date'], one row per day.
+    Returns a content hash of every row keyed by interval_date as %Y%m%d, same as the daily document ids.
+    """
+    return {interval_date.strftime('%Y%m%d'): hashlib.sha1(
+        json.dumps(row, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        for interval_date, row in day_records(dfm)}
+
+
+def select_changed_days(dfm, day_hashes, written_day_hashes):
+    """Rows of dfm whose content hash differs from the hash last written, i.e. new or changed days."""
+    changed = [day_id for day_id, day_hash in day_hashes.items()
+               if written_day_hashes.get(day_id) != day_hash]
+
+    return dfm.loc[dfm.index.strftime('%Y%m%d').isin(changed)]
+
+
+def dailies_collection_name(interval_length):
+    """Daily documents at 30 min intervals go to dailies, finer interval lengths to e.g. dailies_5min."""
+    return 'dailies' if interval_length == 30 else f"dailies_{interval_length}min"
+
+
+def merge_df_to_db(nmi, dfm, root_collection_name, logger, interval_length=30):
     """
     dfm must have DatetimeIndex['interval_date'], dtype='datetime64[ns]'
-    interval_length must be 30 mins so there should be 48 array values for each day
+    there must be 1440 / interval_length array values for each day, see day_records(),
+    interval_length 30 is loaded to dailies, finer ones to their high resolution sub collection
     all values must be normalised to kW or kWh
     """
 
@@ -46,37 +182,25 @@ def merge_df_to_db(nmi, dfm, root_collection_name, logger):
 
     logger.info('merge_df_to_db(%s)', nmi)
 
-    fdb = init_firestore_client()
+    dailies_store = init_dailies_store(logger)
 
-    interval_length = 30
     uom = 'KWH'
+    collection_name = dailies_collection_name(interval_length)
+
+    if collection_name == 'dailies':
+        site_data = {'nmi': nmi, 'name': 'Home',
+                     'interval_length': interval_length, 'uom': uom}
+    else:
+        site_data = {'nmi': nmi, 'high_res_interval_length': interval_length}
+
+    # The site document is counted as a document written too
+    stage_name = 'db_write' if collection_name == 'dailies' else f"db_write_{interval_length}min"
+
+    with span(stage_name, logger, nmi=nmi, collection=collection_name) as db_write:
+        dailies_store.upsert_site(root_collection_name, nmi, site_data)
 
-    site_doc = fdb.collection(root_collection_name).document(nmi)
-    site_doc.set({
-        'nmi': nmi,
-        'name': 'Home',
-        'interval_length': interval_length,
-        'uom': uom,
-    }, merge=True)
-
-    # There is a limit of 500 on the number of batch writes
-    # Write one year of data at a time
-    first_year = dfm.index.get_level_values(
-        'interval_date')[0].year
-    last_year = dfm.index.get_level_values(
-        'interval_date')[-1].year
-
-    for year in range(first_year, last_year + 1):
-        df_year = dfm[str(year)]
-        date_key_dict = df_year.to_dict('index')
-
-        batch = fdb.batch()
-
-        for interval_date in date_key_dict:
-            doc_data = {'interval_date': interval_date,
-                        **(date_key_dict.get(interval_date))}
-            daily_doc = site_doc.collection(
-                'dailies').document(interval_date.strftime('%Y%m%d'))
-            batch.set(daily_doc, doc_data, merge=True)
-
-        batch.commit()
+        dailies = {interval_date.strftime('%Y%m%d'): {'interval_date': interval_date, **day_data}
+                   for interval_date, day_data in day_records(dfm)}
+        dailies_store.upsert_dailies(
+            root_collection_name, nmi, dailies, collection_name=collection_name)
+        db_write.add(rows=len(dfm.index), documents=len(dailies) + 1)
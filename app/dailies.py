@@ -0,0 +1,125 @@
+"""
+Columnar snapshot of the dailies collection, used for analysis in the notebooks.
+Each interval column is stored as a fixed width (days x 48) float64 array and each day column as a (days,) array,
+next to an interval_date datetime64[D] array, in a NumPy .npz file.
+Members of a .npz are read lazily so notebooks only load the columns they select.
+
+The snapshot is refreshed incrementally, a high-water mark of the latest updated_at exported is kept
+in a small JSON blob next to it and only daily documents updated since are read and merged in.
+"""
+
+import json
+from datetime import datetime, timezone
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+INTERVAL_COUNT = 48
+
+INTERVAL_COLUMNS = ['meter_consumptions_kwh', 'meter_generations_kwh',
+                    'solar_generations_kwh', 'solar_mean_powrs_kw', 'solar_devices_reportings',
+                    'capacities_kw', 'charge_quantities_kwh', 'deterioration_states_pct',
+                    'discharge_quantities_kwh', 'power_at_charges_kw', 'residual_capacities_pct',
+                    'total_charge_quantities_kwh', 'total_discharge_quantities_kwh',
+                    ]
+DAY_COLUMNS = ['min_temperature_c', 'max_temperature_c']
+
+
+def dailies_to_arrays(docs):
+    """
+    docs is a sequence of daily document dicts, documents without interval_date are skipped.
+    Missing interval columns are filled with 0.0 and missing day columns with NaN.
+    Returns a dict of column name to array, plus interval_date, ordered by interval_date.
+    """
+    docs = [doc for doc in docs if 'interval_date' in doc]
+
+    # Firestore returns timezone aware UTC timestamps for the naive midnight dates written
+    interval_dates = pd.to_datetime(
+        [doc['interval_date'] for doc in docs], utc=True).tz_localize(None).values.astype('datetime64[D]')
+    order = np.argsort(interval_dates, kind='stable')
+    docs = [docs[i] for i in order]
+    arrays = {'interval_date': interval_dates[order]}
+
+    for column in INTERVAL_COLUMNS:
+        values = np.zeros((len(docs), INTERVAL_COUNT))
+        rows = [i for i, doc in enumerate(docs) if column in doc]
+        if len(rows) > 0:
+            values[rows] = np.array([docs[i][column]
+                                     for i in rows], dtype=np.float64)
+        arrays[column] = values
+
+    for column in DAY_COLUMNS:
+        arrays[column] = np.array([doc.get(column, np.nan)
+                                   for doc in docs], dtype=np.float64)
+
+    return arrays
+
+
+def write_dailies_npz(arrays, file_obj):
+    np.savez(file_obj, **arrays)
+
+
+def read_dailies_npz(file_obj, columns=None):
+    """Reads interval_date and the selected columns (all columns if None) of a dailies snapshot."""
+    with np.load(file_obj) as npz:
+        names = columns if columns is not None else [
+            name for name in npz.files if name != 'interval_date']
+        return {name: npz[name] for name in ['interval_date'] + list(names)}
+
+
+def merge_dailies_arrays(existing, updates):
+    """
+    Merges updated days into an existing snapshot, days in updates replace the same days in existing.
+    Returns arrays ordered by interval_date.
+    """
+    interval_dates = np.concatenate(
+        [existing['interval_date'], updates['interval_date']])
+    keep = ~pd.Index(interval_dates).duplicated(keep='last')
+    order = np.argsort(interval_dates[keep], kind='stable')
+
+    return {name: np.concatenate([existing[name], updates[name]])[keep][order] for name in existing}
+
+
+def export_dailies_snapshot(dailies_store, blob_store, root_collection_name, nmi, logger, full=False):
+    """
+    Exports the dailies of an NMI to dailies_{nmi}.npz with its high-water mark in dailies_{nmi}.json.
+    Unless full is set or there is no previous snapshot, only documents updated since the mark are read.
+    Returns the number of documents read.
+    """
+    npz_blob_name = f"dailies_{nmi}.npz"
+    mark_blob_name = f"dailies_{nmi}.json"
+    export_started_at = datetime.now(timezone.utc)
+
+    existing = None
+    updated_since = None
+    mark_json = None if full else blob_store.get(mark_blob_name)
+    existing_npz = None if mark_json is None else blob_store.get(npz_blob_name)
+    if existing_npz is not None:
+        existing = read_dailies_npz(BytesIO(existing_npz))
+        updated_since = datetime.fromisoformat(
+            json.loads(mark_json)['updated_at'])
+
+    docs = [doc for _, doc in dailies_store.stream_dailies(
+        root_collection_name, nmi, updated_since=updated_since)]
+    arrays = dailies_to_arrays(docs)
+    if existing is not None:
+        arrays = merge_dailies_arrays(existing, arrays)
+
+    npz_buffer = BytesIO()
+    write_dailies_npz(arrays, npz_buffer)
+    blob_store.put(npz_blob_name, npz_buffer.getvalue(),
+                   content_type='application/octet-stream')
+
+    # Documents written before updated_at was recorded have none, the export start time bounds those
+    updated_ats = [doc['updated_at']
+                   for doc in docs if doc.get('updated_at') is not None]
+    mark = max(updated_ats) if len(updated_ats) > 0 else (
+        updated_since or export_started_at)
+    blob_store.put(mark_blob_name, json.dumps({'updated_at': mark.isoformat()}),
+                   content_type='application/json')
+
+    logger.info('export_dailies_snapshot(nmi=%s), updated_since=%s, documents=%s, days=%s',
+                nmi, updated_since, len(docs), len(arrays['interval_date']))
+
+    return len(docs)
@@ -1,27 +1,40 @@
 import json
 import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 
 import numpy as np
 import pandas as pd
-import requests
-from google.cloud.storage import Blob
 
-from app import ENLIGHTEN_URL, NMI
-from app.common import AEST_OFFSET, LOCAL_TZ, merge_df_to_db
+from app import ENLIGHTEN_STORAGE_PATH_PREFIX, ENLIGHTEN_URL, NMI
+from app.backends import as_blob_store
+from app.common import LOCAL_TZ, get_already_fetched, merge_df_to_db
+from app.http_client import http_get
+from app.metrics import span
+from app.timealign import (DAY_NS, MINUTE_NS, utc_to_aest_slots,
+                           utc_to_local_ns)
 
+# If blob name already exists but file size is small then it's probably an API error messgage only.
+ALREADY_FETCHED_SIZE_THRESHOLD_BYTES = 1024
 
-def get_enlighten_stats_resp(api_key, user_id, system_id, as_of_date):
-    local_as_of_date = datetime.combine(
-        as_of_date.date(), datetime.min.time(), tzinfo=LOCAL_TZ)
+
+def get_enlighten_stats_resp(api_key, user_id, system_id, as_of_date, enlighten_url=ENLIGHTEN_URL):
+    # localize() rather than tzinfo=, a pytz zone passed as tzinfo uses its LMT offset
+    local_as_of_date = LOCAL_TZ.localize(datetime.combine(
+        as_of_date.date(), datetime.min.time()))
     path = f"/api/v2/systems/{system_id}/stats"
     query = {'key': api_key, 'user_id': user_id,
              'datetime_format': 'iso8601', 'start_at': f"{int(local_as_of_date.timestamp())}"}
-    resp = requests.get(f"{ENLIGHTEN_URL}{path}", params=query)
+    resp = http_get(f"{enlighten_url}{path}", params=query)
 
     return resp
 
 
+def enlighten_blob_name(as_of_date):
+    return f"{ENLIGHTEN_STORAGE_PATH_PREFIX}/{str(as_of_date.year)}/enlighten_stats_{as_of_date.strftime('%Y%m%d')}.json"
+
+
 def handle_enlighten_blob(data, context, storage_client, bucket, blob_name, root_collection_name, logger):
     """
     Handle blob events in path ENLIGHTEN_STORAGE_PATH_PREFIX, parses the enlighten stats blob (from the blob event),
@@ -36,77 +49,141 @@ def handle_enlighten_blob(data, context, storage_client, bucket, blob_name, root
         logger.warn('Unexpected blob_name=%s', blob_name)
         return None
 
-    blob = Blob(blob_name, bucket)
-    raw_data = json.loads(blob.download_as_string())
-
     interval_date = datetime.strptime(match[1], '%Y%m%d')
 
-    df_day = create_normalised_enlighten_stats_df(
-        interval_date, raw_data.get('intervals'))
+    with span('handle_enlighten_blob', logger, blob_name=blob_name):
+        with span('download') as download:
+            raw_json = as_blob_store(bucket).get(blob_name)
+            download.add(rows=1, bytes=len(raw_json))
+
+        with span('parse') as parse:
+            intervals = json.loads(raw_json).get('intervals')
+            parse.add(rows=len(intervals or ()))
+
+        with span('normalise') as normalise:
+            df_day = create_normalised_enlighten_stats_df(
+                interval_date, intervals)
+            normalise.add(rows=len(df_day.index))
 
-    merge_df_to_db(NMI, df_day, root_collection_name, logger)
+        merge_df_to_db(NMI, df_day, root_collection_name, logger)
 
 
-def rounded_mean(num):
-    return round(np.mean(num / 1000), 3)
+def create_enlighten_year_df(bucket, year, logger, max_workers=8):
+    """
+    Normalised Enlighten days of a whole year for reloading.
+    The blobs of the year are downloaded concurrently on threads and all days normalised in one
+    create_normalised_enlighten_days_df() call.  Returns None if there are no blobs.
+    """
+    blob_store = as_blob_store(bucket)
+
+    with span('list') as list_blobs:
+        blob_names = [name for name in get_already_fetched(
+            None, blob_store, f"{ENLIGHTEN_STORAGE_PATH_PREFIX}/{year}", ALREADY_FETCHED_SIZE_THRESHOLD_BYTES)
+            if _enlighten_blob_date(name) is not None]
+        list_blobs.add(rows=len(blob_names))
+
+    with span('download') as download, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        days = list(executor.map(
+            partial(_read_enlighten_blob, blob_store), blob_names))
+        download.add(rows=len(days))
+
+    logger.info('create_enlighten_year_df(year=%s), blobs=%s', year, len(blob_names))
+    if len(days) == 0:
+        return None
 
+    with span('normalise') as normalise:
+        df_year = create_normalised_enlighten_days_df(days)
+        normalise.add(rows=len(df_year.index))
 
-def sum_to_kwh(num):
-    return np.sum(num / 1000)
+    return df_year
+
+
+def _enlighten_blob_date(blob_name):
+    match = re.search(r'enlighten_stats_(\d\d\d\d\d\d\d\d).json', blob_name)
+    return datetime.strptime(match[1], '%Y%m%d') if match else None
+
+
+def _read_enlighten_blob(blob_store, blob_name):
+    raw_data = json.loads(blob_store.get(blob_name))
+
+    return _enlighten_blob_date(blob_name), raw_data.get('intervals')
+
+
+# Enlighten stats are 5 minute intervals, 288 a day and 6 a half hour interval
+PERIODS_PER_DAY = 288
+PERIODS_PER_INTERVAL = 6
+PERIOD_MINUTES = 5
 
 
 def create_normalised_enlighten_stats_df(interval_date, enlighten_intervals):
-    df_stats = pd.DataFrame(enlighten_intervals)
-
-    df_stats.rename(columns={'end_at': 'period_end'}, inplace=True)
-    df_stats['period_end'] = pd.to_datetime(
-        df_stats['period_end']).dt.tz_convert(LOCAL_TZ)
-    df_stats['period_start'] = df_stats['period_end'] - \
-        pd.Timedelta('5 minutes')
-    df_stats['interval_date'] = pd.to_datetime(
-        df_stats['period_start'].dt.date)
-    df_stats.set_index(['interval_date', 'period_start',
-                        'period_end'], inplace=True)
-
-    df_periods = _create_5_min_periods_df(interval_date)
-
-    df_solar = df_periods.join(df_stats, how='left', on=[
-        'interval_date', 'period_start', 'period_end'])
-    df_interval = df_solar.groupby(['interval_date', 'interval']).agg(
-        devices_reporting=pd.NamedAgg(
-            column='devices_reporting', aggfunc='first'),
-        mean_powr_kw=pd.NamedAgg(column='powr', aggfunc=rounded_mean),
-        generation_kwh=pd.NamedAgg(column='enwh', aggfunc=sum_to_kwh),
-    ).fillna(0)
-    df_day = df_interval.groupby(['interval_date']).agg(
-        solar_devices_reportings=pd.NamedAgg(
-            column='devices_reporting', aggfunc=list),
-        solar_mean_powrs_kw=pd.NamedAgg(column='mean_powr_kw', aggfunc=list),
-        solar_generations_kwh=pd.NamedAgg(
-            column='generation_kwh', aggfunc=list),
-    )
-
-    return df_day
-
-
-def _create_5_min_periods_df(interval_date):
-    iso_date_str = interval_date.strftime('%Y-%m-%d')
-    interval_date = pd.Timestamp(iso_date_str)
-
-    interval_count = int(60 * 24 / 5)
-    interval5s = pd.Index(np.arange(1, interval_count + 1))
-    period_starts = pd.date_range(
-        start=interval_date, periods=interval_count, freq='5min', tz=AEST_OFFSET)
-    period_ends = period_starts + pd.Timedelta('5 minutes')
-    df_periods = pd.DataFrame({
-        'interval_date': interval_date,
-        'interval_5': interval5s,
-        'period_start': period_starts,
-        'period_end': period_ends,
-    })
-    df_periods['interval'] = np.ceil(
-        df_periods['interval_5'] / (30 / 5)).astype(int)
-    df_periods.set_index(['interval_date', 'period_start',
-                          'period_end', 'interval_5', 'interval'])
-
-    return df_periods
+    return create_normalised_enlighten_days_df([(interval_date, enlighten_intervals)])
+
+
+def create_normalised_enlighten_days_df(days):
+    """
+    days is a sequence of (interval_date, enlighten stats intervals) tuples, returns one row per day
+    with 48 half hour values per column.
+    Each 5 minute interval is mapped straight to its period of the AEST day (0..287) from its end_at and scattered
+    into (days x 288) arrays, which are reduced to (days x 48) half hours.  Intervals are kept only if their period
+    starts on interval_date in local time.  Half hours take the first devices_reporting, the mean power in kW rounded
+    to 3 decimals and the sum of energy in kWh, missing values are 0.
+    """
+    day_count = len(days)
+    interval_dates = pd.DatetimeIndex(
+        [pd.Timestamp(interval_date.strftime('%Y-%m-%d')) for interval_date, _ in days], name='interval_date')
+    samples = [(day_index, sample) for day_index, (_, enlighten_intervals) in enumerate(days)
+               for sample in (enlighten_intervals or [])]
+
+    day_indexes = np.array([day_index for day_index, _ in samples], dtype=np.int64)
+    period_starts = pd.to_datetime(
+        [sample['end_at'] for _, sample in samples], utc=True).asi8 - PERIOD_MINUTES * MINUTE_NS
+    local_days = utc_to_local_ns(period_starts) // DAY_NS * DAY_NS
+    aest_days, periods, aligned = utc_to_aest_slots(
+        period_starts, slot_minutes=PERIOD_MINUTES)
+    sample_days = interval_dates.asi8[day_indexes]
+    keep = (local_days == sample_days) & (aest_days == sample_days) & aligned
+    slots = day_indexes[keep] * PERIODS_PER_DAY + periods[keep]
+
+    def sample_values(key):
+        return np.array([sample.get(key) for _, sample in samples], dtype=np.float64)[keep]
+
+    powrs = sample_values('powr')
+    enwhs = sample_values('enwh')
+    devices = sample_values('devices_reporting')
+
+    def day_intervals(values, reduce):
+        return reduce(values.reshape(day_count, 48, PERIODS_PER_INTERVAL), axis=2)
+
+    # Same as joining on the 5 minute periods then groupby half hour, sums skip missing values
+    powr_sums = np.zeros(day_count * PERIODS_PER_DAY)
+    powr_counts = np.zeros(day_count * PERIODS_PER_DAY)
+    enwh_sums = np.zeros(day_count * PERIODS_PER_DAY)
+    powr_valid = ~np.isnan(powrs)
+    np.add.at(powr_sums, slots[powr_valid], powrs[powr_valid] / 1000)
+    np.add.at(powr_counts, slots[powr_valid], 1)
+    enwh_valid = ~np.isnan(enwhs)
+    np.add.at(enwh_sums, slots[enwh_valid], enwhs[enwh_valid] / 1000)
+
+    powr_interval_sums = day_intervals(powr_sums, np.sum)
+    powr_interval_counts = day_intervals(powr_counts, np.sum)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_powrs_kw = np.round(
+            powr_interval_sums / powr_interval_counts, 3)
+    mean_powrs_kw[powr_interval_counts == 0] = 0.0
+    generations_kwh = day_intervals(enwh_sums, np.sum)
+
+    # First devices_reporting of each half hour, in period order
+    devices_reportings = np.zeros(day_count * 48)
+    devices_valid = ~np.isnan(devices)
+    interval_slots = slots[devices_valid] // PERIODS_PER_INTERVAL
+    order = np.lexsort((slots[devices_valid], interval_slots))
+    first_slots, first_indexes = np.unique(
+        interval_slots[order], return_index=True)
+    devices_reportings[first_slots] = devices[devices_valid][order][first_indexes]
+    devices_reportings = devices_reportings.reshape(day_count, 48)
+
+    return pd.DataFrame({
+        'solar_devices_reportings': list(devices_reportings.tolist()),
+        'solar_mean_powrs_kw': list(mean_powrs_kw.tolist()),
+        'solar_generations_kwh': list(generations_kwh.tolist()),
+    }, index=interval_dates)
@@ -5,7 +5,9 @@ import pandas as pd
 from app import (GCP_STORAGE_BUCKET_ID, LEMS_BATTERY_ID, LEMS_DATA_MIN_DATE,
                  LEMS_PASSWORD, LEMS_STORAGE_PATH_PREFIX, LEMS_USER,
                  init_gcp_logger, init_storage_client)
-from app.common import get_already_fetched, idate_range
+from app.backends import init_blob_store
+from app.common import (get_already_fetched, idate_range,
+                        save_already_fetched)
 from app.lems import get_lems_data_resp
 
 # If blob name already exists but file size is small then it's probably an API error messgage only.
@@ -29,28 +31,30 @@ def on_http_get_lems_data(request):
 
     storage_client = init_storage_client()
 
-    bucket = storage_client.get_bucket(GCP_STORAGE_BUCKET_ID)
+    bucket = init_blob_store(GCP_STORAGE_BUCKET_ID)
 
     min_date = datetime.combine(date.fromisoformat(
         LEMS_DATA_MIN_DATE), datetime.min.time())
     yesterday = datetime.combine(
         date.today(), datetime.min.time()) - timedelta(days=1)
+    refresh = bool(request.args) and request.args.get(
+        'refresh', '').lower() == 'true'
     already_fetched = get_already_fetched(
-        storage_client, bucket, LEMS_STORAGE_PATH_PREFIX, ALREADY_FETCHED_SIZE_THRESHOLD_BYTES)
+        storage_client, bucket, LEMS_STORAGE_PATH_PREFIX, ALREADY_FETCHED_SIZE_THRESHOLD_BYTES, use_manifest=not refresh)
 
     for as_of_date in idate_range(min_date, yesterday):
         blob_name = f"{LEMS_STORAGE_PATH_PREFIX}/{str(as_of_date.year)}/lems_data_{as_of_date.strftime('%Y%m%d')}.csv"
-        blob_exists = next((i for i in already_fetched if (
-            i.get('name') == blob_name)), None) is not None
-        if not blob_exists:
+        if not already_fetched.has_date(as_of_date):
             gcp_logger.info('blob %s not exists, downloading.', blob_name)
             resp = get_lems_data_resp(
                 LEMS_USER, LEMS_PASSWORD, LEMS_BATTERY_ID, as_of_date)
-            dfm = pd.DataFrame(resp.json())
+            csv_data = pd.DataFrame(resp.json()).to_csv()
 
-            new_blob = bucket.blob(blob_name)
-            new_blob.upload_from_string(dfm.to_csv())
+            bucket.put(blob_name, csv_data)
+            already_fetched.add(blob_name, len(csv_data.encode('utf-8')))
         else:
             gcp_logger.debug('blob %s already exists, skipping.', blob_name)
 
+    save_already_fetched(bucket, LEMS_STORAGE_PATH_PREFIX, already_fetched)
+
     return ('', 200)
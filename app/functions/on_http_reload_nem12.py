@@ -1,5 +1,6 @@
 from app import (GCP_STORAGE_BUCKET_ID, NMI, init_gcp_logger,
                  init_storage_client)
+from app.backends import init_blob_store
 from app.nem12 import handle_nem12_blob_merged
 
 
@@ -9,10 +10,9 @@ def on_http_reload_nem12(request):
 
     storage_client = init_storage_client()
     blob_name = f"nem12/merged/nem12_{NMI}.csv"
-    bucket = storage_client.get_bucket(GCP_STORAGE_BUCKET_ID)
-    gcp_logger = init_gcp_logger()
+    bucket = init_blob_store(GCP_STORAGE_BUCKET_ID)
 
     handle_nem12_blob_merged(None, None, storage_client,
-                             bucket, blob_name, 'sites', gcp_logger)
+                             bucket, blob_name, 'sites', gcp_logger, full_reload=True)
 
     return ('', 200)
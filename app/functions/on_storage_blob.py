@@ -1,14 +1,18 @@
 from app import (ENLIGHTEN_STORAGE_PATH_PREFIX, LEMS_STORAGE_PATH_PREFIX,
                  NEM12_STORAGE_PATH_IN, NEM12_STORAGE_PATH_MERGED,
                  init_gcp_logger, init_storage_client)
+from app.backends import init_blob_store
 from app.enlighten import handle_enlighten_blob
+from app.idempotency import init_event_ledger
 from app.lems import handle_lems_blob
+from app.metrics import increment
 from app.nem12 import handle_nem12_blob_in, handle_nem12_blob_merged
 
 
 def on_storage_blob(data, context):
     """Background Cloud Function to be triggered by Cloud Storage.
        This generic function logs relevant data when a file is changed.
+       Events of blobs with a handler are claimed in the event ledger first, duplicate deliveries are skipped.
 
     Args:
         data (dict): The Cloud Functions event payload.
@@ -17,7 +21,7 @@ def on_storage_blob(data, context):
         None; the output is written to Stackdriver Logging
     """
     gcp_logger = init_gcp_logger()
-    gcp_logger.info('on_http_get_lems_data()')
+    gcp_logger.info('on_storage_blob()')
     storage_client = init_storage_client()
 
     event_id = context.event_id
@@ -29,22 +33,60 @@ def on_storage_blob(data, context):
     gcp_logger.info(
         'event_id=%s, event_type=%s, bucket=%s, name=%s, metageneration=%s, created=%s, updated=%s', event_id, event_type, bucket_name, blob_name, data.get('metageneration'), blob_created, blob_updated)
 
-    bucket = storage_client.get_bucket(bucket_name)
+    bucket = init_blob_store(bucket_name)
 
+    if route_blob(blob_name) is None:
+        gcp_logger.debug(
+            'Skipping storage event event_id=%s, event_type=%s', context.event_id, context.event_type)
+        return ('', 200)
+
+    event_ledger = init_event_ledger()
+    if not event_ledger.claim(bucket, data, event_id):
+        gcp_logger.info(
+            'Skipping duplicate storage event event_id=%s, name=%s, generation=%s', event_id, blob_name, data.get('generation'))
+        increment('storage_events.duplicate')
+        return ('', 200)
+
+    try:
+        dispatch_blob(data, context, storage_client, bucket,
+                      blob_name, 'sites', gcp_logger)
+    except Exception:
+        event_ledger.release(bucket, data)
+        raise
+
+    return ('', 200)
+
+
+def dispatch_blob(data, context, storage_client, bucket, blob_name, root_collection_name, logger):
+    """
+    Routes a blob to its handler by path prefix.
+    Returns False if no handler applies to the blob.
+    """
+    handler = route_blob(blob_name)
+    if handler is None:
+        return False
+
+    handler(data, context, storage_client, bucket,
+            blob_name, root_collection_name, logger)
+
+    return True
+
+
+def route_blob(blob_name):
+    """Returns the handler of a blob by path prefix, None if no handler applies to the blob."""
     if blob_name.startswith(NEM12_STORAGE_PATH_IN):
-        handle_nem12_blob_in(data, context, storage_client,
-                             bucket, blob_name, gcp_logger)
+        return _handle_nem12_blob_in
     elif blob_name.startswith(NEM12_STORAGE_PATH_MERGED):
-        handle_nem12_blob_merged(data, context, storage_client,
-                                 bucket, blob_name, 'sites', gcp_logger)
+        return handle_nem12_blob_merged
     elif blob_name.startswith(ENLIGHTEN_STORAGE_PATH_PREFIX):
-        handle_enlighten_blob(data, context, storage_client,
-                              bucket, blob_name, 'sites', gcp_logger)
+        return handle_enlighten_blob
     elif blob_name.startswith(LEMS_STORAGE_PATH_PREFIX):
-        handle_lems_blob(data, context, storage_client,
-                         bucket, blob_name, 'sites', gcp_logger)
-    else:
-        gcp_logger.debug(
-            'Skipping storage event event_id=%s, event_type=%s', context.event_id, context.event_type)
+        return handle_lems_blob
 
-    return ('', 200)
+    return None
+
+
+def _handle_nem12_blob_in(data, context, storage_client, bucket, blob_name, root_collection_name, logger):
+    # Merging NEM12 files does not load anything into the root collection
+    handle_nem12_blob_in(data, context, storage_client,
+                         bucket, blob_name, logger)
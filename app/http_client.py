@@ -0,0 +1,86 @@
+"""
+Shared HTTP client for the LEMS, Enlighten and BOM APIs.
+A pooled requests.Session is kept per host for the life of the process, so consecutive calls reuse the connection
+(and its TLS session) instead of a handshake per request.  Every call has a timeout and idempotent requests that fail
+with a connection error or a 5xx response are retried with exponential backoff.
+"""
+
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from app import (HTTP_CONNECT_TIMEOUT_SECONDS, HTTP_MAX_RETRIES,
+                 HTTP_READ_TIMEOUT_SECONDS)
+
+# Enough connections for the concurrent backfill workers
+HTTP_POOL_SIZE = 10
+
+# 429 is not retried, another call straight away only uses up more of the API plan limit
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+SESSIONS = {}
+SESSIONS_LOCK = threading.Lock()
+
+
+def init_http_session(url):
+    """Returns the pooled session of the scheme and host of url, created on first use."""
+    split_url = urlsplit(url)
+    host = f"{split_url.scheme}://{split_url.netloc}"
+
+    with SESSIONS_LOCK:
+        session = SESSIONS.get(host)
+        if session:
+            return session
+
+        retry = Retry(total=HTTP_MAX_RETRIES, backoff_factor=0.5,
+                      status_forcelist=RETRY_STATUS_CODES, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE,
+                              max_retries=retry)
+        session = requests.Session()
+        session.mount(f"{host}/", adapter)
+        SESSIONS[host] = session
+
+        return session
+
+
+def close_http_sessions():
+    with SESSIONS_LOCK:
+        for session in SESSIONS.values():
+            session.close()
+        SESSIONS.clear()
+
+
+def http_get(url, timeout=None, **kwargs):
+    """requests.get() on the pooled session of the host, timeout defaults to the configured (connect, read) timeouts."""
+    if timeout is None:
+        timeout = (HTTP_CONNECT_TIMEOUT_SECONDS, HTTP_READ_TIMEOUT_SECONDS)
+
+    return init_http_session(url).get(url, timeout=timeout, **kwargs)
+
+
+def conditional_get(url, validators, **kwargs):
+    """
+    GET with the ETag and Last-Modified validators last seen for url, validators is a dict of url to validators
+    (e.g. read from a manifest blob), updated in place when the resource has changed.
+    Returns None if the resource is unchanged (304 Not Modified), otherwise the response.
+    Save validators only once the response has been processed, so a failed run downloads it again.
+    """
+    headers = dict(kwargs.pop('headers', None) or {})
+    url_validators = validators.get(url, {})
+    if url_validators.get('etag'):
+        headers['If-None-Match'] = url_validators['etag']
+    if url_validators.get('last_modified'):
+        headers['If-Modified-Since'] = url_validators['last_modified']
+
+    resp = http_get(url, headers=headers, **kwargs)
+    if resp.status_code == 304:
+        return None
+
+    resp.raise_for_status()
+    validators[url] = {'etag': resp.headers.get('ETag'),
+                       'last_modified': resp.headers.get('Last-Modified')}
+
+    return resp
@@ -0,0 +1,141 @@
+"""
+Idempotency ledger of storage events and leases over runs that must not overlap.
+Cloud Storage delivers finalize events at least once, so the same (bucket, name, generation, metageneration)
+can arrive more than once, and every redelivery would re-run the NEM12 merge or Firestore load of the blob.
+
+An event is claimed by creating a small marker blob named after its key only if it does not exist yet,
+a duplicate event finds the marker and is skipped before anything is downloaded.  Events claimed by this
+instance are also kept in an LRU, so redeliveries to a warm instance do not need a request at all.
+The marker is released again if the handler fails, so the redelivered event is retried.
+Markers are never deleted by the functions, the bucket lifecycle rule in storage_lifecycle.json expires them.
+
+A lease is a marker blob too, holding an expiry so a lease left behind by a crashed run can be taken over.
+"""
+
+import hashlib
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from app import MANIFEST_STORAGE_PATH_PREFIX
+
+EVENT_MARKER_PREFIX = f"{MANIFEST_STORAGE_PATH_PREFIX}/events"
+EVENT_LEDGER_CACHE_SIZE = 4096
+
+EVENT_LEDGER = None
+
+
+def event_key(data):
+    """(bucket, name, generation, metageneration) of a storage event payload, None without a generation."""
+    if not data or data.get('generation') is None:
+        return None
+
+    return (data.get('bucket'), data.get('name'), str(data['generation']), str(data.get('metageneration', '1')))
+
+
+def event_marker_name(key):
+    # Blob names can be long and contain any character, the marker name only needs to be unique per key
+    digest = hashlib.sha1('\n'.join(key).encode('utf-8')).hexdigest()
+
+    return f"{EVENT_MARKER_PREFIX}/{digest}"
+
+
+class EventLedger():
+    def __init__(self, cache_size=EVENT_LEDGER_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._claimed = OrderedDict()
+        self._lock = threading.Lock()
+
+    def claim(self, blob_store, data, event_id=None):
+        """
+        Returns True if the event of payload data is seen for the first time and should be handled,
+        False for a duplicate.  Events without a generation are always handled.
+        """
+        key = event_key(data)
+        if key is None:
+            return True
+
+        with self._lock:
+            if key in self._claimed:
+                self._claimed.move_to_end(key)
+                return False
+
+        marker = json.dumps({'key': key, 'event_id': event_id,
+                             'claimed_at': datetime.now(timezone.utc).isoformat()})
+        claimed = blob_store.create(event_marker_name(key), marker,
+                                    content_type='application/json')
+
+        with self._lock:
+            self._claimed[key] = True
+            while len(self._claimed) > self.cache_size:
+                self._claimed.popitem(last=False)
+
+        return claimed
+
+    def release(self, blob_store, data):
+        """Forgets a claimed event, e.g. after its handler failed, so a redelivery is handled again."""
+        key = event_key(data)
+        if key is None:
+            return
+
+        with self._lock:
+            self._claimed.pop(key, None)
+        blob_store.delete(event_marker_name(key))
+
+
+def acquire_lease(blob_store, lease_blob_name, lease_seconds, clock=time.time):
+    """
+    Creates the lease blob if it does not exist or has expired, returns the lease token,
+    or None if another run holds the lease.
+    """
+    token = uuid.uuid4().hex
+    lease = json.dumps({'token': token, 'expires_at': clock() + lease_seconds})
+    if blob_store.create(lease_blob_name, lease, content_type='application/json'):
+        return token
+
+    held = _read_lease(blob_store, lease_blob_name)
+    if held is None:
+        # Released in between, whoever creates it again first gets the lease
+        return token if blob_store.create(lease_blob_name, lease, content_type='application/json') else None
+
+    generation, content = held
+    if content['expires_at'] > clock():
+        return None
+
+    # Expired, only the contender replacing the generation it read gets the lease
+    if blob_store.replace(lease_blob_name, lease, generation, content_type='application/json'):
+        return token
+
+    return None
+
+
+def release_lease(blob_store, lease_blob_name, token):
+    """Deletes the lease blob if it is still the lease of token, i.e. it has not expired and been taken over."""
+    held = _read_lease(blob_store, lease_blob_name)
+    if held is not None and held[1]['token'] == token:
+        blob_store.delete(lease_blob_name, generation=held[0])
+
+
+def _read_lease(blob_store, lease_blob_name):
+    """(generation, lease) of the lease blob, None if there is none."""
+    info = blob_store.stat(lease_blob_name)
+    content = None if info is None else blob_store.get(lease_blob_name)
+    if content is None:
+        return None
+
+    # A lease written between stat and get has a later generation, replacing or deleting it by info fails safely
+    return info.generation, json.loads(content)
+
+
+def init_event_ledger():
+    global EVENT_LEDGER
+
+    if EVENT_LEDGER:
+        return EVENT_LEDGER
+
+    EVENT_LEDGER = EventLedger()
+
+    return EVENT_LEDGER
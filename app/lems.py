@@ -1,14 +1,20 @@
 import base64
 import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import partial
 from io import StringIO
 
+import numpy as np
 import pandas as pd
-import requests
-from google.cloud.storage import Blob
 
 from app import LEMS_STORAGE_PATH_PREFIX, LEMS_URL, NMI
-from app.common import AEST_OFFSET, merge_df_to_db
+from app.backends import as_blob_store
+from app.common import get_already_fetched, merge_df_to_db
+from app.http_client import http_get
+from app.metrics import span
+from app.timealign import (SLOTS_PER_DAY, local_day_slot_counts,
+                           utc_to_aest_slots)
 
 
 def get_lems_data_resp(user_id, password, batter_id, as_of_date):
@@ -19,7 +25,7 @@ def get_lems_data_resp(user_id, password, batter_id, as_of_date):
     path = f"/api/Battery/{batter_id}/soc/data"
     query = {'MinDate': as_of_date, 'Hours': '24'}
 
-    resp = requests.get(f"{LEMS_URL}{path}", headers=headers, params=query)
+    resp = http_get(f"{LEMS_URL}{path}", headers=headers, params=query)
 
     return resp
 
@@ -40,91 +46,135 @@ def handle_lems_blob(data, context, storage_client, bucket, blob_name, root_coll
 
     interval_date = datetime.strptime(match[1], '%Y%m%d')
 
-    blob_today = Blob(blob_name, bucket)
-    csv_today = blob_today.download_as_string().decode('utf-8')
-    dfm = create_df_with_yesterday(bucket, interval_date, csv_today)
+    with span('handle_lems_blob', logger, blob_name=blob_name):
+        with span('download') as download:
+            raw_csv = as_blob_store(bucket).get(blob_name)
+            download.add(rows=1, bytes=len(raw_csv))
 
-    df_days = create_normalised_lems_df(dfm)
+        # Reading yesterday's blob is part of parsing, it is only needed during daylight saving
+        with span('parse') as parse:
+            dfm = create_df_with_yesterday(
+                bucket, interval_date, raw_csv.decode('utf-8'))
+            parse.add(rows=len(dfm.index))
 
-    merge_df_to_db(NMI, df_days, root_collection_name, logger)
+        with span('normalise') as normalise:
+            df_days = create_normalised_lems_df(dfm)
+            normalise.add(rows=len(df_days.index))
+
+        merge_df_to_db(NMI, df_days, root_collection_name, logger)
 
 
 def create_df_with_yesterday(bucket, interval_date, raw_csv):
-    dfm = pd.read_csv(StringIO(raw_csv))
-    df_today = fix_dst_issue(dfm)
+    df_today = pd.read_csv(StringIO(raw_csv))
 
     yesterday = interval_date - timedelta(days=1)
-    blob_name_yesterday = f"{LEMS_STORAGE_PATH_PREFIX}/{yesterday.year}/lems_data_{yesterday.strftime('%Y%m%d')}.csv"
-    blob_yesterday = Blob(blob_name_yesterday, bucket)
-    csv_yesterday = None
-    if blob_yesterday.exists():
-        csv_yesterday = blob_yesterday.download_as_string().decode('utf-8')
-        df_yesterday = fix_dst_issue(pd.read_csv(StringIO(csv_yesterday)))
-        return df_today.append(df_yesterday)
+    csv_yesterday = as_blob_store(bucket).get(_lems_blob_name(yesterday))
+    if csv_yesterday is not None:
+        df_yesterday = pd.read_csv(
+            StringIO(csv_yesterday.decode('utf-8')))
+        # During daylight saving the first half hours in today's file complete yesterday's AEST day
+        return pd.concat([df_yesterday, df_today], ignore_index=True)
 
     return df_today
 
 
-def create_normalised_lems_df(dfm):
-    df_normalised = dfm.drop(['Unnamed: 0', 'BatteryId', 'UserGroupId', 'UserGroupName', 'RegistrationId',
-                              'IFUnitSerial', 'CustomerNumber', 'CustomerName', 'CurrentMode', 'TimeZoneId'], axis='columns')
-    df_normalised['period_start'] = pd.to_datetime(
-        dfm['DateMeasuredUtc']).dt.tz_convert(AEST_OFFSET)
-    df_normalised['interval_date'] = pd.to_datetime(
-        df_normalised['period_start'].dt.date)
-    df_normalised.index = dfm.index + 1
-    df_normalised['DeteriorationState_pct'] = df_normalised['DeteriorationState'] / 100
-    df_normalised['Capacity_kwh'] = df_normalised['Capacity'] / 1000
-    df_normalised['ResidualCapacity_pct'] = df_normalised['ResidualCapacity'] / 100
-    df_normalised['PowerAtCharge_kw'] = df_normalised['PowerAtCharge'] / 1000
-    df_normalised['ChargeQty_kwh'] = df_normalised['ChargeQty'] / 1000
-    df_normalised['DischargeQty_kwh'] = df_normalised['DischargeQty'] / 1000
-    df_normalised['TotalChargeQty_kwh'] = df_normalised['TotalChargeQty'] / 1000
-    df_normalised['TotalDischargeQty_kwh'] = df_normalised['TotalDischargeQty'] / 1000
-
-    df_grouped_by_day = df_normalised.groupby(['interval_date']).agg(
-        deterioration_states_pct=pd.NamedAgg(
-            column='DeteriorationState_pct', aggfunc=list),
-        capacities_kw=pd.NamedAgg(
-            column='Capacity_kwh', aggfunc=list),
-        residual_capcacities_pct=pd.NamedAgg(
-            column='ResidualCapacity_pct', aggfunc=list),
-        power_at_charges_kw=pd.NamedAgg(
-            column='PowerAtCharge_kw', aggfunc=list),
-        charge_quantities_kwh=pd.NamedAgg(
-            column='ChargeQty_kwh', aggfunc=list),
-        discharge_quantities_kwh=pd.NamedAgg(
-            column='DischargeQty_kwh', aggfunc=list),
-        total_charge_quantities_kwh=pd.NamedAgg(
-            column='TotalChargeQty_kwh', aggfunc=list),
-        total_discharge_quantities_kwh=pd.NamedAgg(
-            column='TotalDischargeQty_kwh', aggfunc=list),
-        count=pd.NamedAgg(column='interval_date', aggfunc='count'),
-    )
-    df_result = df_grouped_by_day.loc[df_grouped_by_day['count'] == 48]
-    df_result = df_result.drop(['count'], axis='columns')
-
-    return df_result
-
-
-def fix_dst_issue(dfm):
+def create_lems_year_df(bucket, year, logger, max_workers=8):
     """
-    This is needed because LEMS do not handle data correctly during DST transition, i.e. from AEDT to AEST
-    The other way seems fine from AEST to AEDT.
-    Two issues exists when going from AEDT to AEST:
-    1. the hour that rolls back one hour has all values empty.
-    2. Only 47 rows are returned instead of 48.
-    There's nothing much we can do here, simply duplicate the row of data with empty values.
-    Another hack is to add two additional half hourly data when transitioning from AEST to AEDT
-    so that local time data can be converted to standard time data when these files are processed
-    everyday.
+    Normalised LEMS days of a whole year for reloading.
+    The blobs of the year are listed once and downloaded once each, concurrently, together with the last blob
+    of the year before.  Files are days of local time, the AEST days that cross file boundaries during daylight saving
+    are stitched by a single create_normalised_lems_df call.
+    Returns the same days as handle_lems_blob() would for every blob of the year, or None if there are no blobs.
     """
-    row_count = len(dfm.index)
-    if row_count == 47:
-        df_nan = dfm.loc[dfm['UserGroupName'].isnull()]
+    blob_store = as_blob_store(bucket)
+    previous_day = datetime(int(year), 1, 1) - timedelta(days=1)
+    blob_names = [_lems_blob_name(previous_day)] + [name for name in get_already_fetched(
+        None, blob_store, f"{LEMS_STORAGE_PATH_PREFIX}/{year}", 1024) if _lems_blob_date(name) is not None]
+    blob_names = sorted(blob_names, key=_lems_blob_date)
+
+    with span('download') as download, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        dfs = [dfm for dfm in executor.map(partial(_read_lems_blob, blob_store), blob_names)
+               if dfm is not None]
+        download.add(rows=sum(len(dfm.index) for dfm in dfs))
+
+    logger.info('create_lems_year_df(year=%s), blobs=%s', year, len(dfs))
+    if len(dfs) == 0:
+        return None
+
+    with span('normalise') as normalise:
+        df_year = create_normalised_lems_df(pd.concat(dfs, ignore_index=True))
+        normalise.add(rows=len(df_year.index))
+
+    return df_year
+
+
+def _lems_blob_name(as_of_date):
+    return f"{LEMS_STORAGE_PATH_PREFIX}/{as_of_date.year}/lems_data_{as_of_date.strftime('%Y%m%d')}.csv"
+
+
+def _lems_blob_date(blob_name):
+    match = re.search(r'lems_data_(\d\d\d\d\d\d\d\d).csv', blob_name)
+    return match[1] if match else None
 
-        df_result = dfm.append([df_nan, df_nan, df_nan]).sort_values(
-            by=['DateMeasuredBattery']).reset_index(drop=True)
-        return df_result
 
-    return dfm
+def _read_lems_blob(blob_store, blob_name):
+    raw_csv = blob_store.get(blob_name)
+    if raw_csv is None:
+        return None
+
+    return pd.read_csv(StringIO(raw_csv.decode('utf-8')))
+
+
+# LEMS measurements and the divisor converting each to the unit of its daily document field
+LEMS_COLUMNS = {
+    'DeteriorationState': ('deterioration_states_pct', 100),
+    'Capacity': ('capacities_kw', 1000),
+    'ResidualCapacity': ('residual_capcacities_pct', 100),
+    'PowerAtCharge': ('power_at_charges_kw', 1000),
+    'ChargeQty': ('charge_quantities_kwh', 1000),
+    'DischargeQty': ('discharge_quantities_kwh', 1000),
+    'TotalChargeQty': ('total_charge_quantities_kwh', 1000),
+    'TotalDischargeQty': ('total_discharge_quantities_kwh', 1000),
+}
+
+
+def create_normalised_lems_df(dfm):
+    """
+    dfm is the rows of one or more LEMS data files, in any order.
+    Each row goes to the AEST half hour slot of its DateMeasuredUtc, rows off the half hour are dropped and
+    a later row for the same slot replaces an earlier one.
+    Days are kept if all 48 slots are filled.  On daylight saving transition days LEMS leaves out the repeated
+    hour and a day of local time no longer lines up with the AEST day, so these are also kept with up to two missing
+    slots per half hour the local day is shorter or longer, the missing slots are NaN.
+    Returns one row per day with wide (field, interval) columns, see day_records().
+    """
+    values = dfm[list(LEMS_COLUMNS)].to_numpy(dtype=np.float64) / np.array(
+        [divisor for _, divisor in LEMS_COLUMNS.values()], dtype=np.float64)
+
+    measured_utc = pd.to_datetime(
+        dfm['DateMeasuredUtc'], utc=True).dt.tz_convert(None).to_numpy()
+    valid = ~np.isnat(measured_utc)
+    days_ns, slots, aligned = utc_to_aest_slots(
+        measured_utc[valid].astype(np.int64))
+    days, day_indexes = np.unique(days_ns[aligned], return_inverse=True)
+    slots = slots[aligned]
+
+    day_values = np.full((len(days), SLOTS_PER_DAY,
+                          len(LEMS_COLUMNS)), np.nan)
+    day_values[day_indexes, slots] = values[valid][aligned]
+    filled = np.zeros((len(days), SLOTS_PER_DAY), dtype=bool)
+    filled[day_indexes, slots] = True
+
+    missing_slots = SLOTS_PER_DAY - filled.sum(axis=1)
+    allowed_missing_slots = 2 * \
+        np.abs(local_day_slot_counts(days) - SLOTS_PER_DAY)
+    complete = missing_slots <= allowed_missing_slots
+
+    interval_dates = pd.DatetimeIndex(
+        days[complete].astype('datetime64[ns]'), name='interval_date')
+    columns = pd.MultiIndex.from_product(
+        [[name for name, _ in LEMS_COLUMNS.values()], range(SLOTS_PER_DAY)], names=[None, 'interval'])
+
+    # (days x 48 x fields) -> (days x fields x 48)
+    return pd.DataFrame(day_values[complete].transpose(0, 2, 1).reshape(len(interval_dates), len(columns)),
+                        index=interval_dates, columns=columns)
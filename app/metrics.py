@@ -0,0 +1,146 @@
+"""
+Stage level timing and throughput of the ingest pipelines.
+A span times one stage of a handler (download, parse, normalise, aggregate, db_write) and counts what the stage
+went through: rows, bytes and documents written.  Spans opened within a span are its children, the path of a span
+is the names of its ancestors and its own joined by '/', e.g. handle_lems_blob/db_write.
+
+Every finished span is added to the in-process registry, which keeps the count, total and max duration and
+the rows, bytes and documents per path, so a warm instance or a local backfill can dump them at the end.
+A span without a parent is also logged as one structured record with its children, when given a logger.
+"""
+
+import json
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+METRICS_REGISTRY = None
+
+_ACTIVE_SPANS = threading.local()
+
+
+class Span():
+    __slots__ = ('name', 'path', 'labels', 'rows', 'bytes', 'documents', 'duration_seconds', 'children')
+
+    def __init__(self, name, path, labels):
+        self.name = name
+        self.path = path
+        self.labels = labels
+        self.rows = 0
+        self.bytes = 0
+        self.documents = 0
+        self.duration_seconds = None
+        self.children = []
+
+    def add(self, rows=0, bytes=0, documents=0):
+        self.rows += rows
+        self.bytes += bytes
+        self.documents += documents
+
+    def to_dict(self):
+        span_dict = {'name': self.name, 'path': self.path,
+                     'duration_seconds': round(self.duration_seconds, 6) if self.duration_seconds is not None else None,
+                     'rows': self.rows, 'bytes': self.bytes, 'documents': self.documents, **self.labels}
+        if self.children:
+            span_dict['children'] = [child.to_dict() for child in self.children]
+
+        return span_dict
+
+    def __repr__(self):
+        return f"Span({self.path}, duration_seconds={self.duration_seconds}, rows={self.rows}, bytes={self.bytes}, documents={self.documents})"
+
+
+class MetricsRegistry():
+    def __init__(self):
+        self._stages = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def record(self, span):
+        with self._lock:
+            stage = self._stages.setdefault(span.path, {'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0,
+                                                        'rows': 0, 'bytes': 0, 'documents': 0})
+            stage['count'] += 1
+            stage['total_seconds'] += span.duration_seconds
+            stage['max_seconds'] = max(stage['max_seconds'], span.duration_seconds)
+            stage['rows'] += span.rows
+            stage['bytes'] += span.bytes
+            stage['documents'] += span.documents
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def snapshot(self):
+        """{'stages': {path: stats}, 'counters': {name: value}}, a copy safe to keep while spans are recorded."""
+        with self._lock:
+            return {'stages': {path: dict(stage) for path, stage in sorted(self._stages.items())},
+                    'counters': dict(sorted(self._counters.items()))}
+
+    def dump(self, logger=None):
+        """Returns the snapshot as JSON and logs it if given a logger."""
+        snapshot_json = json.dumps(self.snapshot())
+        if logger is not None:
+            logger.info('metrics %s', snapshot_json)
+
+        return snapshot_json
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self._counters.clear()
+
+
+@contextmanager
+def span(name, logger=None, **labels):
+    """
+    Times the block as a stage, yields the Span to add rows, bytes and documents to.
+    The span is recorded also when the block raises, labels are kept in the logged record only.
+    """
+    stack = _active_spans()
+    parent = stack[-1] if stack else None
+    current = Span(name, f"{parent.path}/{name}" if parent else name, labels)
+    stack.append(current)
+
+    start = perf_counter()
+    try:
+        yield current
+    finally:
+        current.duration_seconds = perf_counter() - start
+        stack.pop()
+        init_metrics_registry().record(current)
+
+        if parent is not None:
+            parent.children.append(current)
+        elif logger is not None:
+            span_dict = current.to_dict()
+            logger.info('span %s', json.dumps(span_dict), extra={'metrics': span_dict})
+
+
+def current_span():
+    """The innermost active span of this thread, None outside of a span."""
+    stack = _active_spans()
+
+    return stack[-1] if stack else None
+
+
+def increment(name, value=1):
+    init_metrics_registry().increment(name, value)
+
+
+def _active_spans():
+    if not hasattr(_ACTIVE_SPANS, 'stack'):
+        _ACTIVE_SPANS.stack = []
+
+    return _ACTIVE_SPANS.stack
+
+
+def init_metrics_registry():
+    global METRICS_REGISTRY
+
+    if METRICS_REGISTRY:
+        return METRICS_REGISTRY
+
+    METRICS_REGISTRY = MetricsRegistry()
+
+    return METRICS_REGISTRY
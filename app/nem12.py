@@ -4,197 +4,619 @@ and NEM12 calculations.
 """
 
 import csv
-import os
-from datetime import datetime
-from pathlib import Path
-
+import itertools
+import sys
+import time
+from array import array
+from collections import Counter, namedtuple
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from functools import lru_cache
+from io import StringIO
+
+import numpy as np
 import pandas as pd
-from google.cloud.storage import Blob
 
-from app import NEM12_STORAGE_PATH_IN, NEM12_STORAGE_PATH_MERGED
-from app.common import merge_df_to_db
+from app import (MANIFEST_STORAGE_PATH_PREFIX, NEM12_HIGH_RES_DAILIES,
+                 NEM12_MERGE_LEASE_SECONDS, NEM12_MERGE_WINDOW_SECONDS,
+                 NEM12_STORAGE_PATH_IN, NEM12_STORAGE_PATH_MERGED)
+from app.backends import as_blob_store
+from app.common import (day_content_hashes, merge_df_to_db, read_json_blob,
+                        select_changed_days, write_json_blob)
+from app.idempotency import acquire_lease, release_lease
+from app.metrics import increment, span
+
+NEM12_MERGED_MANIFEST_BLOB_NAME = f"{MANIFEST_STORAGE_PATH_PREFIX}/nem12_merged_generations.json"
+NEM12_MERGE_LEASE_BLOB_NAME = f"{MANIFEST_STORAGE_PATH_PREFIX}/nem12_merge_lease.json"
 
+# Interval lengths (minutes) of NEM12 registers that can be loaded, days are loaded at 30 minutes
+SUPPORTED_INTERVAL_LENGTHS = (5, 15, 30)
+DAILY_INTERVAL_LENGTH = 30
 
-def handle_nem12_blob_in(data, context, storage_client, bucket, blob_name, logger):
+
+def handle_nem12_blob_in(data, context, storage_client, bucket, blob_name, logger,
+                         window_seconds=None, lease_seconds=None, sleep=time.sleep):
     """
-    Handle blob events in path NEM12_STORAGE_PATH_IN, merges all NEM12 files in this path
+    Handle blob events in path NEM12_STORAGE_PATH_IN, merges NEM12 files in this path
     together and places in NEM12_STORAGE_PATH_MERGED path, one NMI per file.
+    A burst of uploads is coalesced into one merge run: the first event takes the merge lease and waits
+    window_seconds for the rest of the burst to land, events arriving while the lease is held return straight away
+    and leave their blob to the lease holder, which merges again until no new blob is left.
+    window_seconds and lease_seconds default to NEM12_MERGE_WINDOW_SECONDS and NEM12_MERGE_LEASE_SECONDS.
     """
 
     logger.info(f"handle_nem12_blob_in(blob_name={blob_name})")
-    nem12_blobs = [blob for blob in (storage_client.list_blobs(
-        bucket_or_name=bucket, prefix=NEM12_STORAGE_PATH_IN)) if blob.name.endswith('.csv')]
+    blob_store = as_blob_store(bucket)
+    window_seconds = NEM12_MERGE_WINDOW_SECONDS if window_seconds is None else window_seconds
+    lease_seconds = NEM12_MERGE_LEASE_SECONDS if lease_seconds is None else lease_seconds
+
+    while True:
+        token = acquire_lease(
+            blob_store, NEM12_MERGE_LEASE_BLOB_NAME, lease_seconds)
+        if token is None:
+            logger.info(
+                f"NEM12 merge already running, blob_name={blob_name} is left to it")
+            increment('nem12_in.coalesced_events')
+            return
+
+        try:
+            sleep(window_seconds)
+            with span('handle_nem12_blob_in', logger, blob_name=blob_name):
+                while merge_new_nem12_blobs(blob_store, logger) > 0:
+                    pass
+        finally:
+            release_lease(blob_store, NEM12_MERGE_LEASE_BLOB_NAME, token)
+
+        # A blob arriving between the last merge and the release found the lease taken, merge it now
+        if len(_new_nem12_blobs(blob_store)) == 0:
+            return
+        window_seconds = 0
+
+
+def _new_nem12_blobs(blob_store, merged_generations=None):
+    """Blobs in NEM12_STORAGE_PATH_IN not yet recorded in the merged manifest (by name and generation)."""
+    if merged_generations is None:
+        merged_generations = read_json_blob(
+            blob_store, NEM12_MERGED_MANIFEST_BLOB_NAME, {})
+    nem12_blobs = [blob for blob in blob_store.list(
+        NEM12_STORAGE_PATH_IN) if blob.name.endswith('.csv')]
+
+    return [n12 for n12 in nem12_blobs if merged_generations.get(n12.name) != n12.generation]
+
+
+def merge_new_nem12_blobs(blob_store, logger):
+    """
+    Parses the new blobs of NEM12_STORAGE_PATH_IN and merges them on top of the existing merged files
+    of the NMIs they contain, each merged file is written once.  Returns the number of blobs merged.
+    Previously merged days win over those of blobs merged for the first time, same as the earlier file did.
+    Blobs merged before under the same name but with another generation are corrected re-uploads, their days
+    win over the merged ones.
+    """
+    merged_generations = read_json_blob(
+        blob_store, NEM12_MERGED_MANIFEST_BLOB_NAME, {})
+    new_blobs = _new_nem12_blobs(blob_store, merged_generations)
 
-    Path(
-        f"/tmp/{NEM12_STORAGE_PATH_IN}").mkdir(parents=True, exist_ok=True)
-    Path(
-        f"/tmp/{NEM12_STORAGE_PATH_MERGED}").mkdir(parents=True, exist_ok=True)
+    if len(new_blobs) == 0:
+        logger.info('No new NEM12 blobs to merge')
+        return 0
 
     logger.info(
-        f"Merging blobs [{str.join(',', [n12.name for n12 in nem12_blobs])}]")
-    nem12_files = []
-    for n12 in nem12_blobs:
-        file_name = f"/tmp/{n12.name}"
-        with open(file_name, 'wb') as file_obj:
-            n12.download_to_file(file_obj)
-            nem12_files.append(file_name)
+        f"Merging blobs [{str.join(',', [n12.name for n12 in new_blobs])}]")
+    with span('download') as download:
+        new_csvs = [blob_store.get(n12.name).decode('utf-8')
+                    for n12 in new_blobs]
+        nmis = sorted(set(itertools.chain.from_iterable(
+            read_nmis(StringIO(new_csv)) for new_csv in new_csvs)))
+
+        # Re-uploaded blobs come first so their corrections take precedence, then previously merged data,
+        # same as the earlier file did when it was merged
+        replaced_csvs = [new_csv for n12, new_csv in zip(new_blobs, new_csvs) if n12.name in merged_generations]
+        added_csvs = [new_csv for n12, new_csv in zip(new_blobs, new_csvs) if n12.name not in merged_generations]
+        merged_csvs = []
+        for nmi in nmis:
+            merged_csv = blob_store.get(_merged_blob_name(nmi))
+            if merged_csv is not None:
+                merged_csvs.append(merged_csv.decode('utf-8'))
+        download.add(rows=len(new_csvs) + len(merged_csvs),
+                     bytes=sum(len(n12_csv) for n12_csv in merged_csvs + new_csvs))
+
+    with span('parse') as parse:
+        merger = Nem12Merger([StringIO(n12_csv)
+                              for n12_csv in replaced_csvs + merged_csvs + added_csvs])
+        parse.add(rows=_parsed_rows(merger))
+
+    if merger.skipped_records:
+        logger.warning(f"Skipped unknown records {dict(merger.skipped_records)}")
+
+    nmrs_by_nmi = merger.nmi_meter_registers_by_nmi()
+    reads_by_nmi = merger.accumulation_reads_by_nmi()
+    with span('blob_write') as blob_write:
+        for nmi in sorted(set(nmrs_by_nmi) | set(reads_by_nmi)):
+            new_blob_name = _merged_blob_name(nmi)
+            logger.info(f"Writing to new_blob_name={new_blob_name}")
 
-    merger = Nem12Merger(nem12_files)
-    nmi_meter_registers = merger.nmi_meter_registers
+            csv_buffer = StringIO()
+            write_nem12(nmrs_by_nmi.get(nmi, []), csv_buffer,
+                        reads_by_nmi.get(nmi, []))
+            blob_store.put(new_blob_name, csv_buffer.getvalue(),
+                           content_type='text/csv')
+            blob_write.add(bytes=len(csv_buffer.getvalue()), documents=1)
 
-    if len(nmi_meter_registers) > 0:
-        nmis = set([nmr.nmi for nmr in nmi_meter_registers])
+    merged_generations.update(
+        {n12.name: n12.generation for n12 in new_blobs})
+    write_json_blob(blob_store, NEM12_MERGED_MANIFEST_BLOB_NAME,
+                    merged_generations)
+
+    increment('nem12_in.blobs_merged', len(new_blobs))
+
+    return len(new_blobs)
+
+
+def _parsed_rows(merger):
+    """Interval days and accumulation reads parsed, the rows of a merge or load."""
+    return sum(len(nmr.interval_days) for nmr in merger.nmi_meter_registers) + len(merger.accumulation_reads)
+
+
+def _merged_blob_name(nmi):
+    return f"{NEM12_STORAGE_PATH_MERGED}/nem12_{nmi}.csv"
 
-        for nmi in nmis:
-            tmp_file_name = f"/tmp/{NEM12_STORAGE_PATH_MERGED}/nem12_{nmi}.csv"
-            logger.info(f"Writing to file_name={tmp_file_name}")
-
-            with open(tmp_file_name, mode="w") as csv_file:
-                csv_writer = csv.writer(csv_file, delimiter=',')
-                nmrs = [nmr for nmr in nmi_meter_registers if nmr.nmi == nmi]
-                for nmr in nmrs:
-                    csv_writer.writerow(nmr.line_items)
-                    for iday in nmr.interval_days:
-                        csv_writer.writerow(iday.line_items)
-                        for var_q in iday.variable_qualities:
-                            csv_writer.writerow(var_q.line_items)
-
-            new_blob_name = f"{NEM12_STORAGE_PATH_MERGED}/nem12_{nmi}.csv"
-            logger.info(f"Writing to new_blob_name={new_blob_name}")
-            new_blob = bucket.blob(new_blob_name)
-            with open(tmp_file_name, mode="rb") as tmp_file_obj:
-                new_blob.upload_from_file(
-                    file_obj=tmp_file_obj, content_type='text/csv')
 
-            os.remove(tmp_file_name)
+def read_nmis(nem12_file):
+    """Scans only the 200 (NEM12) and 250 (NEM13) records of a NEM12 file and returns the NMIs found."""
+    with _open_nem12(nem12_file) as csv_file:
+        return {row[1] for row in csv.reader(csv_file, delimiter=',') if row and row[0] in ('200', '250')}
 
 
-def handle_nem12_blob_merged(data, context, storage_client, bucket, blob_name, root_collection_name, logger):
+def write_nem12(nmi_meter_registers, file_obj, accumulation_reads=()):
+    """
+    Writes the 200 records with their 300, 400 and 500 records, then the 250 records with their 550 records,
+    as originally read, the registers and reads must come from a Nem12Merger created with keep_lines=True.
+    """
+    csv_writer = csv.writer(file_obj, delimiter=',')
+    for nmr in nmi_meter_registers:
+        if nmr.line_items is None:
+            raise ValueError(
+                f"Lines of {nmr} were not kept, parse with keep_lines=True to write NEM12")
+        csv_writer.writerow(nmr.line_items)
+        for iday in nmr.interval_days:
+            csv_writer.writerow(iday.line_items)
+            for var_q in iday.variable_qualities:
+                csv_writer.writerow(var_q.line_items)
+            for b2b_details in iday.b2b_details or ():
+                csv_writer.writerow(b2b_details.line_items)
+
+    for read in accumulation_reads:
+        if read.line_items is None:
+            raise ValueError(
+                f"Lines of {read} were not kept, parse with keep_lines=True to write NEM13")
+        csv_writer.writerow(read.line_items)
+        if read.b2b_details is not None:
+            csv_writer.writerow(read.b2b_details.line_items)
+
+
+def _open_nem12(nem12_file):
+    """NEM12 files can be given as a file name or an already opened text stream."""
+    if hasattr(nem12_file, 'read'):
+        return nullcontext(nem12_file)
+
+    return open(nem12_file)
+
+
+def handle_nem12_blob_merged(data, context, storage_client, bucket, blob_name, root_collection_name, logger, full_reload=False):
     """
     Handle blob events in path NEM12_STORAGE_PATH_MERGED, parses the NEM12 blob (from the blob event),
     groups consumption and generation data into dates and loads into Firestore.
     This function only handles one NMI per NEM12 file, pre-processed by handle_nem12_blob_in()
+    Only days whose content hash differs from the manifest of days last written are loaded,
+    unless full_reload is set.
+    Registers of 5 or 15 minute intervals are summed into 30 minute intervals, with NEM12_HIGH_RES_DAILIES
+    set the days are also loaded at the finest interval length all registers of the NMI can be summed into,
+    i.e. that of its coarsest register, into its high resolution dailies.  NMIs with a 30 minute register have none.
+    Accumulation reads of NEM13 files are spread evenly over their read periods into the same dailies.
     """
 
     logger.info(f"handle_nem12_blob_merged(blob_name={blob_name})")
 
-    Path(
-        f"/tmp/{NEM12_STORAGE_PATH_MERGED}").mkdir(parents=True, exist_ok=True)
+    with span('handle_nem12_blob_merged', logger, blob_name=blob_name, full_reload=full_reload):
+        _load_nem12_blob_merged(as_blob_store(bucket), blob_name,
+                                root_collection_name, logger, full_reload)
 
-    blob = Blob(blob_name, bucket)
 
-    nem12_files = []
-    with open(f"/tmp/{blob_name}", 'wb') as file_obj:
-        blob.download_to_file(file_obj)
-        nem12_files.append(f"/tmp/{blob_name}")
+def _load_nem12_blob_merged(blob_store, blob_name, root_collection_name, logger, full_reload):
+    with span('download') as download:
+        nem12_csv = blob_store.get(blob_name).decode('utf-8')
+        download.add(rows=1, bytes=len(nem12_csv))
+
+    with span('parse') as parse:
+        nem12_parser = Nem12Merger([StringIO(nem12_csv)], keep_lines=False)
+        parse.add(rows=_parsed_rows(nem12_parser))
 
-    nem12_parser = Nem12Merger(nem12_files)
     nmi_meter_registers = nem12_parser.nmi_meter_registers
+    accumulation_reads = nem12_parser.accumulation_reads
+
+    if nem12_parser.skipped_records:
+        logger.warning(
+            f"Skipped unknown records {dict(nem12_parser.skipped_records)}")
 
-    if len(nmi_meter_registers) > 0:
-        nmis = set([nmr.nmi for nmr in nmi_meter_registers])
+    if len(nmi_meter_registers) > 0 or len(accumulation_reads) > 0:
+        nmis = set([nmr.nmi for nmr in nmi_meter_registers] +
+                   [read.nmi for read in accumulation_reads])
         assert len(nmis) == 1, f"Expected only one NMI but found [{nmis}]"
 
         nmi = list(nmis)[0]
 
-        flattened = nem12_parser.flatten_data()
-        df_nem12 = pd.DataFrame(flattened)
+        _merge_changed_days(blob_store, nmi, nem12_parser, DAILY_INTERVAL_LENGTH,
+                            root_collection_name, logger, full_reload)
+
+        # Supported interval lengths divide each other, every register can be summed into the coarsest one
+        high_res_interval_length = max(
+            (nmr.interval_length for nmr in nmi_meter_registers), default=DAILY_INTERVAL_LENGTH)
+        finest_interval_length = min(
+            (nmr.interval_length for nmr in nmi_meter_registers), default=DAILY_INTERVAL_LENGTH)
+        if NEM12_HIGH_RES_DAILIES and finest_interval_length < high_res_interval_length:
+            logger.warning(
+                f"nmi={nmi} has registers of {finest_interval_length} to {high_res_interval_length} minute intervals, high resolution dailies are loaded at {high_res_interval_length} minutes")
+        if NEM12_HIGH_RES_DAILIES and high_res_interval_length < DAILY_INTERVAL_LENGTH:
+            _merge_changed_days(blob_store, nmi, nem12_parser, high_res_interval_length,
+                                root_collection_name, logger, full_reload)
+
+
+def _merge_changed_days(blob_store, nmi, nem12_parser, interval_length, root_collection_name, logger, full_reload):
+    """Loads days of nem12_parser at interval_length whose content hash changed since last written."""
+    suffix = '' if interval_length == DAILY_INTERVAL_LENGTH else f"_{interval_length}min"
+    with span(f"aggregate{suffix}") as aggregate:
+        df_agged_to_day = nem12_parser.flatten_to_frame(interval_length)
+        aggregate.add(rows=len(df_agged_to_day.index))
+
+    manifest_blob_name = f"{MANIFEST_STORAGE_PATH_PREFIX}/{root_collection_name}/nem12_{nmi}_days{suffix}.json"
+    day_hashes = day_content_hashes(df_agged_to_day)
+    written_day_hashes = {} if full_reload else read_json_blob(
+        blob_store, manifest_blob_name, {})
+    df_changed = select_changed_days(
+        df_agged_to_day, day_hashes, written_day_hashes)
+    logger.info(
+        f"nmi={nmi}, interval_length={interval_length}, days={len(df_agged_to_day.index)}, changed_days={len(df_changed.index)}")
+
+    if len(df_changed.index) > 0:
+        merge_df_to_db(nmi, df_changed, root_collection_name,
+                       logger, interval_length=interval_length)
+
+    written_day_hashes.update(day_hashes)
+    write_json_blob(blob_store, manifest_blob_name, written_day_hashes)
+
+
+def downsample_interval_values(values, interval_length, target_interval_length=DAILY_INTERVAL_LENGTH):
+    """
+    Sums (days x 1440 / interval_length) interval values into (days x 1440 / target_interval_length),
+    target_interval_length must be a multiple of interval_length.
+    """
+    if interval_length == target_interval_length:
+        return values
+
+    assert target_interval_length % interval_length == 0, f"Cannot downsample interval_length={interval_length} to {target_interval_length}"
+
+    return values.reshape(len(values), -1, target_interval_length // interval_length).sum(axis=2)
+
+
+# Quality flags (first character of a NEM12 QualityMethod) from least to most severe, a 30 minute interval
+# summed from finer intervals takes the most severe flag of them and its method
+QUALITY_SEVERITY = 'VANESF'
+QUALITY_RANKS = np.zeros(256, dtype=np.uint8)
+QUALITY_RANKS[[ord(flag) for flag in QUALITY_SEVERITY]] = np.arange(
+    1, len(QUALITY_SEVERITY) + 1)
+# Quality flag ASCII codes to strings, 0 is no quality
+QUALITY_STRINGS = np.array([''] + [chr(code) for code in range(1, 256)], dtype=object)
+
+
+@lru_cache(maxsize=256)
+def parse_quality_method(quality_method):
+    """QualityMethod such as 'A', 'E52' or 'S53' to (quality flag ASCII code, method number), 0 when blank."""
+    flag = ord(quality_method[0]) if quality_method else 0
+    method = int(quality_method[1:]) if quality_method[1:].isdigit() else 0
+
+    return flag, method
+
+
+@lru_cache(maxsize=1024)
+def _uniform_slots(code, interval_count):
+    # Days without 400 records share one immutable array per quality flag and method
+    return bytes((code,)) * interval_count
+
+
+def downsample_interval_qualities(qualities, methods, interval_length, target_interval_length=DAILY_INTERVAL_LENGTH):
+    """
+    (days x 1440 / interval_length) uint8 quality flags and methods into (days x 1440 / target_interval_length),
+    each target interval takes the most severe quality flag of its intervals, see QUALITY_SEVERITY.
+    """
+    if interval_length == target_interval_length:
+        return qualities, methods
+
+    factor = target_interval_length // interval_length
+    qualities = qualities.reshape(len(qualities), -1, factor)
+    methods = methods.reshape(len(methods), -1, factor)
+    most_severe = QUALITY_RANKS[qualities].argmax(axis=2)[..., np.newaxis]
+
+    return (np.take_along_axis(qualities, most_severe, axis=2)[..., 0],
+            np.take_along_axis(methods, most_severe, axis=2)[..., 0])
+
+
+def _register_day_arrays(nmr, interval_length=DAILY_INTERVAL_LENGTH):
+    """(values, quality flags, methods) of all interval days of nmr, each (days x 1440 / interval_length)."""
+    day_count = len(nmr.interval_days)
+    native_count = 1440 // nmr.interval_length
+    values = np.frombuffer(b''.join(iday.interval_values for iday in nmr.interval_days),
+                           dtype=np.float64).reshape(day_count, native_count)
+    qualities = np.frombuffer(b''.join(iday.interval_qualities for iday in nmr.interval_days),
+                              dtype=np.uint8).reshape(day_count, native_count)
+    methods = np.frombuffer(b''.join(iday.interval_methods for iday in nmr.interval_days),
+                            dtype=np.uint8).reshape(day_count, native_count)
+
+    return (downsample_interval_values(values, nmr.interval_length, interval_length),
+            *downsample_interval_qualities(qualities, methods, nmr.interval_length, interval_length))
+
+
+def spread_accumulation_read(read, interval_length=DAILY_INTERVAL_LENGTH):
+    """
+    Spreads the quantity of an accumulation (NEM13) read evenly over the intervals from the previous read
+    to the current read, read times are rounded down to the start of their interval.
+    Returns (interval dates, (days x 1440 / interval_length) interval values).
+    """
+    interval_count = 1440 // interval_length
+    first_date = datetime(read.previous_read_at.year,
+                          read.previous_read_at.month, read.previous_read_at.day)
+    start = int((read.previous_read_at - first_date).total_seconds()) // 60 // interval_length
+    end = int((read.current_read_at - first_date).total_seconds()) // 60 // interval_length
+    count = max(end - start, 1)
+    days = (start + count - 1) // interval_count + 1
+
+    values = np.zeros(days * interval_count)
+    values[start:start + count] = read.quantity / count
+
+    return [first_date + timedelta(days=day) for day in range(days)], values.reshape(days, interval_count)
+
+
+def _check_register(nmr):
+    assert nmr.uom == 'KWH', f"Current implementation only supports KWH but got uom={nmr.uom}"
+    assert nmr.interval_length in SUPPORTED_INTERVAL_LENGTHS, f"Current implementation only supports interval lengths of {SUPPORTED_INTERVAL_LENGTHS} minutes but got interval_length={nmr.interval_length}"
+
+
+@lru_cache(maxsize=8192)
+def _parse_interval_date(date_str):
+    # The same dates repeat for every register and every overlapping file, strptime is the slowest part of a 300 row
+    return datetime.strptime(date_str, '%Y%m%d')
+
+
+NEM_DATETIME_FORMATS = {8: '%Y%m%d', 12: '%Y%m%d%H%M', 14: '%Y%m%d%H%M%S'}
+
 
-        df_interval = df_nem12.groupby(['interval_date', 'interval']).agg(
-            consumption_kwh=pd.NamedAgg(column='consumption', aggfunc='sum'),
-            generation_kwh=pd.NamedAgg(column='generation', aggfunc='sum'),
-            quality=pd.NamedAgg(column='quality', aggfunc='first'),
-            interval_length=pd.NamedAgg(
-                column='interval_length', aggfunc='first'),
-            uom=pd.NamedAgg(column='uom', aggfunc='first'),
-        )
-        df_interval['generation_kwh'] = df_interval['generation_kwh'].abs()
-        df_agged_to_day = df_interval.groupby(['interval_date']).agg(
-            meter_consumptions_kwh=pd.NamedAgg(
-                column='consumption_kwh', aggfunc=list),
-            meter_generations_kwh=pd.NamedAgg(
-                column='generation_kwh', aggfunc=list),
-            meter_data_qualities=pd.NamedAgg(column='quality', aggfunc=list),
-        )
+def _parse_nem_datetime(value):
+    """NEM12/NEM13 Date(8) and DateTime(12)/DateTime(14) fields, None if blank."""
+    if not value:
+        return None
 
-        merge_df_to_db(nmi, df_agged_to_day, root_collection_name, logger)
+    return datetime.strptime(value, NEM_DATETIME_FORMATS[len(value)])
 
-    for tmp_n12_file in nem12_files:
-        os.remove(tmp_n12_file)
+
+def _parse_float(value):
+    return float(value) if value else None
+
+
+Nem12Header = namedtuple(
+    'Nem12Header', ['version', 'created_at', 'from_participant', 'to_participant'])
+
+# 500 record, the manual read the interval data of the day before it was produced from
+B2BDetails = namedtuple('B2BDetails', [
+                        'trans_code', 'ret_service_order', 'read_at', 'index_read', 'line_items'])
+
+# 550 record, the reads of the accumulation (250) record before it
+B2BAccumulationDetails = namedtuple('B2BAccumulationDetails', [
+    'previous_trans_code', 'previous_ret_service_order', 'current_trans_code', 'current_ret_service_order',
+    'line_items'])
+
+# Record indicator to the Nem12Merger method reading it, a reader returns the IntervalDay it completed if any
+RECORD_READERS = {
+    '100': '_read_header',
+    '200': '_read_nmi_data_details',
+    '300': '_read_interval_data',
+    '400': '_read_interval_event',
+    '500': '_read_b2b_details',
+    '250': '_read_basic_meter_data',
+    '550': '_read_b2b_accumulation_details',
+    '900': '_read_end_of_data',
+}
 
 
 class Nem12Merger():
-    """Naive implementation, only handles record 200, 300 and 400.
-    For record 400 (VariableDayQuality), only the whole CSV line is parsed.
-    All other record types are skipped.
+    """Reads NEM12 interval (200, 300, 400, 500) and NEM13 accumulation (250, 550) meter data files,
+    each row is dispatched on its record indicator through RECORD_READERS.
+    Unknown record types are counted in skipped_records, registers left out of flatten_to_frame() in skipped_registers.
     NEM12 file spec can be found here:
     https://www.aemo.com.au/consultations/current-and-closed-consultations/meter-data-file-format-specification-nem12-and-nem13/
+
+    Duplicate records across overlapping files are found through hashed indexes keyed by
+    (nmi, meter, register, register_config, interval_length) and (register, interval_date), so merging is linear in
+    the number of rows.  A register exported at another interval length, e.g. moving from 30 to 5 minute intervals,
+    is kept as a register of its own, each 300 record is read with the interval length of its 200 record.
+    Days already read at another interval length of the register are skipped with their 400 and 500 records.
+    When streaming=True nothing is parsed up front, use iter_interval_days() to stream the files instead.
+
+    Interval values are kept as array('d'), next to them the quality flag (ASCII code) and method of every interval
+    as bytes, from the 300 QualityMethod or for variable (V) days filled from the ranges of the 400 records.
+    The raw CSV rows (line_items) are only kept when keep_lines=True, which write_nem12() needs.
+    Without them a parsed day is about a quarter of the size.
     """
 
-    def __init__(self, nem12_files):
+    def __init__(self, nem12_files, streaming=False, keep_lines=True):
         self.nem12_files = nem12_files
+        self.keep_lines = keep_lines
+        self.headers = []
         self.nmi_meter_registers = []
+        self.accumulation_reads = []
+        self.skipped_records = Counter()
+        self.skipped_registers = Counter()
         self.current_nmr = None
         self.current_iday = None
-        self._parse()
+        self.current_read = None
+        self._current_nmr_siblings = []
+        self._pending_iday = None
+        self._nmr_index = {}
+        self._nmr_siblings = {}
+        self._read_index = {}
+        self._record_readers = {record_indicator: getattr(self, reader)
+                                for record_indicator, reader in RECORD_READERS.items()}
+        if not streaming:
+            self._parse()
 
     def _parse(self):
+        for _ in self.iter_interval_days():
+            pass
+
+    def iter_interval_days(self):
+        """
+        Streams rows of all NEM12 files and yields each new IntervalDay once it is complete,
+        i.e. once all of its 400 and 500 records have been read.  Interval days already seen in an
+        earlier file are merged into the existing IntervalDay and not yielded again.
+        """
+        record_readers = self._record_readers
+
         for nem12_file in self.nem12_files:
-            with open(nem12_file) as csv_file:
-                csv_reader = csv.reader(csv_file, delimiter=',')
-                for row in csv_reader:
-                    if row[0] == '200':
-                        nmi = row[1]
-                        register = row[3]
-                        meter = row[6]
-                        register_config = row[2]
-                        uom = row[7]
-                        interval_length = int(row[8])
-                        row_nmr = NmiMeterRegister(
-                            nmi, meter, register, register_config, uom, interval_length, row)
-                        existing_nmr = next(
-                            (nmr for nmr in self.nmi_meter_registers if nmr == row_nmr), None)
-                        if existing_nmr is None:
-                            existing_nmr = row_nmr
-                            self.nmi_meter_registers.append(existing_nmr)
-                        self.current_nmr = existing_nmr
-
-                    elif row[0] == '300':
-                        interval_count = 1440 / self.current_nmr.interval_length
-                        interval_date = datetime.strptime(
-                            row[1], '%Y%m%d')
-                        quality = row[int(interval_count + 2)]
-                        row_iday = IntervalDay(
-                            self.current_nmr, interval_date, quality, row)
-                        existing_iday = next(
-                            (iday for iday in self.current_nmr.interval_days if iday == row_iday), None)
-                        if existing_iday is None:
-                            existing_iday = row_iday
-                            existing_iday.interval_values = [
-                                float(iv) for iv in row[2:int(interval_count + 2)]]
-                            self.current_nmr.interval_days.append(
-                                existing_iday)
-                        self.current_iday = existing_iday
-
-                    elif row[0] == '400':
-                        row_var_quality = VariableDayQuality(
-                            self.current_iday, "".join(row), row)
-                        existing_var_quality = next(
-                            (vq for vq in self.current_iday.variable_qualities if vq == row_var_quality), None)
-                        if existing_var_quality is None:
-                            existing_var_quality = row_var_quality
-                            self.current_iday.variable_qualities.append(
-                                existing_var_quality)
-
-                    else:
-                        print(f"skipping record type {row[0]}")
+            with _open_nem12(nem12_file) as csv_file:
+                for row in csv.reader(csv_file, delimiter=','):
+                    reader = record_readers.get(row[0]) if row else None
+                    if reader is None:
+                        self.skipped_records[row[0] if row else ''] += 1
+                        continue
+
+                    completed_iday = reader(row)
+                    if completed_iday is not None:
+                        yield completed_iday
+
+        completed_iday = self._complete_pending_iday()
+        if completed_iday is not None:
+            yield completed_iday
+
+    def _complete_pending_iday(self):
+        completed_iday = self._pending_iday
+        self._pending_iday = None
+
+        return completed_iday
+
+    def _line_items(self, row):
+        return row if self.keep_lines else None
+
+    def _read_header(self, row):
+        self.headers.append(Nem12Header(
+            row[1], _parse_nem_datetime(row[2]), row[3], row[4]))
+
+        return self._complete_pending_iday()
+
+    def _read_nmi_data_details(self, row):
+        nmi = row[1]
+        register = row[3]
+        meter = row[6]
+        register_config = row[2]
+        uom = row[7]
+        interval_length = int(row[8])
+        nmr_key = (nmi, meter, register, register_config, interval_length)
+        existing_nmr = self._nmr_index.get(nmr_key)
+        if existing_nmr is None:
+            existing_nmr = NmiMeterRegister(
+                nmi, meter, register, register_config, uom, interval_length, self._line_items(row))
+            self._nmr_index[nmr_key] = existing_nmr
+            self._nmr_siblings.setdefault(nmr_key[:4], []).append(existing_nmr)
+            self.nmi_meter_registers.append(existing_nmr)
+        self.current_nmr = existing_nmr
+        # The same register at other interval lengths, almost always none
+        self._current_nmr_siblings = [nmr for nmr in self._nmr_siblings[nmr_key[:4]] if nmr is not existing_nmr]
+
+        return self._complete_pending_iday()
+
+    def _read_interval_data(self, row):
+        completed_iday = self._complete_pending_iday()
+
+        interval_count = 1440 // self.current_nmr.interval_length
+        interval_date = _parse_interval_date(row[1])
+        existing_iday = self.current_nmr.interval_day_index.get(interval_date)
+        if existing_iday is None and any(interval_date in nmr.interval_day_index for nmr in self._current_nmr_siblings):
+            # Read earlier at another interval length, that day wins and the 400 and 500 records of this one are skipped
+            self.current_iday = None
+            return completed_iday
+        if existing_iday is None:
+            quality = sys.intern(row[interval_count + 2])
+            interval_values = array('d', map(float, row[2:interval_count + 2]))
+            flag, method = parse_quality_method(quality)
+            existing_iday = IntervalDay(self.current_nmr, interval_date, quality, interval_values,
+                                        _uniform_slots(flag, interval_count), _uniform_slots(method, interval_count),
+                                        self._line_items(row))
+            self.current_nmr.add_interval_day(existing_iday)
+            self._pending_iday = existing_iday
+        self.current_iday = existing_iday
+
+        return completed_iday
+
+    def _read_interval_event(self, row):
+        if self.current_iday is None:
+            return
+
+        variable_quality = VariableDayQuality(self.current_iday, int(row[1]), int(row[2]), sys.intern(row[3]),
+                                              sys.intern(row[4]), self._line_items(row))
+        self.current_iday.add_variable_quality(variable_quality)
+        # Days merged from an earlier file keep the intervals qualities read with them
+        if self.current_iday is self._pending_iday:
+            self.current_iday.fill_interval_qualities(variable_quality)
+
+    def _read_b2b_details(self, row):
+        if self.current_iday is None:
+            return
+
+        self.current_iday.add_b2b_details(B2BDetails(
+            row[1], row[2], _parse_nem_datetime(row[3]), _parse_float(row[4]), self._line_items(row)))
+
+    def _read_basic_meter_data(self, row):
+        read = AccumulationRead(
+            nmi=row[1], register=row[3], nmi_suffix=row[4], meter=row[6], direction=row[7], uom=row[19],
+            previous_read_at=_parse_nem_datetime(row[9]), current_read_at=_parse_nem_datetime(row[14]),
+            quality=sys.intern(row[15]), quantity=float(row[18]), line_items=self._line_items(row))
+        existing_read = self._read_index.get(read.key)
+        if existing_read is None:
+            self._read_index[read.key] = read
+            self.accumulation_reads.append(read)
+            existing_read = read
+        self.current_read = existing_read
+
+        return self._complete_pending_iday()
+
+    def _read_b2b_accumulation_details(self, row):
+        if self.current_read.b2b_details is None:
+            self.current_read.b2b_details = B2BAccumulationDetails(
+                row[1], row[2], row[3], row[4], self._line_items(row))
+
+    def _read_end_of_data(self, row):
+        return self._complete_pending_iday()
+
+    def nmi_meter_registers_by_nmi(self):
+        """Groups nmi_meter_registers by NMI in one pass, keeping the order they were read in."""
+        grouped = {}
+        for nmr in self.nmi_meter_registers:
+            grouped.setdefault(nmr.nmi, []).append(nmr)
+
+        return grouped
+
+    def accumulation_reads_by_nmi(self):
+        """Groups accumulation_reads by NMI in one pass, keeping the order they were read in."""
+        grouped = {}
+        for read in self.accumulation_reads:
+            grouped.setdefault(read.nmi, []).append(read)
+
+        return grouped
 
     def flatten_data(self):
         """
         This implementation assumes the following:
-        * input and output interval_length = 30
+        * input interval_length is one of SUPPORTED_INTERVAL_LENGTHS, output interval_length = 30
         * input and output UOM is KWH
         * input registers starts with either E or B to represent consumption or generation respectively, all other streams (e.g. K, Q) result in 0.0 value
+        * only interval data (NEM12) is flattened, accumulation reads (NEM13) are left out
 
         Returns:
         * Flattenned representation of interval values with parent keys (e.g. nmi, meter, register, interval_date) associated.
@@ -203,22 +625,24 @@ class Nem12Merger():
         result = []
 
         for nmr in self.nmi_meter_registers:
-            uom = nmr.uom
-            interval_length = nmr.interval_length
-            assert uom == 'KWH', f"Current implementation only supports KWH but got uom={uom}"
-            assert interval_length == 30, f"Current implementation only supports interval length of 30 minutes but got interval_length={interval_length}"
+            _check_register(nmr)
+
+            if len(nmr.interval_days) == 0:
+                continue
+            register_values, register_qualities, _ = _register_day_arrays(nmr)
 
-            for iday in nmr.interval_days:
+            for iday, interval_values, interval_qualities in zip(nmr.interval_days, register_values.tolist(),
+                                                                 QUALITY_STRINGS[register_qualities].tolist()):
 
-                for i, value in enumerate(iday.interval_values):
+                for i, value in enumerate(interval_values):
 
                     result.append({
                         'nmi': nmr.nmi,
                         'meter': nmr.meter,
                         'register': nmr.register,
                         'interval_date': iday.interval_date,
-                        'quality': iday.quality,
-                        'interval_length': nmr.interval_length,
+                        'quality': interval_qualities[i],
+                        'interval_length': DAILY_INTERVAL_LENGTH,
                         'uom': nmr.uom,
                         'interval': i+1,
                         'consumption': value if nmr.register.startswith('E') else 0.0,
@@ -227,8 +651,102 @@ class Nem12Merger():
 
         return result
 
+    def flatten_to_frame(self, interval_length=DAILY_INTERVAL_LENGTH):
+        """
+        Same assumptions as flatten_data() but builds the day level frame loaded into Firestore directly,
+        i.e. what grouping flatten_data() by interval_date and interval produces.
+        Interval values of each register are copied into preallocated (days x 1440 / interval_length) float64 arrays,
+        summed down from finer interval lengths, consumption and generation registers are summed per interval
+        and generation made absolute.
+        A finer interval_length gives the high resolution frame, registers coarser than it cannot be represented
+        and are left out, counted by register key in skipped_registers and in the nem12.registers_skipped counter.
+        Accumulation reads (NEM13) with a previous read are spread evenly over their read period,
+        see spread_accumulation_read(), and added to consumption or generation by their DirectionIndicator,
+        E (export from the grid) or I (import to the grid).
+        The quality flag and method of each interval are those of the first register with data for it.
+
+        Returns:
+        * DataFrame indexed by interval_date with columns meter_consumptions_kwh, meter_generations_kwh,
+          meter_data_qualities (quality flags, e.g. 'A' or 'S') and meter_data_methods (0 if none),
+          each holding a list of 1440 / interval_length (48 by default) values per day.
+        """
+        assert interval_length in SUPPORTED_INTERVAL_LENGTHS, f"interval_length must be one of {SUPPORTED_INTERVAL_LENGTHS} but got {interval_length}"
+        interval_count = 1440 // interval_length
+
+        for nmr in self.nmi_meter_registers:
+            _check_register(nmr)
+        nmi_meter_registers = []
+        for nmr in self.nmi_meter_registers:
+            if interval_length % nmr.interval_length == 0:
+                nmi_meter_registers.append(nmr)
+            else:
+                self.skipped_registers[nmr.key] += 1
+                increment('nem12.registers_skipped')
+
+        spread_reads = []
+        for read in self.accumulation_reads:
+            assert read.uom == 'KWH', f"Current implementation only supports KWH but got uom={read.uom}"
+            assert read.direction in ('E', 'I'), f"Expected direction E or I but got direction={read.direction} for {read}"
+            if read.previous_read_at is not None:
+                spread_reads.append(
+                    (read, *spread_accumulation_read(read, interval_length)))
+
+        interval_dates = sorted({iday.interval_date for nmr in nmi_meter_registers
+                                 for iday in nmr.interval_days} |
+                                {read_date for _, read_dates, _ in spread_reads for read_date in read_dates})
+        date_rows = {interval_date: i for i,
+                     interval_date in enumerate(interval_dates)}
+
+        consumptions = np.zeros((len(interval_dates), interval_count))
+        generations = np.zeros((len(interval_dates), interval_count))
+        qualities = np.zeros((len(interval_dates), interval_count), dtype=np.uint8)
+        methods = np.zeros((len(interval_dates), interval_count), dtype=np.uint8)
+
+        for nmr in nmi_meter_registers:
+            if len(nmr.interval_days) == 0:
+                continue
+
+            rows = np.fromiter((date_rows[iday.interval_date] for iday in nmr.interval_days),
+                               dtype=np.intp, count=len(nmr.interval_days))
+            values, register_qualities, register_methods = _register_day_arrays(
+                nmr, interval_length)
+
+            if nmr.register.startswith('E'):
+                consumptions[rows] += values
+            elif nmr.register.startswith('B'):
+                generations[rows] += values
+
+            # Quality of the first register with data for the interval wins, same as aggfunc='first'
+            unset = qualities[rows] == 0
+            qualities[rows] = np.where(unset, register_qualities, qualities[rows])
+            methods[rows] = np.where(unset, register_methods, methods[rows])
+
+        for read, read_dates, values in spread_reads:
+            rows = np.array([date_rows[read_date] for read_date in read_dates], dtype=np.intp)
+            if read.direction == 'E':
+                consumptions[rows] += values
+            else:
+                generations[rows] += values
+
+            flag, method = parse_quality_method(read.quality)
+            unset = qualities[rows] == 0
+            qualities[rows] = np.where(unset, flag, qualities[rows])
+            methods[rows] = np.where(unset, method, methods[rows])
+
+        np.abs(generations, out=generations)
+
+        return pd.DataFrame({
+            'meter_consumptions_kwh': consumptions.tolist(),
+            'meter_generations_kwh': generations.tolist(),
+            'meter_data_qualities': QUALITY_STRINGS[qualities].tolist(),
+            'meter_data_methods': methods.tolist(),
+        }, index=pd.DatetimeIndex(interval_dates, name='interval_date'))
+
 
 class NmiMeterRegister():
+    __slots__ = ('nmi', 'meter', 'register', 'register_config', 'uom', 'interval_length',
+                 'interval_days', 'interval_day_index', 'line_items')
+
     def __init__(self, nmi, meter, register, register_config, uom, interval_length, line_items):
         self.nmi = nmi
         self.meter = meter
@@ -237,39 +755,85 @@ class NmiMeterRegister():
         self.uom = uom
         self.interval_length = interval_length
         self.interval_days = []
+        self.interval_day_index = {}
         self.line_items = line_items
 
+    @property
+    def key(self):
+        return (self.nmi, self.meter, self.register, self.register_config, self.interval_length)
+
+    def add_interval_day(self, interval_day):
+        self.interval_days.append(interval_day)
+        self.interval_day_index[interval_day.interval_date] = interval_day
+
     def __eq__(self, other):
         if not isinstance(other, NmiMeterRegister):
             return False
         else:
-            return self.nmi == other.nmi and self.meter == other.meter and self.register == other.register and self.register_config == other.register_config
+            return self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
 
     def __repr__(self):
-        return f"nmi={self.nmi},meter={self.meter},register={self.register},register_config={self.register_config},uom={self.uom},len(interval_days)={len(self.interval_days)}"
+        return f"nmi={self.nmi},meter={self.meter},register={self.register},register_config={self.register_config},uom={self.uom},interval_length={self.interval_length},len(interval_days)={len(self.interval_days)}"
 
     def __str__(self):
         return self.__repr__()
 
 
 class IntervalDay():
-    def __init__(self, nmi_meter_register, interval_date, quality, line_items):
+    __slots__ = ('nmi_meter_register', 'interval_date', 'quality', 'interval_values', 'interval_qualities',
+                 'interval_methods', 'variable_qualities', 'b2b_details', 'line_items')
+
+    def __init__(self, nmi_meter_register, interval_date, quality, interval_values, interval_qualities,
+                 interval_methods, line_items=None):
         self.nmi_meter_register = nmi_meter_register
         self.interval_date = interval_date
         self.quality = quality
-        self.interval_values = []
+        self.interval_values = interval_values
+        self.interval_qualities = interval_qualities
+        self.interval_methods = interval_methods
         self.variable_qualities = []
+        self.b2b_details = None
         self.line_items = line_items
 
     def get_interval_length(self):
         return self.nmi_meter_register.interval_length
 
+    def add_variable_quality(self, variable_quality):
+        # A day has a handful of 400 records at most, a scan is cheaper than a set per day
+        if all(var_q.key != variable_quality.key for var_q in self.variable_qualities):
+            self.variable_qualities.append(variable_quality)
+
+    def fill_interval_qualities(self, variable_quality):
+        """Sets the quality flag and method of the (1 based, inclusive) interval range of a 400 record."""
+        flag, method = parse_quality_method(variable_quality.quality_method)
+        start = variable_quality.start_interval - 1
+        end = variable_quality.end_interval
+        qualities = bytearray(self.interval_qualities)
+        methods = bytearray(self.interval_methods)
+        qualities[start:end] = _uniform_slots(flag, end - start)
+        methods[start:end] = _uniform_slots(method, end - start)
+        self.interval_qualities = bytes(qualities)
+        self.interval_methods = bytes(methods)
+
+    def add_b2b_details(self, b2b_details):
+        # Only allocated for the few days with a manual read
+        if self.b2b_details is None:
+            self.b2b_details = []
+        if all(existing[:4] != b2b_details[:4] for existing in self.b2b_details):
+            self.b2b_details.append(b2b_details)
+
     def __eq__(self, other):
         if not isinstance(other, IntervalDay):
             return False
         else:
             return self.nmi_meter_register == other.nmi_meter_register and self.interval_date == other.interval_date
 
+    def __hash__(self):
+        return hash((self.nmi_meter_register, self.interval_date))
+
     def __repr__(self):
         return f"nmi_meter_register={self.nmi_meter_register},interval_date={self.interval_date},len(interval_values)={len(self.interval_values)},len(variable_qualities)={len(self.variable_qualities)}"
 
@@ -278,19 +842,74 @@ class IntervalDay():
 
 
 class VariableDayQuality():
-    def __init__(self, interval_day, line_str, line_items):
+    """Interval event (400) record, the quality of the intervals start_interval to end_interval (1 based, inclusive)."""
+
+    __slots__ = ('interval_day', 'start_interval', 'end_interval', 'quality_method', 'reason_code', 'line_items')
+
+    def __init__(self, interval_day, start_interval, end_interval, quality_method, reason_code, line_items=None):
         self.interval_day = interval_day
-        self.line_str = line_str
+        self.start_interval = start_interval
+        self.end_interval = end_interval
+        self.quality_method = quality_method
+        self.reason_code = reason_code
         self.line_items = line_items
 
+    @property
+    def key(self):
+        return (self.start_interval, self.end_interval, self.quality_method, self.reason_code)
+
     def __eq__(self, other):
         if not isinstance(other, VariableDayQuality):
             return False
         else:
-            return self.interval_day == other.interval_day and self.line_str == other.line_str
+            return self.interval_day == other.interval_day and self.key == other.key
+
+    def __hash__(self):
+        return hash((self.interval_day, self.key))
+
+    def __repr__(self):
+        return f"interval_day={self.interval_day},start_interval={self.start_interval},end_interval={self.end_interval},quality_method={self.quality_method},reason_code={self.reason_code}"
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class AccumulationRead():
+    """NEM13 basic meter data (250) record, the quantity accumulated between two register reads."""
+
+    __slots__ = ('nmi', 'register', 'nmi_suffix', 'meter', 'direction', 'uom', 'previous_read_at',
+                 'current_read_at', 'quality', 'quantity', 'b2b_details', 'line_items')
+
+    def __init__(self, nmi, register, nmi_suffix, meter, direction, uom, previous_read_at, current_read_at,
+                 quality, quantity, line_items=None):
+        self.nmi = nmi
+        self.register = register
+        self.nmi_suffix = nmi_suffix
+        self.meter = meter
+        self.direction = direction
+        self.uom = uom
+        self.previous_read_at = previous_read_at
+        self.current_read_at = current_read_at
+        self.quality = quality
+        self.quantity = quantity
+        self.b2b_details = None
+        self.line_items = line_items
+
+    @property
+    def key(self):
+        return (self.nmi, self.meter, self.register, self.nmi_suffix, self.current_read_at)
+
+    def __eq__(self, other):
+        if not isinstance(other, AccumulationRead):
+            return False
+        else:
+            return self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
 
     def __repr__(self):
-        return f"interval_day={self.interval_day},line_str={self.line_str}"
+        return f"nmi={self.nmi},meter={self.meter},register={self.register},nmi_suffix={self.nmi_suffix},previous_read_at={self.previous_read_at},current_read_at={self.current_read_at},quantity={self.quantity}"
 
     def __str__(self):
         return self.__repr__()
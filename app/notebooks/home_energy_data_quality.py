@@ -29,32 +29,36 @@ NMI = os.environ.get(
 
 STORAGE_CLIENT = storage.Client()
 bucket = STORAGE_CLIENT.get_bucket(GCP_STORAGE_BUCKET_ID)
-pkl_file_name = f"dailies_{NMI}.pkl"
-blob = storage.Blob(pkl_file_name, bucket)
-pkl_file_path = f"/tmp/{pkl_file_name}"
-
-with open(pkl_file_path, 'wb') as pkl_file:
-    STORAGE_CLIENT.download_blob_to_file(blob, pkl_file)
-
-df = pd.read_pickle(pkl_file_path)
-os.remove(pkl_file_path)
+npz_file_name = f"dailies_{NMI}.npz"
+blob = storage.Blob(npz_file_name, bucket)
+npz_file_path = f"/tmp/{npz_file_name}"
+
+with open(npz_file_path, 'wb') as npz_file:
+    STORAGE_CLIENT.download_blob_to_file(blob, npz_file)
+
+# Columns of a .npz are only read when accessed
+dailies = np.load(npz_file_path)
+df = pd.DataFrame({
+    'min_temperature_c': dailies['min_temperature_c'],
+    'max_temperature_c': dailies['max_temperature_c'],
+}, index=pd.DatetimeIndex(dailies['interval_date'], name='interval_date'))
 # %%
-meter_cons = np.array(df['meter_consumptions_kwh'].values.tolist())
-meter_gens = np.array(df['meter_generations_kwh'].values.tolist())
-solar_gens = np.array(df['solar_generations_kwh'].values.tolist())
-solar_powrs = np.array(df['solar_mean_powrs_kw'].values.tolist())
-solar_devices = np.array(df['solar_devices_reportings'].values.tolist())
-capacities = np.array(df['capacities_kw'].values.tolist())
-charge_quantities = np.array(df['charge_quantities_kwh'].values.tolist())
-deterioration_states = np.array(df['deterioration_states_pct'].values.tolist())
-discharge_quantities = np.array(df['discharge_quantities_kwh'].values.tolist())
-power_at_charges = np.array(df['power_at_charges_kw'].values.tolist())
-residual_capacities = np.array(df['residual_capacities_pct'].values.tolist())
-total_charge_quantities = np.array(
-    df['total_charge_quantities_kwh'].values.tolist())
-total_discharge_quantities = np.array(
-    df['total_discharge_quantities_kwh'].values.tolist())
+meter_cons = dailies['meter_consumptions_kwh']
+meter_gens = dailies['meter_generations_kwh']
+solar_gens = dailies['solar_generations_kwh']
+solar_powrs = dailies['solar_mean_powrs_kw']
+solar_devices = dailies['solar_devices_reportings']
+capacities = dailies['capacities_kw']
+charge_quantities = dailies['charge_quantities_kwh']
+deterioration_states = dailies['deterioration_states_pct']
+discharge_quantities = dailies['discharge_quantities_kwh']
+power_at_charges = dailies['power_at_charges_kw']
+residual_capacities = dailies['residual_capacities_pct']
+total_charge_quantities = dailies['total_charge_quantities_kwh']
+total_discharge_quantities = dailies['total_discharge_quantities_kwh']
 interval_dates = np.repeat(df.index.tolist(), meter_cons.shape[1])
+dailies.close()
+os.remove(npz_file_path)
 
 numeric_columns = ('meter_consumption_kwh', 'meter_generation_kwh',
                    'solar_generation_kwh', 'solar_mean_powr_kw', 'solar_devices_reporting',
@@ -0,0 +1,192 @@
+import logging
+import threading
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+from app import (ENLIGHTEN_STORAGE_PATH_PREFIX, LEMS_STORAGE_PATH_PREFIX, NMI,
+                 NEM12_STORAGE_PATH_IN, NEM12_STORAGE_PATH_MERGED)
+from app.backends import (GcsBlobStore, LocalBlobStore, MemoryDailiesStore,
+                          SqliteDailiesStore, configure_backends)
+from app.functions.on_storage_blob import dispatch_blob
+
+
+@pytest.fixture
+def local_backends(tmp_path, monkeypatch):
+    monkeypatch.setattr('app.nem12.NEM12_MERGE_WINDOW_SECONDS', 0)
+    blob_store = LocalBlobStore(tmp_path / 'blobs')
+    dailies_store = MemoryDailiesStore()
+    configure_backends(blob_store, dailies_store)
+    yield blob_store, dailies_store
+    configure_backends()
+
+
+class FakeGcsBucket():
+    """
+    The google.cloud.storage Bucket calls GcsBlobStore makes, in memory, with generation preconditions checked
+    and applied atomically as Cloud Storage does.
+    """
+
+    def __init__(self):
+        self.blobs = {}
+        self.generation = 0
+        self.upload_preconditions = []
+        self.lock = threading.Lock()
+
+    def blob(self, name):
+        return FakeGcsBlob(self, name)
+
+    def get_blob(self, name):
+        with self.lock:
+            if name not in self.blobs:
+                return None
+            blob = FakeGcsBlob(self, name)
+            blob.data, blob.generation = self.blobs[name]
+
+        return blob
+
+    def delete_blob(self, name, if_generation_match=None):
+        from google.api_core.exceptions import NotFound, PreconditionFailed
+
+        with self.lock:
+            if name not in self.blobs:
+                raise NotFound(name)
+            if if_generation_match is not None and self.blobs[name][1] != if_generation_match:
+                raise PreconditionFailed(name)
+            del self.blobs[name]
+
+    def list_blobs(self, prefix):
+        with self.lock:
+            names = sorted(name for name in self.blobs if name.startswith(prefix))
+
+        return [self.get_blob(name) for name in names]
+
+
+class FakeGcsBlob():
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.data = None
+        self.generation = None
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    def download_as_string(self):
+        return self.data
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        from google.api_core.exceptions import PreconditionFailed
+
+        with self.bucket.lock:
+            self.bucket.upload_preconditions.append(if_generation_match)
+            current = self.bucket.blobs.get(self.name)
+            if if_generation_match is not None and (current[1] if current else 0) != if_generation_match:
+                raise PreconditionFailed(self.name)
+            self.bucket.generation += 1
+            self.bucket.blobs[self.name] = (data.encode('utf-8') if isinstance(data, str) else data,
+                                            self.bucket.generation)
+
+
+def _copy_fixtures(blob_store, fixtures_glob, prefix):
+    for path in sorted(Path('fixtures').glob(fixtures_glob)):
+        blob_name = f"{prefix}/{path.parent.name}/{path.name}" if path.parent.name.isdigit(
+        ) else f"{prefix}/{path.name}"
+        blob_store.put(blob_name, path.read_bytes())
+
+
+def test_local_blob_store(tmp_path):
+    # given
+    blob_store = LocalBlobStore(tmp_path)
+
+    # when
+    blob_store.put('lems/2020/b.csv', 'b')
+    blob_store.put('lems/2019/a.csv', b'a')
+    blob_store.put('enlighten/2019/c.json', '{}')
+
+    # then
+    assert blob_store.get('lems/2019/a.csv') == b'a'
+    assert blob_store.get('lems/2019/missing.csv') is None
+    assert [b.name for b in blob_store.list('lems')] == [
+        'lems/2019/a.csv', 'lems/2020/b.csv']
+    assert blob_store.stat('lems/2020/b.csv').size == 1
+    assert not blob_store.exists('lems/2019/missing.csv')
+
+
+def test_gcs_blob_store_create_is_conditional():
+    # given
+    bucket = FakeGcsBucket()
+    blob_store = GcsBlobStore(bucket)
+
+    # when
+    created = blob_store.create('manifests/events/a', 'first')
+    created_again = blob_store.create('manifests/events/a', 'second')
+
+    # then
+    assert bucket.upload_preconditions == [0, 0]
+    assert created
+    # the PreconditionFailed of the second upload is the blob already existing
+    assert not created_again
+    assert blob_store.get('manifests/events/a') == b'first'
+
+
+@pytest.mark.parametrize('store_type', ['memory', 'sqlite'])
+def test_dailies_store_merges_fields(store_type, tmp_path):
+    # given
+    if store_type == 'memory':
+        dailies_store = MemoryDailiesStore()
+    else:
+        dailies_store = SqliteDailiesStore(str(tmp_path / 'dailies.sqlite3'))
+
+    # when
+    dailies_store.upsert_site('test_sites', '6408091979', {'nmi': '6408091979'})
+    dailies_store.upsert_dailies('test_sites', '6408091979', {
+        '20200102': {'interval_date': datetime(2020, 1, 2), 'meter_consumptions_kwh': [0.1] * 48},
+        '20200101': {'interval_date': datetime(2020, 1, 1), 'meter_consumptions_kwh': [0.2] * 48},
+    })
+    dailies_store.upsert_dailies('test_sites', '6408091979', {
+        '20200101': {'interval_date': datetime(2020, 1, 1), 'solar_generations_kwh': [0.3] * 48},
+    })
+    dailies_store.upsert_dailies('test_sites', '6408091979', {
+        '20200101': {'interval_date': datetime(2020, 1, 1), 'meter_consumptions_kwh': [0.05] * 288},
+    }, collection_name='dailies_5min')
+
+    # then
+    dailies = list(dailies_store.stream_dailies('test_sites', '6408091979'))
+    assert [day_id for day_id, _ in dailies] == ['20200101', '20200102']
+    assert dailies[0][1]['meter_consumptions_kwh'] == [0.2] * 48
+    assert dailies[0][1]['solar_generations_kwh'] == [0.3] * 48
+    assert list(dailies_store.stream_dailies('sites', '6408091979')) == []
+    assert [doc['meter_consumptions_kwh'] for _, doc in dailies_store.stream_dailies(
+        'test_sites', '6408091979', collection_name='dailies_5min')] == [[0.05] * 288]
+
+
+def test_ingest_fixtures_offline(local_backends):
+    # given
+    blob_store, dailies_store = local_backends
+    logger = logging.getLogger()
+    _copy_fixtures(blob_store, 'nem12/in/*.csv', NEM12_STORAGE_PATH_IN)
+    _copy_fixtures(blob_store, 'enlighten/2019/enlighten_stats_2019040*.json',
+                   ENLIGHTEN_STORAGE_PATH_PREFIX)
+    _copy_fixtures(blob_store, 'lems/2019/lems_data_2019040*.csv',
+                   LEMS_STORAGE_PATH_PREFIX)
+
+    # when
+    for prefix in (NEM12_STORAGE_PATH_IN, NEM12_STORAGE_PATH_MERGED, ENLIGHTEN_STORAGE_PATH_PREFIX, LEMS_STORAGE_PATH_PREFIX):
+        for blob in blob_store.list(prefix):
+            assert dispatch_blob(None, None, None, blob_store,
+                                 blob.name, 'test_sites', logger)
+
+    # then
+    meter_dailies = dict(
+        dailies_store.stream_dailies('test_sites', '6408091979'))
+    assert len(meter_dailies) == 731
+    assert len(meter_dailies['20190406']['meter_consumptions_kwh']) == 48
+    assert len(dict(dailies_store.stream_dailies(
+        'test_sites', '6123456789'))) == 52
+
+    site_dailies = dict(dailies_store.stream_dailies('test_sites', NMI))
+    assert len(site_dailies['20190407']['solar_generations_kwh']) == 48
+    assert len(site_dailies['20190405']['capacities_kw']) == 48
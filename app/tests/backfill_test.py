@@ -0,0 +1,208 @@
+import asyncio
+import json
+import logging
+import threading
+from datetime import datetime
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from app import ENLIGHTEN_STORAGE_PATH_PREFIX
+from app.backends import LocalBlobStore
+from app.backfill import (ENLIGHTEN_BACKFILL_CURSOR_BLOB_NAME, TokenBucket,
+                          backfill_enlighten)
+from app.common import (LOCAL_TZ, get_already_fetched, read_json_blob,
+                        save_already_fetched)
+from app.enlighten import (ALREADY_FETCHED_SIZE_THRESHOLD_BYTES,
+                           enlighten_blob_name, get_enlighten_stats_resp)
+
+
+class StubEnlightenServer(ThreadingHTTPServer):
+    """Serves /api/v2/systems/{system_id}/stats, failing days in failing_dates."""
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubEnlightenHandler)
+        self.failing_dates = set()
+        self.requested_dates = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class StubEnlightenHandler(BaseHTTPRequestHandler):
+    def do_GET(self):  # pylint: disable=invalid-name
+        query = parse_qs(urlparse(self.path).query)
+        as_of_date = datetime.fromtimestamp(
+            int(query['start_at'][0]), LOCAL_TZ).strftime('%Y%m%d')
+        with self.server.lock:
+            self.server.requested_dates.append(as_of_date)
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(
+                self.server.max_in_flight, self.server.in_flight)
+
+        # Slow enough for requests to overlap
+        threading.Event().wait(0.05)
+
+        if as_of_date in self.server.failing_dates:
+            status_code, body = 500, {'reason': 'Internal Server Error'}
+        else:
+            status_code, body = 200, {'system_id': 597188, 'intervals': [
+                {'end_at': 0, 'devices_reporting': 1, 'powr': 0, 'enwh': 0}] * 30}
+
+        with self.server.lock:
+            self.server.in_flight -= 1
+
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+@pytest.fixture
+def stub_enlighten_server():
+    server = StubEnlightenServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_token_bucket_spaces_calls():
+    # given
+    now = [0.0]
+
+    async def fake_sleep(seconds):
+        now[0] += seconds
+
+    token_bucket = TokenBucket(
+        10, period=60.0, clock=lambda: now[0], sleep=fake_sleep)
+
+    # when
+    acquired_at = []
+
+    async def acquire_all():
+        for _ in range(4):
+            await token_bucket.acquire()
+            acquired_at.append(now[0])
+
+    asyncio.run(acquire_all())
+
+    # then
+    assert acquired_at == pytest.approx([0.0, 6.0, 12.0, 18.0])
+
+
+def test_backfill_enlighten_resumes_from_cursor(stub_enlighten_server, tmp_path):
+    # given
+    blob_store = LocalBlobStore(tmp_path)
+    logger = logging.getLogger()
+    fetch_day = partial(get_enlighten_stats_resp, 'key', 'user', '597188',
+                        enlighten_url=stub_enlighten_server.url)
+    stub_enlighten_server.failing_dates.add('20200104')
+
+    def run_backfill():
+        return asyncio.run(backfill_enlighten(
+            blob_store, fetch_day, datetime(2020, 1, 1), datetime(2020, 1, 8), logger,
+            token_bucket=TokenBucket(1000, period=1.0, capacity=4), concurrency=4))
+
+    # when
+    first_fetched = run_backfill()
+    first_cursor = read_json_blob(
+        blob_store, ENLIGHTEN_BACKFILL_CURSOR_BLOB_NAME)
+    stub_enlighten_server.failing_dates.clear()
+    stub_enlighten_server.requested_dates.clear()
+    second_fetched = run_backfill()
+
+    # then
+    assert first_fetched == 7
+    assert first_cursor == {'start_date': '2020-01-01T00:00:00', 'end_date': '2020-01-08T00:00:00',
+                            'next_date': '2020-01-04T00:00:00'}
+    assert stub_enlighten_server.max_in_flight > 1
+    assert second_fetched == 1
+    assert stub_enlighten_server.requested_dates == ['20200104']
+    assert read_json_blob(blob_store, ENLIGHTEN_BACKFILL_CURSOR_BLOB_NAME)[
+        'next_date'] == '2020-01-09T00:00:00'
+    assert blob_store.exists(enlighten_blob_name(datetime(2020, 1, 4)))
+
+
+def test_backfill_enlighten_saves_already_fetched(stub_enlighten_server, tmp_path):
+    # given
+    blob_store = LocalBlobStore(tmp_path)
+    fetch_day = partial(get_enlighten_stats_resp, 'key', 'user', '597188',
+                        enlighten_url=stub_enlighten_server.url)
+    stub_enlighten_server.failing_dates.add('20200103')
+
+    # when
+    asyncio.run(backfill_enlighten(
+        blob_store, fetch_day, datetime(2020, 1, 1), datetime(2020, 1, 4), logging.getLogger(),
+        token_bucket=TokenBucket(1000, period=1.0, capacity=4), concurrency=2))
+    # the prefix is not listed again when the index was saved
+    blob_store.put(enlighten_blob_name(datetime(2020, 1, 3)), b'x' * 2048)
+    already_fetched = get_already_fetched(
+        None, blob_store, ENLIGHTEN_STORAGE_PATH_PREFIX, ALREADY_FETCHED_SIZE_THRESHOLD_BYTES, use_manifest=True)
+
+    # then
+    assert [already_fetched.has_date(datetime(2020, 1, day)) for day in range(1, 5)] == [
+        True, True, False, True]
+
+
+def test_backfill_enlighten_earlier_range(stub_enlighten_server, tmp_path):
+    # given
+    blob_store = LocalBlobStore(tmp_path)
+    fetch_day = partial(get_enlighten_stats_resp, 'key', 'user', '597188',
+                        enlighten_url=stub_enlighten_server.url)
+
+    def run_backfill(start_date, end_date):
+        return asyncio.run(backfill_enlighten(
+            blob_store, fetch_day, start_date, end_date, logging.getLogger(),
+            token_bucket=TokenBucket(1000, period=1.0, capacity=4), concurrency=4))
+
+    # when
+    later_fetched = run_backfill(datetime(2020, 1, 5), datetime(2020, 1, 8))
+    stub_enlighten_server.requested_dates.clear()
+    earlier_fetched = run_backfill(datetime(2020, 1, 1), datetime(2020, 1, 6))
+
+    # then
+    assert later_fetched == 4
+    assert earlier_fetched == 4
+    assert sorted(stub_enlighten_server.requested_dates) == [
+        '20200101', '20200102', '20200103', '20200104']
+
+
+def test_backfill_enlighten_saves_progress_on_error(stub_enlighten_server, tmp_path):
+    # given
+    blob_store = LocalBlobStore(tmp_path)
+    stub_enlighten_server.failing_dates.add('20200101')
+    # a saved index is reused as is, the days it misses are not listed
+    save_already_fetched(blob_store, ENLIGHTEN_STORAGE_PATH_PREFIX, get_already_fetched(
+        None, blob_store, ENLIGHTEN_STORAGE_PATH_PREFIX, ALREADY_FETCHED_SIZE_THRESHOLD_BYTES, use_manifest=True))
+
+    def fetch_day(as_of_date):
+        if as_of_date == datetime(2020, 1, 3):
+            raise ValueError('unexpected response')
+        return get_enlighten_stats_resp('key', 'user', '597188', as_of_date,
+                                        enlighten_url=stub_enlighten_server.url)
+
+    # when
+    with pytest.raises(ValueError):
+        asyncio.run(backfill_enlighten(
+            blob_store, fetch_day, datetime(2020, 1, 1), datetime(2020, 1, 4), logging.getLogger(),
+            token_bucket=TokenBucket(1000, period=1.0, capacity=4), concurrency=1))
+    already_fetched = get_already_fetched(
+        None, blob_store, ENLIGHTEN_STORAGE_PATH_PREFIX, ALREADY_FETCHED_SIZE_THRESHOLD_BYTES, use_manifest=True)
+
+    # then
+    assert [already_fetched.has_date(datetime(2020, 1, day)) for day in range(1, 5)] == [
+        False, True, False, False]
+    assert read_json_blob(blob_store, ENLIGHTEN_BACKFILL_CURSOR_BLOB_NAME, {}).get('next_date') is None
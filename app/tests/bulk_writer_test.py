@@ -0,0 +1,129 @@
+import logging
+
+import pandas as pd
+import pytest
+from google.api_core.exceptions import ServiceUnavailable
+
+import app
+from app.bulk_writer import BulkWriter
+from app.common import merge_df_to_db
+
+
+class FakeFirestore():
+    """In-memory stand in for firestore.Client, documents are kept in a dict keyed by path."""
+
+    def __init__(self, failures=0):
+        self.documents = {}
+        self.commits = []
+        self.failures = failures
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+
+class FakeCollection():
+    def __init__(self, fdb, path):
+        self.fdb = fdb
+        self.path = path
+
+    def document(self, doc_id):
+        return FakeDocument(self.fdb, f"{self.path}/{doc_id}")
+
+
+class FakeDocument():
+    def __init__(self, fdb, path):
+        self.fdb = fdb
+        self.path = path
+
+    def collection(self, name):
+        return FakeCollection(self.fdb, f"{self.path}/{name}")
+
+    def set(self, doc_data, merge=False):
+        existing = self.fdb.documents.get(self.path, {}) if merge else {}
+        self.fdb.documents[self.path] = {**existing, **doc_data}
+
+
+class FakeBatch():
+    def __init__(self, fdb):
+        self.fdb = fdb
+        self.writes = []
+
+    def set(self, doc_ref, doc_data, merge=False):
+        self.writes.append((doc_ref, doc_data, merge))
+
+    def commit(self):
+        assert len(self.writes) <= 500
+        if self.fdb.failures > 0:
+            self.fdb.failures -= 1
+            raise ServiceUnavailable('fake outage')
+        for doc_ref, doc_data, merge in self.writes:
+            doc_ref.set(doc_data, merge=merge)
+        self.fdb.commits.append(len(self.writes))
+
+
+def test_flush_in_chunks():
+    # given
+    fdb = FakeFirestore()
+    writer = BulkWriter(fdb, logging.getLogger())
+    for i in range(1201):
+        writer.set(fdb.collection('dailies').document(str(i)), {'i': i})
+
+    # when
+    stats = writer.flush()
+
+    # then
+    assert sorted(fdb.commits) == [201, 500, 500]
+    assert stats['documents'] == 1201
+    assert stats['chunks'] == 3
+    assert len(fdb.documents) == 1201
+
+
+def test_flush_retries_failed_chunks():
+    # given
+    fdb = FakeFirestore(failures=2)
+    delays = []
+    writer = BulkWriter(fdb, logging.getLogger(), max_workers=1,
+                        backoff_seconds=0.1, sleep=delays.append)
+    for i in range(10):
+        writer.set(fdb.collection('dailies').document(str(i)), {'i': i})
+
+    # when
+    stats = writer.flush()
+
+    # then
+    assert stats['documents'] == 10
+    assert delays == [0.1, 0.2]
+
+
+def test_flush_gives_up_after_max_attempts():
+    # given
+    fdb = FakeFirestore(failures=3)
+    writer = BulkWriter(fdb, logging.getLogger(),
+                        max_attempts=3, sleep=lambda _: None)
+    writer.set(fdb.collection('dailies').document('1'), {'i': 1})
+
+    # then
+    with pytest.raises(ServiceUnavailable):
+        writer.flush()
+
+
+def test_merge_df_to_db(monkeypatch):
+    # setup
+    fdb = FakeFirestore()
+    monkeypatch.setattr(app, 'FIRESTORE_CLIENT', fdb)
+
+    # given
+    interval_dates = pd.date_range(
+        '2019-01-01', '2020-12-31', name='interval_date')
+    dfm = pd.DataFrame({'meter_consumptions_kwh': [[0.1] * 48] * len(interval_dates)},
+                       index=interval_dates)
+
+    # when
+    merge_df_to_db('6408091979', dfm, 'test_sites', logging.getLogger())
+
+    # then
+    assert sorted(fdb.commits) == [231, 500]
+    assert fdb.documents['test_sites/6408091979/dailies/20200229']['meter_consumptions_kwh'] == [0.1] * 48
@@ -1,6 +1,11 @@
 from datetime import datetime
 
-from app.common import idate_range
+import pandas as pd
+
+from app.backends import LocalBlobStore
+from app.common import (AlreadyFetched, day_content_hashes,
+                        get_already_fetched, idate_range,
+                        save_already_fetched, select_changed_days)
 
 
 def test_idate_range():
@@ -13,3 +18,70 @@ def test_idate_range():
         datetime.fromisoformat('2020-01-02T00:00:00'),
         datetime.fromisoformat('2020-01-03T00:00:00'),
     ]
+
+
+def test_select_changed_days():
+    # given
+    interval_dates = pd.DatetimeIndex(
+        ['2019-12-31', '2020-01-01', '2020-01-02'], name='interval_date')
+    df_written = pd.DataFrame(
+        {'meter_consumptions_kwh': [[0.1] * 48, [0.2] * 48, [0.3] * 48]}, index=interval_dates)
+    written_day_hashes = day_content_hashes(df_written)
+    df_new = pd.DataFrame(
+        {'meter_consumptions_kwh': [[0.1] * 48, [0.25] * 48, [0.3] * 48, [0.4] * 48]},
+        index=interval_dates.append(pd.DatetimeIndex(['2020-01-03'], name='interval_date')))
+
+    # when
+    df_changed = select_changed_days(
+        df_new, day_content_hashes(df_new), written_day_hashes)
+
+    # then
+    assert list(written_day_hashes.keys()) == [
+        '20191231', '20200101', '20200102']
+    assert df_changed.index.strftime('%Y%m%d').tolist() == [
+        '20200101', '20200103']
+    assert select_changed_days(
+        df_written, written_day_hashes, written_day_hashes).empty
+
+
+def test_get_already_fetched(tmp_path):
+    # given
+    blob_store = LocalBlobStore(tmp_path)
+    blob_store.put('lems/2019/lems_data_20191231.csv', 'x' * 2048)
+    blob_store.put('lems/2020/lems_data_20200101.csv', 'x' * 2048)
+    blob_store.put('lems/2020/lems_data_20200102.csv', '{"error": "API error"}')
+
+    # when
+    already_fetched = get_already_fetched(None, blob_store, 'lems', 1024)
+
+    # then
+    assert list(already_fetched) == [
+        'lems/2019/lems_data_20191231.csv', 'lems/2020/lems_data_20200101.csv']
+    assert 'lems/2020/lems_data_20200101.csv' in already_fetched
+    assert [already_fetched.has_date(d) for d in idate_range(datetime(2019, 12, 30), datetime(2020, 1, 2))] == [
+        False, True, True, False]
+
+
+def test_get_already_fetched_from_manifest(tmp_path):
+    # given
+    blob_store = LocalBlobStore(tmp_path)
+    blob_store.put('lems/2020/lems_data_20200101.csv', 'x' * 2048)
+    already_fetched = get_already_fetched(
+        None, blob_store, 'lems', 1024, use_manifest=True)
+    already_fetched.add('lems/2020/lems_data_20200103.csv', 2048)
+    already_fetched.add('lems/2020/lems_data_20200104.csv', 20)
+    save_already_fetched(blob_store, 'lems', already_fetched)
+
+    # when
+    blob_store.put('lems/2020/lems_data_20200102.csv', 'x' * 2048)
+    cached = get_already_fetched(
+        None, blob_store, 'lems', 1024, use_manifest=True)
+    listed = get_already_fetched(None, blob_store, 'lems', 1024)
+
+    # then
+    assert isinstance(cached, AlreadyFetched)
+    assert list(cached) == [
+        'lems/2020/lems_data_20200101.csv', 'lems/2020/lems_data_20200103.csv']
+    assert [cached.has_date(d) for d in idate_range(datetime(2020, 1, 1), datetime(2020, 1, 4))] == [
+        True, False, True, False]
+    assert listed.has_date(datetime(2020, 1, 2))
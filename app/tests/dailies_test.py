@@ -0,0 +1,84 @@
+import logging
+from datetime import datetime, timezone
+from io import BytesIO
+
+import numpy as np
+
+from app.backends import LocalBlobStore, MemoryDailiesStore
+from app.dailies import (INTERVAL_COLUMNS, dailies_to_arrays,
+                         export_dailies_snapshot, read_dailies_npz,
+                         write_dailies_npz)
+
+
+def test_dailies_to_arrays():
+    # given
+    docs = [
+        {'interval_date': datetime(2020, 1, 1, tzinfo=timezone.utc),
+         'meter_consumptions_kwh': [0.1] * 48, 'min_temperature_c': 12.5},
+        {'min_temperature_c': 10.0},
+        {'interval_date': datetime(2020, 1, 2, tzinfo=timezone.utc),
+         'solar_generations_kwh': list(range(48))},
+    ]
+
+    # when
+    arrays = dailies_to_arrays(docs)
+
+    # then
+    assert arrays['interval_date'].tolist() == [
+        datetime(2020, 1, 1).date(), datetime(2020, 1, 2).date()]
+    assert arrays['meter_consumptions_kwh'].shape == (2, 48)
+    assert arrays['meter_consumptions_kwh'][0].tolist() == [0.1] * 48
+    assert arrays['meter_consumptions_kwh'][1].tolist() == [0.0] * 48
+    assert arrays['solar_generations_kwh'][1, 47] == 47.0
+    assert arrays['min_temperature_c'][0] == 12.5
+    assert np.isnan(arrays['max_temperature_c']).all()
+
+
+def test_dailies_npz_column_select():
+    # given
+    docs = [{'interval_date': datetime(2020, 1, 1), 'meter_consumptions_kwh': [0.1] * 48}]
+    npz_buffer = BytesIO()
+    write_dailies_npz(dailies_to_arrays(docs), npz_buffer)
+    npz_buffer.seek(0)
+
+    # when
+    selected = read_dailies_npz(npz_buffer, ['meter_consumptions_kwh'])
+    npz_buffer.seek(0)
+    everything = read_dailies_npz(npz_buffer)
+
+    # then
+    assert sorted(selected.keys()) == ['interval_date', 'meter_consumptions_kwh']
+    assert selected['meter_consumptions_kwh'].dtype == np.float64
+    assert set(INTERVAL_COLUMNS) < set(everything.keys())
+
+
+def test_export_dailies_snapshot_incremental(tmp_path):
+    # given
+    dailies_store = MemoryDailiesStore()
+    blob_store = LocalBlobStore(tmp_path)
+    logger = logging.getLogger()
+    dailies_store.upsert_dailies('test_sites', '6408091979', {
+        '20200102': {'interval_date': datetime(2020, 1, 2), 'meter_consumptions_kwh': [0.2] * 48},
+        '20200101': {'interval_date': datetime(2020, 1, 1), 'meter_consumptions_kwh': [0.1] * 48},
+    })
+    first_read = export_dailies_snapshot(
+        dailies_store, blob_store, 'test_sites', '6408091979', logger)
+
+    # when
+    dailies_store.upsert_dailies('test_sites', '6408091979', {
+        '20200103': {'interval_date': datetime(2020, 1, 3), 'meter_consumptions_kwh': [0.3] * 48},
+        '20200101': {'interval_date': datetime(2020, 1, 1), 'solar_generations_kwh': [0.5] * 48},
+    })
+    second_read = export_dailies_snapshot(
+        dailies_store, blob_store, 'test_sites', '6408091979', logger)
+    third_read = export_dailies_snapshot(
+        dailies_store, blob_store, 'test_sites', '6408091979', logger)
+
+    # then
+    assert (first_read, second_read, third_read) == (2, 2, 0)
+    snapshot = read_dailies_npz(
+        BytesIO(blob_store.get('dailies_6408091979.npz')))
+    assert [str(d) for d in snapshot['interval_date']] == [
+        '2020-01-01', '2020-01-02', '2020-01-03']
+    assert snapshot['meter_consumptions_kwh'][:, 0].tolist() == [0.1, 0.2, 0.3]
+    assert snapshot['solar_generations_kwh'][:, 0].tolist() == [0.5, 0.0, 0.0]
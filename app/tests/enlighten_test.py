@@ -1,13 +1,19 @@
 import json
 import logging
 from datetime import datetime
+from pathlib import Path
 
 import pandas as pd
 
-from app import (ENLIGHTEN_API_KEY, ENLIGHTEN_SYSTEM_ID, ENLIGHTEN_USER_ID,
+from app import (ENLIGHTEN_API_KEY, ENLIGHTEN_STORAGE_PATH_PREFIX,
+                 ENLIGHTEN_SYSTEM_ID, ENLIGHTEN_USER_ID,
                  GCP_STORAGE_BUCKET_ID, init_firestore_client,
                  init_storage_client)
-from app.enlighten import get_enlighten_stats_resp, handle_enlighten_blob
+from app.backends import LocalBlobStore
+from app.benchmarks.enlighten_resample import join_groupby_day_df
+from app.enlighten import (create_enlighten_year_df,
+                           create_normalised_enlighten_stats_df,
+                           get_enlighten_stats_resp, handle_enlighten_blob)
 
 
 def test_get_enlighten_stats_resp():
@@ -45,3 +51,37 @@ def test_handle_enlighten_blob():
     # tear down
     doc = fdb.collection(
         'test_sites/6408091979/dailies').document('20190407').delete()
+
+
+def test_create_enlighten_year_df(tmp_path):
+    # given
+    blob_store = LocalBlobStore(tmp_path)
+    paths = sorted(Path('fixtures/enlighten/2019').glob('*.json'))
+    for path in paths:
+        blob_store.put(
+            f"{ENLIGHTEN_STORAGE_PATH_PREFIX}/2019/{path.name}", path.read_bytes())
+
+    # when
+    df_year = create_enlighten_year_df(
+        blob_store, 2019, logging.getLogger())
+
+    # then
+    df_per_day = pd.concat([join_groupby_day_df(
+        datetime.strptime(path.name[-13:-5], '%Y%m%d'), json.loads(path.read_text()).get('intervals'))
+        for path in paths])
+    assert df_year.equals(df_per_day)
+
+
+def test_create_normalised_enlighten_stats_df_matches_join_groupby():
+    for path in sorted(Path('fixtures/enlighten').glob('*/enlighten_stats_*.json')):
+        # given
+        interval_date = datetime.strptime(path.name[-13:-5], '%Y%m%d')
+        enlighten_intervals = json.loads(path.read_text()).get('intervals')
+
+        # when
+        df_day = create_normalised_enlighten_stats_df(
+            interval_date, enlighten_intervals)
+
+        # then
+        assert df_day.equals(join_groupby_day_df(
+            interval_date, enlighten_intervals)), path.name
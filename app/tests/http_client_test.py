@@ -0,0 +1,66 @@
+import pytest
+
+from app.benchmarks.http_reuse import StubHttpServer
+from app.http_client import close_http_sessions, conditional_get, http_get
+
+
+@pytest.fixture
+def stub_server():
+    servers = []
+
+    def start(**kwargs):
+        server = StubHttpServer(**kwargs).start()
+        servers.append(server)
+        return server
+
+    yield start
+    close_http_sessions()
+    for server in servers:
+        server.stop()
+
+
+def test_http_get_reuses_connection(stub_server):
+    # given
+    server = stub_server(body=b'{"intervals": []}')
+
+    # when
+    resps = [http_get(f"{server.url}/api/stats", params={'day': day})
+             for day in range(5)]
+
+    # then
+    assert [resp.json() for resp in resps] == [{'intervals': []}] * 5
+    assert server.requests == 5
+    assert server.connections == 1
+
+
+def test_http_get_retries_server_errors(stub_server):
+    # given
+    server = stub_server(failures=1)
+
+    # when
+    resp = http_get(f"{server.url}/api/stats")
+
+    # then
+    assert resp.status_code == 200
+    assert server.requests == 2
+
+
+def test_conditional_get(stub_server):
+    # given
+    server = stub_server(body=b'{"observations": {}}', etag='"v1"')
+    url = f"{server.url}/fwo/IDV60901.95874.json"
+    validators = {}
+
+    # when
+    first_resp = conditional_get(url, validators)
+    first_validators = dict(validators)
+    second_resp = conditional_get(url, validators)
+    server.etag = '"v2"'
+    third_resp = conditional_get(url, validators)
+
+    # then
+    assert first_resp.json() == {'observations': {}}
+    assert first_validators == {url: {'etag': '"v1"', 'last_modified': None}}
+    assert second_resp is None
+    assert third_resp.status_code == 200
+    assert validators[url]['etag'] == '"v2"'
@@ -0,0 +1,193 @@
+import logging
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from app import MANIFEST_STORAGE_PATH_PREFIX, NEM12_STORAGE_PATH_MERGED
+from app.backends import GcsBlobStore, LocalBlobStore
+from app.functions import on_storage_blob as on_storage_blob_module
+from app.idempotency import (EVENT_MARKER_PREFIX, EventLedger, acquire_lease,
+                             release_lease)
+from app.tests.backends_test import FakeGcsBucket
+
+BLOB_NAME = f"{NEM12_STORAGE_PATH_MERGED}/nem12_6408091979.csv"
+
+
+def _event(generation, metageneration='1', name=BLOB_NAME):
+    return {'bucket': 'test-bucket', 'name': name, 'generation': generation, 'metageneration': metageneration}
+
+
+@pytest.fixture
+def storage_function(tmp_path, monkeypatch):
+    blob_store = LocalBlobStore(tmp_path)
+    handled = []
+
+    def handle_blob(data, context, storage_client, bucket, blob_name, root_collection_name, logger):
+        handled.append(data['generation'])
+        if data.get('fail'):
+            raise RuntimeError('handler failed')
+
+    monkeypatch.setattr(on_storage_blob_module, 'init_gcp_logger', logging.getLogger)
+    monkeypatch.setattr(on_storage_blob_module, 'init_storage_client', lambda: None)
+    monkeypatch.setattr(on_storage_blob_module, 'init_blob_store', lambda bucket_name: blob_store)
+    monkeypatch.setattr(on_storage_blob_module, 'handle_nem12_blob_merged', handle_blob)
+    monkeypatch.setattr('app.idempotency.EVENT_LEDGER', None)
+
+    def on_storage_blob(data):
+        context = SimpleNamespace(event_id=f"event-{data['generation']}",
+                                  event_type='google.storage.object.finalize')
+        return on_storage_blob_module.on_storage_blob(data, context)
+
+    return blob_store, handled, on_storage_blob
+
+
+def test_event_ledger_claims_once(tmp_path):
+    # given
+    blob_store = LocalBlobStore(tmp_path)
+    ledger = EventLedger()
+
+    # when
+    first_claim = ledger.claim(blob_store, _event('1001'))
+    cached_claim = ledger.claim(blob_store, _event('1001'))
+    other_instance_claim = EventLedger().claim(blob_store, _event('1001'))
+    new_generation_claim = ledger.claim(blob_store, _event('1002'))
+    new_metageneration_claim = ledger.claim(blob_store, _event('1002', '2'))
+    ledger.release(blob_store, _event('1001'))
+    released_claim = EventLedger().claim(blob_store, _event('1001'))
+
+    # then
+    assert first_claim
+    assert not cached_claim
+    assert not other_instance_claim
+    assert new_generation_claim
+    assert new_metageneration_claim
+    assert released_claim
+    assert len(blob_store.list(EVENT_MARKER_PREFIX)) == 3
+    assert EventLedger().claim(blob_store, {'name': BLOB_NAME})
+
+
+def test_event_ledger_cache_size(tmp_path):
+    # given
+    blob_store = LocalBlobStore(tmp_path)
+    ledger = EventLedger(cache_size=2)
+
+    # when
+    for generation in ('1', '2', '3'):
+        ledger.claim(blob_store, _event(generation))
+
+    # then
+    assert len(ledger._claimed) == 2
+    assert not ledger.claim(blob_store, _event('1'))
+
+
+def test_on_storage_blob_skips_duplicate_events(storage_function):
+    # given
+    blob_store, handled, on_storage_blob = storage_function
+
+    # when
+    on_storage_blob(_event('1001'))
+    on_storage_blob(_event('1001'))
+    on_storage_blob(_event('1002'))
+    on_storage_blob(_event('1003', name=f"{MANIFEST_STORAGE_PATH_PREFIX}/nem12_merged_generations.json"))
+
+    # then
+    assert handled == ['1001', '1002']
+    assert len(blob_store.list(EVENT_MARKER_PREFIX)) == 2
+
+
+def test_on_storage_blob_retries_failed_events(storage_function):
+    # given
+    blob_store, handled, on_storage_blob = storage_function
+
+    # when
+    with pytest.raises(RuntimeError):
+        on_storage_blob({**_event('1001'), 'fail': True})
+    on_storage_blob(_event('1001'))
+
+    # then
+    assert handled == ['1001', '1001']
+    assert len(blob_store.list(EVENT_MARKER_PREFIX)) == 1
+
+
+def test_lease(tmp_path):
+    # given
+    blob_store = LocalBlobStore(tmp_path)
+    now = [1000.0]
+
+    def clock():
+        return now[0]
+
+    # when
+    first_token = acquire_lease(blob_store, 'manifests/lease.json', 60, clock=clock)
+    held_token = acquire_lease(blob_store, 'manifests/lease.json', 60, clock=clock)
+    now[0] += 61
+    taken_over_token = acquire_lease(blob_store, 'manifests/lease.json', 60, clock=clock)
+    release_lease(blob_store, 'manifests/lease.json', first_token)
+    still_held = blob_store.exists('manifests/lease.json')
+    release_lease(blob_store, 'manifests/lease.json', taken_over_token)
+
+    # then
+    assert first_token is not None
+    assert held_token is None
+    assert taken_over_token not in (None, first_token)
+    assert still_held
+    assert not blob_store.exists('manifests/lease.json')
+
+
+class JitteryBlobStore():
+    """Delays every request by a random few milliseconds, so racing contenders interleave their requests."""
+
+    def __init__(self, blob_store, seed):
+        self.blob_store = blob_store
+        self.rand = random.Random(seed)
+
+    def __getattr__(self, name):
+        request = getattr(self.blob_store, name)
+
+        def delayed(*args, **kwargs):
+            time.sleep(self.rand.uniform(0, 0.005))
+            return request(*args, **kwargs)
+
+        return delayed
+
+
+@pytest.mark.parametrize('store_type', ['local', 'gcs'])
+def test_lease_race(store_type, tmp_path):
+    # given
+    blob_store = JitteryBlobStore(
+        LocalBlobStore(tmp_path) if store_type == 'local' else GcsBlobStore(FakeGcsBucket()), seed=1)
+    contenders = 8
+    now = [1000.0]
+
+    def race():
+        start = threading.Barrier(contenders)
+        tokens = []
+
+        def contend():
+            start.wait()
+            tokens.append(acquire_lease(blob_store, 'manifests/lease.json', 60, clock=lambda: now[0]))
+
+        threads = [threading.Thread(target=contend) for _ in range(contenders)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return [token for token in tokens if token is not None]
+
+    # when
+    for_new_lease = race()
+    winners_of_expired_leases = []
+    for _ in range(5):
+        now[0] += 61
+        winners_of_expired_leases.append(race())
+    release_lease(blob_store, 'manifests/lease.json', for_new_lease[0])
+    still_held = blob_store.exists('manifests/lease.json')
+
+    # then
+    assert len(for_new_lease) == 1
+    assert [len(winners) for winners in winners_of_expired_leases] == [1] * 5
+    assert still_held
@@ -1,11 +1,29 @@
 import logging
+from collections import Counter
 from datetime import datetime
+from pathlib import Path
 
 import pandas as pd
 
 from app import (GCP_STORAGE_BUCKET_ID, LEMS_BATTERY_ID, LEMS_PASSWORD,
-                 LEMS_USER, init_firestore_client, init_storage_client)
-from app.lems import get_lems_data_resp, handle_lems_blob
+                 LEMS_STORAGE_PATH_PREFIX, LEMS_USER, init_firestore_client,
+                 init_storage_client)
+from app.backends import LocalBlobStore
+from app.benchmarks.lems_normalise import fix_dst_issue, groupby_lems_df
+from app.common import day_content_hashes, day_records
+from app.lems import (create_df_with_yesterday, create_lems_year_df,
+                      create_normalised_lems_df, get_lems_data_resp,
+                      handle_lems_blob)
+
+
+class CountingBlobStore(LocalBlobStore):
+    def __init__(self, root_dir):
+        super().__init__(root_dir)
+        self.gets = Counter()
+
+    def get(self, blob_name):
+        self.gets[blob_name] += 1
+        return super().get(blob_name)
 
 
 def test_get_lems_data_resp():
@@ -42,3 +60,65 @@ def test_handle_lems_blob():
     # tear down
     yesterday_doc = fdb.collection(
         'test_sites/6408091979/dailies').document('20190405').delete()
+
+
+def test_create_lems_year_df(tmp_path):
+    # given
+    blob_store = CountingBlobStore(tmp_path)
+    for path in sorted(Path('fixtures/lems').glob('*/lems_data_*.csv')):
+        blob_store.put(
+            f"{LEMS_STORAGE_PATH_PREFIX}/{path.parent.name}/{path.name}", path.read_bytes())
+    blob_names = [b.name for b in blob_store.list(
+        f"{LEMS_STORAGE_PATH_PREFIX}/2020")]
+
+    # when
+    df_year = create_lems_year_df(blob_store, 2020, logging.getLogger())
+
+    # then
+    assert set(blob_store.gets.values()) == {1}
+    assert len(blob_store.gets) == len(blob_names) + 1
+    df_per_blob = pd.concat([create_normalised_lems_df(create_df_with_yesterday(
+        blob_store, datetime.strptime(name[-12:-4], '%Y%m%d'), blob_store.get(name).decode('utf-8')))
+        for name in blob_names])
+    df_per_blob = df_per_blob.loc[~df_per_blob.index.duplicated(keep='first')]
+    pd.testing.assert_frame_equal(df_year, df_per_blob.sort_index())
+
+
+def test_create_normalised_lems_df_matches_groupby():
+    # given
+    paths = sorted(Path('fixtures/lems').glob('*/lems_data_*.csv'))
+    dfm = pd.concat([pd.read_csv(path) for path in paths], ignore_index=True)
+
+    # when
+    df_days = create_normalised_lems_df(dfm)
+
+    # then
+    df_reference = groupby_lems_df(pd.concat(
+        [fix_dst_issue(pd.read_csv(path)) for path in paths], ignore_index=True))
+    # On daylight saving transition days fix_dst_issue() placed rows out of order, in spring the day overlapping
+    # with the next file or the odd row it leaves got the day dropped
+    transition_days = pd.DatetimeIndex(
+        ['2018-04-01', '2018-10-07', '2019-04-07', '2019-10-06', '2020-04-05'], name='interval_date')
+    assert df_days.index.difference(df_reference.index).equals(
+        pd.DatetimeIndex(['2018-10-07', '2019-10-06'], name='interval_date'))
+    assert day_content_hashes(df_days.drop(transition_days, errors='ignore')) == day_content_hashes(
+        df_reference.drop(transition_days, errors='ignore'))
+    interval_date, day_data = next(day_records(df_days))
+    assert interval_date == df_reference.index[0]
+    assert len(day_data['capacities_kw']) == 48
+
+
+def test_create_normalised_lems_df_autumn_transition_day():
+    # given
+    dfm = pd.concat([pd.read_csv(f"fixtures/lems/2019/lems_data_2019040{day}.csv") for day in (6, 7, 8)],
+                    ignore_index=True)
+
+    # when
+    df_days = create_normalised_lems_df(dfm)
+
+    # then
+    assert [d.strftime('%Y%m%d') for d in df_days.index] == [
+        '20190406', '20190407', '20190408']
+    capacities = df_days.loc['2019-04-07', 'capacities_kw']
+    # LEMS leaves out 01:30 and 02:00, 23:00 and 23:30 AEST are in no file of local time
+    assert capacities.index[capacities.isna()].tolist() == [3, 4, 46, 47]
@@ -0,0 +1,24 @@
+import pytest
+
+import main
+from app.benchmarks.cold_start import measure_entry_point
+
+
+def test_entry_point_imports_only_its_dependencies():
+    # when
+    cold_start = measure_entry_point('on_fdb_dailies_write')
+
+    # then
+    assert not cold_start['pandas_imported']
+    assert 'pandas' not in cold_start['slowest_packages_ms']
+
+
+def test_entry_points_resolve():
+    # when
+    entry_points = {name: getattr(main, name) for name in main.ENTRY_POINTS}
+
+    # then
+    assert all(callable(entry_point) for entry_point in entry_points.values())
+    assert set(main.ENTRY_POINTS) <= set(dir(main))
+    with pytest.raises(AttributeError):
+        getattr(main, 'on_missing_function')
@@ -0,0 +1,128 @@
+import json
+import logging
+from pathlib import Path
+
+import pytest
+
+from app import ENLIGHTEN_STORAGE_PATH_PREFIX, NEM12_STORAGE_PATH_MERGED
+from app.backends import (LocalBlobStore, MemoryDailiesStore,
+                          configure_backends)
+from app.enlighten import handle_enlighten_blob
+from app.metrics import (current_span, increment, init_metrics_registry,
+                         span)
+from app.nem12 import handle_nem12_blob_merged
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@pytest.fixture
+def metrics_registry():
+    registry = init_metrics_registry()
+    registry.reset()
+    yield registry
+    registry.reset()
+
+
+@pytest.fixture
+def span_logger():
+    logger = logging.getLogger('metrics_test')
+    logger.setLevel(logging.INFO)
+    handler = ListHandler()
+    logger.addHandler(handler)
+    yield logger, handler.records
+    logger.removeHandler(handler)
+
+
+def test_spans_are_recorded_by_path(metrics_registry, span_logger):
+    # given
+    logger, records = span_logger
+
+    # when
+    for _ in range(2):
+        with span('handle', logger, blob_name='a.csv') as handle:
+            with span('download') as download:
+                download.add(rows=1, bytes=100)
+            with span('db_write') as db_write:
+                assert current_span() is db_write
+                db_write.add(rows=3, documents=4)
+    increment('events')
+    increment('events', 2)
+
+    # then
+    snapshot = metrics_registry.snapshot()
+    assert list(snapshot['stages']) == [
+        'handle', 'handle/db_write', 'handle/download']
+    assert snapshot['stages']['handle/download']['count'] == 2
+    assert snapshot['stages']['handle/download']['bytes'] == 200
+    assert snapshot['stages']['handle/db_write']['rows'] == 6
+    assert snapshot['stages']['handle/db_write']['documents'] == 8
+    assert snapshot['stages']['handle']['max_seconds'] <= snapshot['stages']['handle']['total_seconds']
+    assert snapshot['counters'] == {'events': 3}
+    assert current_span() is None
+    assert handle.duration_seconds >= download.duration_seconds + db_write.duration_seconds
+
+    # only the outermost span is logged, with its children
+    assert len(records) == 2
+    assert records[0].metrics['blob_name'] == 'a.csv'
+    assert [child['path'] for child in records[0].metrics['children']] == [
+        'handle/download', 'handle/db_write']
+    assert json.loads(metrics_registry.dump()) == snapshot
+
+
+def test_span_is_recorded_when_stage_fails(metrics_registry):
+    # when
+    with pytest.raises(ValueError):
+        with span('parse') as parse:
+            parse.add(rows=1)
+            raise ValueError('bad record')
+
+    # then
+    assert metrics_registry.snapshot()['stages']['parse']['count'] == 1
+    assert current_span() is None
+
+
+def test_handlers_record_stages(metrics_registry, span_logger, tmp_path):
+    # given
+    logger, records = span_logger
+    blob_store = LocalBlobStore(tmp_path)
+    enlighten_blob_name = f"{ENLIGHTEN_STORAGE_PATH_PREFIX}/2020/enlighten_stats_20200101.json"
+    nem12_blob_name = f"{NEM12_STORAGE_PATH_MERGED}/nem12_6408091979.csv"
+    enlighten_json = Path(
+        'fixtures/enlighten/2020/enlighten_stats_20200101.json').read_bytes()
+    blob_store.put(enlighten_blob_name, enlighten_json)
+    blob_store.put(nem12_blob_name, Path(
+        'fixtures/nem12/merged/nem12_6408091979_small.csv').read_bytes())
+    configure_backends(blob_store, MemoryDailiesStore())
+
+    try:
+        # when
+        handle_enlighten_blob(None, None, None, blob_store,
+                              enlighten_blob_name, 'sites', logger)
+        handle_nem12_blob_merged(None, None, None, blob_store,
+                                 nem12_blob_name, 'sites', logger)
+    finally:
+        configure_backends()
+
+    # then
+    stages = metrics_registry.snapshot()['stages']
+    assert {'handle_enlighten_blob/download', 'handle_enlighten_blob/parse', 'handle_enlighten_blob/normalise',
+            'handle_enlighten_blob/db_write'} <= set(stages)
+    assert stages['handle_enlighten_blob/download']['bytes'] == len(
+        enlighten_json)
+    assert stages['handle_enlighten_blob/parse']['rows'] == len(
+        json.loads(enlighten_json)['intervals'])
+    assert stages['handle_enlighten_blob/db_write']['documents'] == 2
+
+    nem12_days = stages['handle_nem12_blob_merged/aggregate']['rows']
+    assert nem12_days > 0
+    assert stages['handle_nem12_blob_merged/parse']['rows'] >= nem12_days
+    assert stages['handle_nem12_blob_merged/db_write']['rows'] == nem12_days
+    assert [record.metrics['name'] for record in records if hasattr(record, 'metrics')] == [
+        'handle_enlighten_blob', 'handle_nem12_blob_merged']
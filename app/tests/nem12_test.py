@@ -1,12 +1,27 @@
+import csv
 import logging
+import threading
+from collections import Counter
+from datetime import datetime
+from io import StringIO
 from os import listdir
 from os.path import isfile, join
 
+import numpy as np
 import pandas as pd
+import pytest
 
-from app import (GCP_STORAGE_BUCKET_ID, init_firestore_client,
+from app import (GCP_STORAGE_BUCKET_ID, NEM12_STORAGE_PATH_IN,
+                 NEM12_STORAGE_PATH_MERGED, init_firestore_client,
                  init_storage_client)
-from app.nem12 import Nem12Merger, handle_nem12_blob_merged
+from app.backends import LocalBlobStore, MemoryDailiesStore, configure_backends
+from app.benchmarks.nem12_flatten import groupby_day_frame, measure
+from app.benchmarks.nem12_memory import plain_object_model, retained_bytes
+from app.benchmarks.synthetic import write_synthetic_nem12
+from app.common import read_json_blob
+from app.nem12 import (NEM12_MERGED_MANIFEST_BLOB_NAME, Nem12Merger,
+                       handle_nem12_blob_in, handle_nem12_blob_merged,
+                       merge_new_nem12_blobs, read_nmis, write_nem12)
 
 NEM12_IN_PATH = 'fixtures/nem12/in'
 NEM12_MERGED_PATH = 'fixtures/nem12/merged'
@@ -16,6 +31,25 @@ NEM12_MERGED_FILES = [join(NEM12_MERGED_PATH, f) for f in listdir(
     NEM12_MERGED_PATH) if isfile(join(NEM12_MERGED_PATH, f))]
 
 
+class CountingBlobStore(LocalBlobStore):
+    def __init__(self, root_dir):
+        super().__init__(root_dir)
+        self.puts = Counter()
+
+    def put(self, blob_name, data, content_type=None):
+        self.puts[blob_name] += 1
+        return super().put(blob_name, data, content_type)
+
+
+def assert_day_frames_match(df_actual, df_expected):
+    """Same days and qualities, values equal up to the order they were summed in."""
+    assert df_actual.index.equals(df_expected.index)
+    assert df_actual['meter_data_qualities'].tolist() == df_expected['meter_data_qualities'].tolist()
+    for column in ['meter_consumptions_kwh', 'meter_generations_kwh']:
+        assert np.allclose(np.array(df_actual[column].tolist()),
+                           np.array(df_expected[column].tolist()))
+
+
 def test_nem12_parsing():
     # when
     merger = Nem12Merger(NEM12_IN_FILES)
@@ -57,3 +91,385 @@ def test_flatten_data():
     # then
     df_result = pd.read_pickle('fixtures/nem12/test_flatten_data.pkl')
     assert len(df_result.index) == len(dfm.index)
+
+
+def test_nem12_parsing_overlapping_files():
+    # when
+    merger = Nem12Merger(NEM12_IN_FILES + NEM12_IN_FILES + NEM12_MERGED_FILES)
+    expected = Nem12Merger(NEM12_IN_FILES)
+
+    # then
+    assert [nmr.key for nmr in merger.nmi_meter_registers] == [
+        nmr.key for nmr in expected.nmi_meter_registers]
+    assert [len(nmr.interval_days) for nmr in merger.nmi_meter_registers] == [
+        len(nmr.interval_days) for nmr in expected.nmi_meter_registers]
+
+
+def test_nem12_parsing_interval_length_change():
+    # given
+    nem12_30min_csv = '\n'.join([
+        '200,6400000002,E1B1,E1,E1,N1,1236594,KWH,30,',
+        f"300,20200101,{','.join(['0.6'] * 48)},A,,,20200102093000,",
+        f"300,20200102,{','.join(['0.6'] * 48)},A,,,20200103093000,",
+        '',
+    ])
+    nem12_5min_csv = '\n'.join([
+        '200,6400000002,E1B1,E1,E1,N1,1236594,KWH,5,',
+        f"300,20200102,{','.join(['0.2'] * 288)},V,,,20200103093000,",
+        '400,1,288,E52,,',
+        f"300,20200103,{','.join(['0.1'] * 288)},A,,,20200104093000,",
+        '',
+    ])
+
+    # when
+    merger = Nem12Merger([StringIO(nem12_30min_csv), StringIO(nem12_5min_csv)])
+    df_day = merger.flatten_to_frame()
+    csv_buffer = StringIO()
+    write_nem12(merger.nmi_meter_registers, csv_buffer)
+
+    # then
+    assert [(nmr.interval_length, len(nmr.interval_days)) for nmr in merger.nmi_meter_registers] == [
+        (30, 2), (5, 1)]
+    assert [sum(values) for values in df_day['meter_consumptions_kwh']] == pytest.approx([28.8, 28.8, 28.8])
+    assert {quality for qualities in df_day['meter_data_qualities'] for quality in qualities} == {'A'}
+    assert Nem12Merger([StringIO(csv_buffer.getvalue())]).flatten_to_frame().to_dict(
+        'index') == df_day.to_dict('index')
+
+
+def test_nem12_streaming():
+    # when
+    merger = Nem12Merger(NEM12_IN_FILES + NEM12_IN_FILES, streaming=True)
+    streamed = list(merger.iter_interval_days())
+
+    # then
+    assert len(streamed) == sum(len(nmr.interval_days)
+                                for nmr in Nem12Merger(NEM12_IN_FILES).nmi_meter_registers)
+    assert len(set(streamed)) == len(streamed)
+    assert all(len(iday.interval_values) == 48 for iday in streamed)
+
+
+def test_flatten_to_frame():
+    # given
+    merger = Nem12Merger(NEM12_IN_FILES)
+
+    # when
+    df_expected, groupby_stats = measure(groupby_day_frame, NEM12_IN_FILES)
+    df_actual, frame_stats = measure(merger.flatten_to_frame)
+
+    # then
+    assert_day_frames_match(df_actual, df_expected)
+    assert frame_stats['peak_bytes'] < groupby_stats['peak_bytes']
+
+
+def test_split_by_nmi():
+    # given
+    merger = Nem12Merger(NEM12_IN_FILES)
+
+    # when
+    split = {}
+    for nmi, nmrs in merger.nmi_meter_registers_by_nmi().items():
+        csv_buffer = StringIO()
+        write_nem12(nmrs, csv_buffer)
+        split[nmi] = csv_buffer.getvalue()
+
+    # then
+    assert sorted(split.keys()) == ['6123456789', '6408091979']
+    for nmi, nmi_csv in split.items():
+        assert read_nmis(StringIO(nmi_csv)) == {nmi}
+        assert Nem12Merger([StringIO(nmi_csv)]).flatten_data() == [
+            row for row in merger.flatten_data() if row['nmi'] == nmi]
+
+
+def test_nem12_parsing_without_lines():
+    # given
+    nem12_files = NEM12_IN_FILES[:1]
+
+    # when
+    _, plain_bytes = retained_bytes(plain_object_model, nem12_files)
+    merger, compact_bytes = retained_bytes(
+        lambda files: Nem12Merger(files, keep_lines=False), nem12_files)
+
+    # then
+    assert compact_bytes * 3 < plain_bytes
+    assert merger.flatten_to_frame().to_dict('index') == Nem12Merger(
+        nem12_files).flatten_to_frame().to_dict('index')
+    with pytest.raises(ValueError):
+        write_nem12(merger.nmi_meter_registers, StringIO())
+
+
+def test_flatten_to_frame_5_minute_intervals(tmp_path):
+    # given
+    nem12_file = write_synthetic_nem12(str(tmp_path / 'nem12_5min.csv'), ['6400000000'], ['E1', 'B1'],
+                                       datetime(2020, 1, 1), 3, interval_length=5)
+    with open(nem12_file) as csv_file:
+        first_e1_row = [row for row in csv.reader(csv_file) if row[0] == '300'][0]
+
+    # when
+    merger = Nem12Merger([nem12_file], keep_lines=False)
+    df_day = merger.flatten_to_frame()
+    df_high_res = merger.flatten_to_frame(5)
+
+    # then
+    assert_day_frames_match(df_day, groupby_day_frame([nem12_file]))
+    assert {len(values) for values in df_day['meter_consumptions_kwh']} == {48}
+    assert {len(values) for values in df_high_res['meter_generations_kwh']} == {288}
+    assert df_day['meter_consumptions_kwh'][0][0] == pytest.approx(
+        sum(float(value) for value in first_e1_row[2:8]))
+    assert np.allclose(np.array(df_high_res['meter_consumptions_kwh'].tolist()).reshape(3, 48, 6).sum(axis=2),
+                       np.array(df_day['meter_consumptions_kwh'].tolist()))
+
+
+def test_handle_nem12_blob_merged_high_res(tmp_path, monkeypatch):
+    # given
+    blob_store = LocalBlobStore(tmp_path / 'blobs')
+    dailies_store = MemoryDailiesStore()
+    configure_backends(blob_store, dailies_store)
+    monkeypatch.setattr('app.nem12.NEM12_HIGH_RES_DAILIES', True)
+    nem12_file = write_synthetic_nem12(str(tmp_path / 'nem12_5min.csv'), ['6400000000'], ['E1', 'B1'],
+                                       datetime(2020, 1, 1), 3, interval_length=5)
+    blob_name = 'nem12/merged/nem12_6400000000.csv'
+    with open(nem12_file, 'rb') as csv_file:
+        blob_store.put(blob_name, csv_file.read())
+
+    # when
+    try:
+        handle_nem12_blob_merged(None, None, None, blob_store, blob_name,
+                                 'test_sites', logging.getLogger())
+    finally:
+        configure_backends()
+
+    # then
+    dailies = dict(dailies_store.stream_dailies('test_sites', '6400000000'))
+    high_res_dailies = dict(dailies_store.stream_dailies(
+        'test_sites', '6400000000', collection_name='dailies_5min'))
+    assert sorted(high_res_dailies) == sorted(dailies) == ['20200101', '20200102', '20200103']
+    assert len(dailies['20200101']['meter_consumptions_kwh']) == 48
+    assert len(high_res_dailies['20200101']['meter_consumptions_kwh']) == 288
+    assert dailies_store.sites[('test_sites', '6400000000')]['interval_length'] == 30
+    assert dailies_store.sites[('test_sites', '6400000000')]['high_res_interval_length'] == 5
+
+
+def test_handle_nem12_blob_merged_mixed_interval_lengths(tmp_path, monkeypatch):
+    # given
+    blob_store = LocalBlobStore(tmp_path / 'blobs')
+    dailies_store = MemoryDailiesStore()
+    configure_backends(blob_store, dailies_store)
+    monkeypatch.setattr('app.nem12.NEM12_HIGH_RES_DAILIES', True)
+    consumption_file = write_synthetic_nem12(str(tmp_path / 'nem12_5min.csv'), ['6400000000'], ['E1'],
+                                             datetime(2020, 1, 1), 2, interval_length=5)
+    generation_file = write_synthetic_nem12(str(tmp_path / 'nem12_30min.csv'), ['6400000000'], ['B1'],
+                                            datetime(2020, 1, 1), 2, interval_length=30)
+    merger = Nem12Merger([consumption_file, generation_file])
+    blob_name = 'nem12/merged/nem12_6400000000.csv'
+    csv_buffer = StringIO()
+    write_nem12(merger.nmi_meter_registers, csv_buffer)
+    blob_store.put(blob_name, csv_buffer.getvalue().encode('utf-8'))
+
+    # when
+    df_high_res = merger.flatten_to_frame(5)
+    try:
+        handle_nem12_blob_merged(None, None, None, blob_store, blob_name,
+                                 'test_sites', logging.getLogger())
+    finally:
+        configure_backends()
+
+    # then
+    assert merger.skipped_registers == {('6400000000', '1236594', 'B1', 'E1B1', 30): 1}
+    assert {sum(values) for values in df_high_res['meter_generations_kwh']} == {0.0}
+    dailies = dict(dailies_store.stream_dailies('test_sites', '6400000000'))
+    assert sorted(dailies) == ['20200101', '20200102']
+    assert sum(dailies['20200101']['meter_generations_kwh']) > 0
+    assert dict(dailies_store.stream_dailies(
+        'test_sites', '6400000000', collection_name='dailies_5min')) == {}
+    assert 'high_res_interval_length' not in dailies_store.sites[('test_sites', '6400000000')]
+
+
+NEM12_ALL_RECORDS_CSV = '\n'.join([
+    '100,NEM12,202001020930,UNITEDENERGY,RETAILER',
+    '200,6400000002,E1B1,E1,E1,N1,1236594,KWH,30,',
+    f"300,20200101,{','.join(['0.5'] * 48)},V,,,20200102093000,",
+    '400,1,40,A,,',
+    '400,41,48,S53,,',
+    '500,O,00001,20200101235900,1234.5',
+    f"300,20200102,{','.join(['0.25'] * 48)},A,,,20200102093000,",
+    '900',
+    '',
+])
+
+NEM13_CSV = '\n'.join([
+    '100,NEM13,202002010930,UNITEDENERGY,RETAILER',
+    '250,6400000003,11,1,11,11,01009,E,1000.0,20200101000000,A,,,1144.0,20200104000000,A,,,144.0,KWH,20200401,20200104093000,',
+    '550,N,,A,',
+    '250,6400000003,11,1,11,11,01009,E,1144.0,20200104000000,A,,,1168.0,20200105000000,E52,,,24.0,KWH,20200401,20200105093000,',
+    '250,6400000003,11,2,21,21,01009,I,500.0,20200104000000,A,,,512.0,20200105000000,A,,,12.0,KWH,20200401,20200105093000,',
+    '900',
+    '',
+])
+
+
+def test_nem12_all_record_types():
+    # when
+    merger = Nem12Merger([StringIO(NEM12_ALL_RECORDS_CSV)])
+    csv_buffer = StringIO()
+    write_nem12(merger.nmi_meter_registers, csv_buffer)
+
+    # then
+    assert merger.skipped_records == {}
+    assert [(header.version, header.created_at) for header in merger.headers] == [
+        ('NEM12', datetime(2020, 1, 2, 9, 30))]
+    first_day, second_day = merger.nmi_meter_registers[0].interval_days
+    assert len(first_day.variable_qualities) == 2
+    assert first_day.b2b_details[0].read_at == datetime(2020, 1, 1, 23, 59)
+    assert first_day.b2b_details[0].index_read == 1234.5
+    assert second_day.b2b_details is None
+    assert first_day.interval_qualities == b'A' * 40 + b'S' * 8
+    assert list(first_day.interval_methods) == [0] * 40 + [53] * 8
+    assert second_day.interval_qualities == b'A' * 48
+    assert [row[0] for row in csv.reader(StringIO(csv_buffer.getvalue()))] == [
+        '200', '300', '400', '400', '500', '300']
+
+
+def test_nem12_unknown_record_types():
+    # when
+    merger = Nem12Merger([StringIO('100,NEM12,202001020930,A,B\n999,x\n999,y\n900\n')])
+
+    # then
+    assert merger.skipped_records == {'999': 2}
+    assert merger.nmi_meter_registers == []
+
+
+def test_nem13_accumulation_reads():
+    # when
+    merger = Nem12Merger([StringIO(NEM13_CSV), StringIO(NEM13_CSV)])
+    df_day = merger.flatten_to_frame()
+    csv_buffer = StringIO()
+    write_nem12([], csv_buffer, merger.accumulation_reads)
+
+    # then
+    assert [read.quantity for read in merger.accumulation_reads] == [144.0, 24.0, 12.0]
+    assert merger.accumulation_reads[0].b2b_details.current_trans_code == 'A'
+    assert [d.strftime('%Y%m%d') for d in df_day.index] == [
+        '20200101', '20200102', '20200103', '20200104']
+    assert df_day['meter_consumptions_kwh'][0] == [1.0] * 48
+    assert df_day['meter_consumptions_kwh'][3] == [0.5] * 48
+    assert df_day['meter_generations_kwh'][0] == [0.0] * 48
+    assert df_day['meter_generations_kwh'][3] == [0.25] * 48
+    assert df_day['meter_data_qualities'][3] == ['E'] * 48
+    assert df_day['meter_data_methods'][3] == [52] * 48
+    assert read_nmis(StringIO(csv_buffer.getvalue())) == {'6400000003'}
+    assert [row[0] for row in csv.reader(StringIO(csv_buffer.getvalue()))] == [
+        '250', '550', '250', '250']
+
+
+def test_flatten_to_frame_interval_qualities():
+    # given
+    nem12_csv = '\n'.join([
+        '200,6400000002,E1B1,E1,E1,N1,1236594,KWH,5,',
+        f"300,20200101,{','.join(['0.1'] * 288)},V,,,20200102093000,",
+        '400,1,3,A,,',
+        '400,4,4,E52,,',
+        '400,5,282,A,,',
+        '400,283,288,S53,,',
+        '200,6400000002,E1B1,B1,B1,N1,1236594,KWH,30,',
+        f"300,20200101,{','.join(['0.0'] * 48)},F14,,,20200102093000,",
+        '',
+    ])
+
+    # when
+    merger = Nem12Merger([StringIO(nem12_csv)], keep_lines=False)
+    df_day = merger.flatten_to_frame()
+    df_high_res = merger.flatten_to_frame(5)
+
+    # then
+    assert df_day['meter_data_qualities'][0] == ['E'] + ['A'] * 46 + ['S']
+    assert df_day['meter_data_methods'][0] == [52] + [0] * 46 + [53]
+    assert_day_frames_match(df_day, groupby_day_frame([StringIO(nem12_csv)]))
+    assert df_high_res['meter_data_qualities'][0] == ['A'] * 3 + ['E'] + ['A'] * 278 + ['S'] * 6
+
+
+def test_flatten_to_frame_most_severe_quality():
+    # given
+    nem12_csv = '\n'.join([
+        '200,6400000002,E1B1,E1,E1,N1,1236594,KWH,5,',
+        f"300,20200101,{','.join(['0.1'] * 288)},V,,,20200102093000,",
+        '400,1,1,A,,',
+        '400,2,2,E52,,',
+        '400,3,3,S53,,',
+        '400,4,4,E54,,',
+        '400,5,5,N,,',
+        '400,6,6,A,,',
+        '400,7,7,N,,',
+        '400,8,12,A,,',
+        '400,13,13,E52,,',
+        '400,14,14,E58,,',
+        '400,15,18,V,,',
+        '400,19,19,S53,,',
+        '400,20,23,A,,',
+        '400,24,24,F14,,',
+        '400,25,288,A,,',
+        '',
+    ])
+
+    # when
+    df_day = Nem12Merger([StringIO(nem12_csv)], keep_lines=False).flatten_to_frame()
+
+    # then
+    assert df_day['meter_data_qualities'][0][:5] == ['S', 'N', 'E', 'F', 'A']
+    assert df_day['meter_data_methods'][0][:5] == [53, 0, 52, 14, 0]
+    assert df_day['meter_consumptions_kwh'][0][0] == pytest.approx(0.6)
+    assert_day_frames_match(df_day, groupby_day_frame([StringIO(nem12_csv)]))
+
+
+def test_merge_new_nem12_blobs_corrected_upload(tmp_path):
+    # given
+    blob_store = LocalBlobStore(tmp_path)
+    blob_name = f"{NEM12_STORAGE_PATH_IN}/upload.csv"
+
+    def nem12_csv(value, days):
+        return '\n'.join(['200,6400000002,E1B1,E1,E1,N1,1236594,KWH,30,'] + [
+            f"300,2020010{day},{','.join([value] * 48)},A,,,20200105093000," for day in days] + [''])
+
+    blob_store.put(f"{NEM12_STORAGE_PATH_IN}/other.csv", nem12_csv('0.5', [3]))
+    blob_store.put(blob_name, nem12_csv('0.1', [1, 2]))
+    merge_new_nem12_blobs(blob_store, logging.getLogger())
+
+    # when
+    blob_store.put(f"{NEM12_STORAGE_PATH_IN}/later.csv", nem12_csv('0.9', [2, 3]))
+    blob_store.replace(blob_name, nem12_csv('0.2', [1, 2]), blob_store.stat(blob_name).generation)
+    merged_count = merge_new_nem12_blobs(blob_store, logging.getLogger())
+
+    # then
+    merger = Nem12Merger([StringIO(blob_store.get(f"{NEM12_STORAGE_PATH_MERGED}/nem12_6400000002.csv").decode('utf-8'))])
+    assert merged_count == 2
+    assert [iday.interval_values[0] for iday in merger.nmi_meter_registers[0].interval_days] == [0.2, 0.2, 0.5]
+
+
+def test_handle_nem12_blob_in_coalesces_burst(tmp_path):
+    # given
+    blob_store = CountingBlobStore(tmp_path)
+    blob_names = []
+    for i, nem12_file in enumerate(NEM12_IN_FILES + NEM12_MERGED_FILES):
+        blob_names.append(f"{NEM12_STORAGE_PATH_IN}/upload_{i}.csv")
+        with open(nem12_file, 'rb') as csv_file:
+            blob_store.put(blob_names[-1], csv_file.read())
+    burst = threading.Barrier(len(blob_names))
+
+    def on_blob_event(blob_name):
+        burst.wait()
+        handle_nem12_blob_in(None, None, None, blob_store, blob_name,
+                             logging.getLogger(), window_seconds=0.2)
+
+    # when
+    threads = [threading.Thread(target=on_blob_event, args=(blob_name,))
+               for blob_name in blob_names]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # then
+    merged_puts = {name: count for name, count in blob_store.puts.items()
+                   if name.startswith(NEM12_STORAGE_PATH_MERGED)}
+    assert merged_puts == {f"{NEM12_STORAGE_PATH_MERGED}/nem12_6123456789.csv": 1,
+                           f"{NEM12_STORAGE_PATH_MERGED}/nem12_6408091979.csv": 1}
+    assert sorted(read_json_blob(blob_store, NEM12_MERGED_MANIFEST_BLOB_NAME)) == blob_names
@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+
+from app.common import LOCAL_TZ
+from app.timealign import (local_day_slot_counts, utc_to_aest_slots,
+                           utc_to_local_ns)
+
+
+def test_utc_to_local_ns():
+    # given
+    utc_times = pd.date_range('2018-12-31', '2021-01-02', freq='7min', tz='UTC')
+
+    # when
+    local_ns = utc_to_local_ns(utc_times.asi8)
+
+    # then
+    assert np.array_equal(
+        local_ns, utc_times.tz_convert(LOCAL_TZ).tz_localize(None).asi8)
+
+
+def test_utc_to_aest_slots():
+    # given
+    utc_times = pd.DatetimeIndex(
+        ['2019-04-06T13:30:00Z', '2019-04-06T14:00:00Z', '2019-04-06T15:37:30Z', '2019-04-07T13:30:00Z'])
+
+    # when
+    days, slots, aligned = utc_to_aest_slots(utc_times.asi8)
+
+    # then
+    assert [str(d) for d in days.astype('datetime64[ns]').astype('datetime64[D]')] == [
+        '2019-04-06', '2019-04-07', '2019-04-07', '2019-04-07']
+    assert slots.tolist() == [47, 0, 3, 47]
+    assert aligned.tolist() == [True, True, False, True]
+
+
+def test_local_day_slot_counts():
+    # given
+    days = pd.date_range('2019-01-01', '2020-12-31', freq='D')
+
+    # when
+    slot_counts = local_day_slot_counts(days.asi8)
+
+    # then
+    assert {day.strftime('%Y%m%d'): count for day, count in zip(days, slot_counts) if count != 48} == {
+        '20190407': 50, '20191006': 46, '20200405': 50, '20201004': 46}
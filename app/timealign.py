@@ -0,0 +1,83 @@
+"""
+Alignment of source timestamps to the AEST (UTC+10, no daylight saving) slots the dailies are kept in.
+NEM12 interval data is already in AEST, Enlighten and LEMS report UTC or Melbourne local time.
+
+Local offsets are looked up in a table of the LOCAL_TZ offset transitions, precomputed once per year,
+with a vectorised search over int64 nanosecond timestamps instead of converting timestamps one by one.
+Local days are 48 half hours except the daylight saving transition days, 46 in spring and 50 in autumn,
+see local_day_slot_counts().
+"""
+
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from app.common import LOCAL_TZ
+
+MINUTE_NS = 60 * 10**9
+DAY_NS = 24 * 60 * MINUTE_NS
+AEST_OFFSET_NS = 10 * 60 * MINUTE_NS
+SLOTS_PER_DAY = 48
+
+
+@lru_cache(maxsize=None)
+def transition_table(year):
+    """
+    (utc_ns, offset_ns) arrays of LOCAL_TZ in year, offset_ns[i] is the UTC offset from utc_ns[i],
+    the first entry is the offset at the start of the year.
+    """
+    # Transitions happen on the quarter hour in UTC in every zone in use
+    utc_times = pd.date_range(
+        f"{year}-01-01", f"{year + 1}-01-01", freq='15min', tz='UTC')[:-1]
+    offsets = (utc_times.tz_convert(LOCAL_TZ).tz_localize(None) -
+               utc_times.tz_localize(None)).asi8
+    changes = np.concatenate([[0], np.flatnonzero(np.diff(offsets)) + 1])
+
+    return utc_times.asi8[changes], offsets[changes]
+
+
+def _offsets_ns(utc_ns):
+    utc_ns = np.asarray(utc_ns, dtype=np.int64)
+    if utc_ns.size == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    first_year = pd.Timestamp(utc_ns.min()).year
+    last_year = pd.Timestamp(utc_ns.max()).year
+    tables = [transition_table(year)
+              for year in range(first_year, last_year + 1)]
+    table_utc_ns = np.concatenate([table_utc for table_utc, _ in tables])
+    table_offsets_ns = np.concatenate([offsets for _, offsets in tables])
+
+    return table_offsets_ns[np.searchsorted(table_utc_ns, utc_ns, side='right') - 1]
+
+
+def utc_to_local_ns(utc_ns):
+    """UTC int64 nanoseconds to naive Melbourne local time int64 nanoseconds."""
+    utc_ns = np.asarray(utc_ns, dtype=np.int64)
+
+    return utc_ns + _offsets_ns(utc_ns)
+
+
+def utc_to_aest_slots(utc_ns, slot_minutes=30):
+    """
+    Maps UTC int64 nanoseconds to AEST slots of slot_minutes.
+    Returns (days, slots, aligned), days as int64 nanoseconds of the AEST midnight (naive), slots the index of the
+    slot within the day and aligned whether the timestamp is exactly on a slot boundary.
+    """
+    aest_ns = np.asarray(utc_ns, dtype=np.int64) + AEST_OFFSET_NS
+    days = aest_ns // DAY_NS * DAY_NS
+    slot_ns = slot_minutes * MINUTE_NS
+
+    return days, (aest_ns - days) // slot_ns, (aest_ns - days) % slot_ns == 0
+
+
+def local_day_slot_counts(days_ns, slot_minutes=30):
+    """Number of slots in each local day (naive midnight int64 nanoseconds), fewer or more on DST transition days."""
+    days_ns = np.asarray(days_ns, dtype=np.int64)
+    # Transitions are at 2 or 3 am, so the offset at midnight standard time is the offset at local midnight
+    midnights_utc = days_ns - _offsets_ns(days_ns - AEST_OFFSET_NS)
+    next_midnights_utc = days_ns + DAY_NS - \
+        _offsets_ns(days_ns + DAY_NS - AEST_OFFSET_NS)
+
+    return (next_midnights_utc - midnights_utc) // (slot_minutes * MINUTE_NS)
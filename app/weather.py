@@ -1,16 +1,40 @@
 import pandas as pd
-import requests
 
-from app import (NMI, SCORESBY_WEATHER_URL, VIEWBANK_WEATHER_URL,
-                 init_gcp_logger)
-from app.common import merge_df_to_db
+from app import (GCP_STORAGE_BUCKET_ID, MANIFEST_STORAGE_PATH_PREFIX, NMI,
+                 SCORESBY_WEATHER_URL, VIEWBANK_WEATHER_URL, init_gcp_logger)
+from app.backends import init_blob_store
+from app.common import merge_df_to_db, read_json_blob, write_json_blob
+from app.http_client import conditional_get, http_get
 
 
-def daily_temperatures_to_db(root_collection_name):
+def daily_temperatures_to_db(root_collection_name, bucket=None):
+    """
+    Loads the daily min and max temperatures of the BOM observations into Firestore.
+    The observations are requested with the ETag and Last-Modified of the last load and nothing is written
+    if neither feed has changed since.
+    """
     gcp_logger = init_gcp_logger()
-    viewbank_data = requests.get(VIEWBANK_WEATHER_URL).json().get(
+    if bucket is None:
+        bucket = init_blob_store(GCP_STORAGE_BUCKET_ID)
+
+    # Kept per root collection, so loading test_sites does not make loading sites skip
+    validators_blob_name = f"{MANIFEST_STORAGE_PATH_PREFIX}/{root_collection_name}/weather_validators.json"
+    validators = read_json_blob(bucket, validators_blob_name, {})
+    viewbank_resp = conditional_get(VIEWBANK_WEATHER_URL, validators)
+    scoresby_resp = conditional_get(SCORESBY_WEATHER_URL, validators)
+    if viewbank_resp is None and scoresby_resp is None:
+        gcp_logger.info(
+            'daily_temperatures_to_db(), observations not modified, skipping.')
+        return
+
+    # Only one feed has changed, the other is still needed in full
+    if viewbank_resp is None:
+        viewbank_resp = http_get(VIEWBANK_WEATHER_URL)
+    if scoresby_resp is None:
+        scoresby_resp = http_get(SCORESBY_WEATHER_URL)
+    viewbank_data = viewbank_resp.json().get(
         'observations').get('data')
-    scoresby_data = requests.get(SCORESBY_WEATHER_URL).json().get(
+    scoresby_data = scoresby_resp.json().get(
         'observations').get('data')
 
     dfm_viewbank = pd.DataFrame(viewbank_data)
@@ -36,4 +60,6 @@ def daily_temperatures_to_db(root_collection_name):
         df_day_scoresby['max_temperature_c'])
 
     merge_df_to_db(NMI, df_day_viewbank, root_collection_name, gcp_logger)
+
+    write_json_blob(bucket, validators_blob_name, validators)
 # %%
@@ -1,9 +1,35 @@
-from app.functions.on_fdb_dailies_write import on_fdb_dailies_write
-from app.functions.on_http_fetch_dailies import on_http_fetch_dailies
-from app.functions.on_http_fetch_weather import on_http_fetch_daily_temperatures
-from app.functions.on_http_get_enlighten_data import on_http_get_enlighten_data
-from app.functions.on_http_get_lems_data import on_http_get_lems_data
-from app.functions.on_http_reload_enlighten import on_http_reload_enlighten
-from app.functions.on_http_reload_lems import on_http_reload_lems
-from app.functions.on_http_reload_nem12 import on_http_reload_nem12
-from app.functions.on_storage_blob import on_storage_blob
+"""
+Cloud Functions entry points, every function is deployed from this module with its --entry-point.
+Function modules are imported on first lookup of their entry point (module __getattr__),
+so a cold start only imports the dependencies of the function being started, e.g. on_fdb_dailies_write
+does not import pandas.  See app/benchmarks/cold_start.py for the import time of each entry point.
+"""
+
+import importlib
+
+ENTRY_POINTS = {
+    'on_fdb_dailies_write': 'app.functions.on_fdb_dailies_write',
+    'on_http_fetch_dailies': 'app.functions.on_http_fetch_dailies',
+    'on_http_fetch_daily_temperatures': 'app.functions.on_http_fetch_weather',
+    'on_http_get_enlighten_data': 'app.functions.on_http_get_enlighten_data',
+    'on_http_get_lems_data': 'app.functions.on_http_get_lems_data',
+    'on_http_reload_enlighten': 'app.functions.on_http_reload_enlighten',
+    'on_http_reload_lems': 'app.functions.on_http_reload_lems',
+    'on_http_reload_nem12': 'app.functions.on_http_reload_nem12',
+    'on_storage_blob': 'app.functions.on_storage_blob',
+}
+
+
+def __getattr__(name):
+    module_name = ENTRY_POINTS.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    entry_point = getattr(importlib.import_module(module_name), name)
+    globals()[name] = entry_point
+
+    return entry_point
+
+
+def __dir__():
+    return sorted(list(globals()) + list(ENTRY_POINTS))